@@ -1,12 +1,18 @@
 import logging
+import os
 import signal
 import time
 
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.options import define, parse_command_line, options
+from tornado.process import cpu_count
 
-from .app import ShoestringApplication
+from .app import SECRET_ENV_KEY, ShoestringApplication, generate_secret, get_backend_class
+from .process import (
+    REUSE_PORT, bind_worker_sockets, fork_workers, inherited_sockets, notify_ready, spawn_successor)
+from .watchdog import Watchdog
 
 
 define('debug', default=False, type=bool, help='Run in debug mode')
@@ -14,6 +20,27 @@ define('port', default=8080, type=int, help='Server port')
 define('allowed_hosts', multiple=True, help='Allowed hosts for cross domain connections')
 define('backend', default='shoestring.backends.memory', help='Backend for storing connections.')
 define('graceful', default=10, type=int, help='Max number of seconds to wait for a graceful shutdown.')
+define('drain_window', default=0.0, type=float,
+       help='Seconds over which a graceful shutdown closes sockets in batches. Use 0 to close all at once.')
+define('drain_reconnect_jitter', default=1000, type=int,
+       help='Max random reconnect delay in milliseconds hinted to clients closed by the drain.')
+define('drain_timeout', default=300, type=int,
+       help='Max number of seconds a replaced server keeps its connections after a hot restart (SIGUSR2).')
+define('workers', default=1, type=int, help='Number of server processes. Use 0 for one per CPU.')
+define('outbound_max_messages', default=1000, type=int, help='Max messages queued for a slow socket.')
+define('outbound_max_bytes', default=1024 * 1024, type=int, help='Max bytes queued for a slow socket.')
+define('outbound_policy', default='close', help='Slow socket policy: close, drop or coalesce.')
+define('batch_window', default=0, type=float, help='Milliseconds to batch messages from a socket.')
+define('resume_log_size', default=0, type=int, help='Messages kept per channel to resume sessions.')
+define('token_format', default='jwt', help='Format of issued room tokens: jwt or compact.')
+define('token_cache_size', default=10000, type=int, help='Max verified tokens to cache. Use 0 to disable.')
+define('compression_level', default=0, type=int,
+       help='permessage-deflate level (1-9) for clients supporting it. Use 0 to disable.')
+define('compression_mem_level', default=8, type=int, help='zlib memory level (1-9) for compression.')
+define('compression_window_bits', default=15, type=int, help='zlib window bits (9-15) for compression.')
+define('compression_min_size', default=256, type=int, help='Smallest message size in bytes to compress.')
+define('blocking_threshold', default=0.0, type=float,
+       help='Log callbacks blocking the IOLoop longer than this many milliseconds. Use 0 to disable.')
 
 
 def shutdown(server, application, graceful=True, ioloop=None):
@@ -31,7 +58,7 @@ def shutdown(server, application, graceful=True, ioloop=None):
         ioloop.stop()
         logging.info('Stopped.')
 
-    deadline = time.time() + options.graceful
+    deadline = time.time() + options.graceful + (options.drain_window if graceful else 0)
 
     def poll():
         now = time.time()
@@ -46,18 +73,101 @@ def shutdown(server, application, graceful=True, ioloop=None):
         finalize()
 
 
-def main(ioloop=None):
+def drain(server, application, ioloop=None):
+    """Stop accepting connections and shut down once the open ones are gone."""
     ioloop = ioloop or IOLoop.current()
+    logging.info('Draining connections...')
+    server.stop()
+    deadline = time.time() + options.drain_timeout
+
+    def poll():
+        remaining = application.backend.subscriber_count()
+        now = time.time()
+        if remaining and now < deadline:
+            ioloop.add_timeout(now + 1, poll)
+        else:
+            if remaining:
+                logging.info('Drain timeout reached with %d connections open.', remaining)
+            shutdown(server, application, graceful=True, ioloop=ioloop)
+
+    poll()
+
+
+def restart(server, application, sockets, ioloop=None):
+    """Hand the listening sockets to a new server process and drain this one.
+
+    The new process is a child of this one. Under systemd run the service
+    with ``Type=notify`` and ``NotifyAccess=all`` so the new process can
+    report itself as the main process and survives this one exiting.
+    """
+    if getattr(server, '_restarting', False) or getattr(server, '_stopping', False):
+        logging.warning('Already restarting or stopping, ignoring restart.')
+        return
+    server._restarting = True
+
+    def ready(started):
+        if started:
+            logging.info('New server process is accepting connections.')
+            drain(server, application, ioloop=ioloop)
+        else:
+            server._restarting = False
+            logging.error('New server process failed to start, still serving.')
+
+    # Tokens issued by this process stay valid in the new one
+    env = {SECRET_ENV_KEY: application.settings['secret']}
+    spawn_successor(sockets, ready, env=env, io_loop=ioloop)
+
+
+def main(ioloop=None):
     parse_command_line()
+    workers = options.workers if options.workers > 0 else cpu_count()
+    # Sockets handed over by a server which is being hot restarted
+    sockets = inherited_sockets()
+    # Generated before forking so every worker signs tokens with the same key
+    secret = os.environ.get(SECRET_ENV_KEY) or generate_secret()
+    if workers > 1:
+        if get_backend_class(options.backend).process_local:
+            msg = 'The {} backend cannot be shared by multiple workers.'.format(options.backend)
+            raise RuntimeError(msg)
+        if not REUSE_PORT:
+            # Workers share the listening sockets inherited from the parent
+            sockets = sockets or bind_sockets(options.port)
+        worker = fork_workers(workers)
+        logging.info('Started worker %d', worker)
+        sockets = sockets or bind_worker_sockets(options.port)
+    ioloop = ioloop or IOLoop.current()
     application = ShoestringApplication(
-        debug=options.debug, backend=options.backend, allowed_hosts=options.allowed_hosts)
+        debug=options.debug, backend=options.backend, allowed_hosts=options.allowed_hosts,
+        outbound_max_messages=options.outbound_max_messages,
+        outbound_max_bytes=options.outbound_max_bytes,
+        outbound_policy=options.outbound_policy, batch_window=options.batch_window,
+        token_format=options.token_format, token_cache_size=options.token_cache_size,
+        resume_log_size=options.resume_log_size, compression_level=options.compression_level,
+        compression_mem_level=options.compression_mem_level,
+        compression_window_bits=options.compression_window_bits,
+        compression_min_size=options.compression_min_size, drain_window=options.drain_window,
+        drain_reconnect_jitter=options.drain_reconnect_jitter, secret=secret)
+    if options.blocking_threshold > 0:
+        watchdog = Watchdog(threshold=options.blocking_threshold / 1000, io_loop=ioloop)
+        watchdog.watch(application.backend)
+        watchdog.start()
     server = HTTPServer(application)
-    server.listen(options.port)
+    sockets = sockets or bind_sockets(options.port)
+    server.add_sockets(sockets)
     signal.signal(signal.SIGINT, lambda sig, frame: shutdown(server, application, graceful=True))
     signal.signal(signal.SIGTERM, lambda sig, frame: shutdown(server, application, graceful=True))
     signal.signal(signal.SIGALRM, lambda sig, frame: shutdown(server, application, graceful=True))
     signal.signal(signal.SIGQUIT, lambda sig, frame: shutdown(server, application, graceful=False))
+    if workers == 1:
+        if get_backend_class(options.backend).process_local:
+            # The new process would start without the rooms of this one
+            logging.info('Hot restart (SIGUSR2) is not supported by the %s backend.',
+                         options.backend)
+        else:
+            signal.signal(signal.SIGUSR2, lambda sig, frame: ioloop.add_callback_from_signal(
+                restart, server, application, sockets, ioloop=ioloop))
     logging.info('Starting server on localhost:%d', options.port)
+    notify_ready()
     if not ioloop._running:
         ioloop.start()
 
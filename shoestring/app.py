@@ -1,3 +1,4 @@
+import base64
 import os
 import time
 
@@ -6,35 +7,83 @@ from importlib import import_module
 from tornado.ioloop import IOLoop
 from tornado.web import Application
 
-from .handlers import CreateRoomHandler, GetRoomHandler, SocketHandler, IndexHandler
+from . import metrics
+from .deflate import get_deflate_options
+from .drain import DrainScheduler
+from .handlers import CreateRoomHandler, GetRoomHandler, SocketHandler, IndexHandler, MetricsHandler
+from .tokens import TOKEN_FORMATS, TokenCache
+
+
+SECRET_ENV_KEY = 'SHOESTRING_SECRET_KEY'
+
+
+def generate_secret():
+    """Random token signing key for servers started without SHOESTRING_SECRET_KEY."""
+    return base64.urlsafe_b64encode(os.urandom(48)).decode('ascii')
+
+
+def get_backend_class(backend_name):
+    """Import the Backend class from the given module path."""
+    backend_module = import_module(backend_name)
+    try:
+        return getattr(backend_module, 'Backend')
+    except AttributeError as e:
+        msg = 'Module "{}" does not define a Backend class.'.format(backend_name)
+        raise ImportError(msg) from e
 
 
 class ShoestringApplication(Application):
 
     def __init__(self, **kwargs):
         backend_name = kwargs.pop('backend', 'shoestring.backends.memory')
-        backend_module = import_module(backend_name)
-        try:
-            backend_class = getattr(backend_module, 'Backend')
-        except AttributeError as e:
-            msg = 'Module "{}" does not define a Backend class.'.format(backend_name)
-            raise ImportError(msg) from e
-        self.backend = backend_class()
+        backend_class = get_backend_class(backend_name)
+        resume_log_size = kwargs.get('resume_log_size', 0)
+        if resume_log_size and not backend_class.supports_resume:
+            raise ValueError('The {} backend does not support resuming sessions.'.format(backend_name))
+        self.backend = backend_class(resume_log_size=resume_log_size)
+        metrics.SUBSCRIBERS.set_function(self.backend.subscriber_count, backend=backend_name)
+        metrics.ROOMS.set_function(self.backend.room_count, backend=backend_name)
+        totals = SocketHandler.outbound_totals
+        metrics.OUTBOUND_QUEUED_MESSAGES.set_function(lambda: totals['messages'])
+        metrics.OUTBOUND_QUEUED_BYTES.set_function(lambda: totals['bytes'])
         routes = [
             (r'/rooms$', CreateRoomHandler, {'backend': self.backend}),
             (r'/rooms/(?P<room>[0-9]+)$', GetRoomHandler, {'backend': self.backend}),
             (r'/socket$', SocketHandler, {'backend': self.backend}),
+            (r'/metrics$', MetricsHandler),
             (r'/$', IndexHandler),
         ]
         settings = {
             'template_path': os.path.join(os.path.dirname(__file__), os.pardir, 'templates'),
             'static_path': os.path.join(os.path.dirname(__file__), os.pardir, 'static'),
             'static_url_prefix': '/static/',
-            'secret': os.environ.get('SHOESTRING_SECRET_KEY', str(os.urandom(75))),
+            'secret': os.environ.get(SECRET_ENV_KEY) or generate_secret(),
         }
         settings.update(kwargs)
+        if settings.get('outbound_policy', 'close') not in SocketHandler.OUTBOUND_POLICIES:
+            raise ValueError('Unknown outbound policy: {}'.format(settings['outbound_policy']))
+        if settings.get('token_format', 'jwt') not in TOKEN_FORMATS:
+            raise ValueError('Unknown token format: {}'.format(settings['token_format']))
+        compression = get_deflate_options(settings)
         super().__init__(routes, **settings)
+        self.compression = compression
+        self.tokens = TokenCache(settings['secret'], max_size=settings.get('token_cache_size', 10000))
+        self.drain = None
 
     def shutdown(self, graceful=True):
-        """Shutdown of the application server. Might be immediate or graceful."""
+        """Shutdown of the application server. Might be immediate or graceful.
+
+        With a ``drain_window`` setting (in seconds) a graceful shutdown
+        closes the sockets in batches over the window before shutting down
+        the backend.
+        """
+        window = self.settings.get('drain_window', 0)
+        if self.drain is not None:
+            self.drain.stop()
+        elif graceful and window > 0:
+            self.drain = DrainScheduler(
+                list(self.backend.get_subscribers()), window,
+                jitter=self.settings.get('drain_reconnect_jitter', 1000))
+            self.drain.start(callback=lambda: self.backend.shutdown(graceful=graceful))
+            return
         self.backend.shutdown(graceful=graceful)
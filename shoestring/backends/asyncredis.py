@@ -0,0 +1,218 @@
+import logging
+import time
+import uuid
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .. import metrics
+from .redis import (
+    Backend as RedisBackend, PublishBatcher, ShardedSubscriber,
+    CREATE_ROOM, JOIN_ROOM, ADD_SUBSCRIBER, REMOVE_SUBSCRIBER, PUBLISH, PUBLISH_LOGGED)
+
+try:
+    from tornadoredis import Client
+    from tornadoredis.exceptions import ConnectionError as TornadoRedisConnectionError
+except ImportError as e:  # pragma: no cover
+    msg = 'The asyncredis backend requires installing tornado-redis.'
+    raise ImportError(msg) from e
+
+
+class Backend(RedisBackend):
+    """Non-blocking Redis channel backend.
+
+    Room state is stored in the same keys as the blocking Redis backend
+    but every command goes through a tornado-redis client so a slow Redis
+    round trip never stalls the IOLoop. The room API methods are coroutines.
+    Since metrics are collected synchronously ``room_count`` returns the
+    count of the previous call and counts the rooms again in the background.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RedisBackend, self).__init__(*args, **kwargs)
+        self.node = uuid.uuid4().hex
+        info = self.parse_redis_parameters()
+        db_number = info.pop('db', 0)
+        info = {k: v for k, v in info.items() if v is not None}
+        self.publisher = Client(selected_db=db_number, **info)
+        # Connecting blocks the IOLoop, replies are read without blocking
+        self.publisher.connection.timeout = self.CONNECT_TIMEOUT
+        self.subscriber = ShardedSubscriber(
+            [Client(selected_db=db_number, **info) for _ in range(self.parse_shard_count())],
+            node=self.node, resubscribed=self._heartbeat)
+        self.batcher = PublishBatcher(
+            self._send_batch, *self.parse_publish_batch(), max_pending=self.parse_publish_buffer(),
+            errors=(TornadoRedisConnectionError, ))
+        self.rooms, self.invalidations = self._room_cache(db_number, info)
+        self._room_count = None
+        self._counting_rooms = None
+        self._removals = set()
+        self.heartbeats = PeriodicCallback(self._heartbeat, self._node_ttl() * 1000 / 3)
+        self.heartbeats.start()
+
+    @gen.coroutine
+    def _command(self, command, method, *args, **kwargs):
+        """Run a Redis command recording its latency."""
+        start = time.perf_counter()
+        try:
+            result = yield gen.Task(method, *args, **kwargs)
+        finally:
+            metrics.REDIS_COMMAND_SECONDS.observe(time.perf_counter() - start, command=command)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def create_room(self, owner):
+        created = False
+        while not created:
+            room = self._get_random_name()
+            # Create the room with an expiry if the name is not taken
+            created = yield self._command(
+                'create_room', self.publisher.eval, CREATE_ROOM,
+                keys=[self._room_key(room), self.ROOMS_KEY], args=self._create_room_args(owner))
+        raise gen.Return(room)
+
+    @gen.coroutine
+    def join_room(self, name, user):
+        key = self._room_key(name)
+        joined = yield self._command(
+            'join_room', self.publisher.eval, JOIN_ROOM,
+            keys=[key], args=[user, self.INVALIDATE_CHANNEL])
+        self._invalidate_room(key)
+        if joined:
+            raise gen.Return(name)
+        else:
+            raise KeyError('Unknown room.')
+
+    @gen.coroutine
+    def get_room(self, name):
+        key = self._room_key(name)
+        members = self._cached_room(key)
+        if members is not None:
+            raise gen.Return(members)
+        generation = self.rooms.generation if self.rooms is not None else None
+        result = yield self._command('hgetall', self.publisher.hgetall, key)
+        if not result:
+            raise KeyError('Unknown room.')
+        members = {}
+        for member, value in result.items():
+            members[member] = bool(value)
+        # Not cached if the room was invalidated while waiting for Redis
+        self._cache_room(key, members, generation)
+        raise gen.Return(members)
+
+    @gen.coroutine
+    def add_subscriber(self, channel, subscriber):
+        keys = self._subscriber_keys(channel)
+        # Subscribed locally first so removing another subscriber meanwhile
+        # doesn't take this node off the channel's nodes
+        self.subscriber.subscribe(channel, subscriber)
+        try:
+            if (channel, subscriber.uuid) in self._removals:
+                # The member's previous socket closed while Redis was unreachable
+                yield self._remove_member(channel, subscriber.uuid)
+            # Marks the member as subscribed, removes any expiry on the room
+            # and adds this node to the channel's nodes
+            result = yield self._command(
+                'add_subscriber', self.publisher.eval, ADD_SUBSCRIBER,
+                keys=keys,
+                args=[subscriber.uuid, self.node, self.INVALIDATE_CHANNEL, self._node_ttl()])
+        except Exception as e:
+            self.subscriber.unsubscribe(channel, subscriber)
+            if isinstance(e, TornadoRedisConnectionError):
+                # Redis may have marked the member subscribed before failing
+                self._removals.add((channel, subscriber.uuid))
+            raise
+        self._invalidate_room(keys[0])
+        if result < 0:
+            self.subscriber.unsubscribe(channel, subscriber)
+            raise ValueError('Already subscribed.')
+
+    @gen.coroutine
+    def remove_subscriber(self, channel, subscriber):
+        self.subscriber.unsubscribe(channel, subscriber)
+        yield self._remove_member(channel, subscriber.uuid)
+
+    @gen.coroutine
+    def _remove_member(self, channel, member):
+        keys = self._subscriber_keys(channel)
+        last = '0' if self._has_subscribers(channel) else '1'
+        # Set the room to expire when the last member unsubscribes
+        try:
+            yield self._command(
+                'remove_subscriber', self.publisher.eval, REMOVE_SUBSCRIBER,
+                keys=keys, args=self._remove_subscriber_args(member, last))
+        except TornadoRedisConnectionError as e:
+            logging.warning('Could not remove %s from channel %s in Redis: %s', member, channel, e)
+            self._removals.add((channel, member))
+            return
+        self._removals.discard((channel, member))
+        self._invalidate_room(keys[0])
+
+    def room_count(self):
+        if self._counting_rooms is None:
+            self._counting_rooms = self._command(
+                'zcount', self.publisher.zcount, *self._room_count_args())
+            IOLoop.current().add_future(self._counting_rooms, self._rooms_counted)
+        return self._room_count
+
+    def _rooms_counted(self, future):
+        self._counting_rooms = None
+        try:
+            self._room_count = future.result()
+        except TornadoRedisConnectionError:
+            self._room_count = None
+
+    @gen.coroutine
+    def get_log(self, channel, since):
+        entries = yield self._command(
+            'xrange', self.publisher.execute_command,
+            'XRANGE', self._log_key(channel), self._log_range_start(since), '+')
+        raise gen.Return(self._parse_log(entries or []))
+
+    @gen.coroutine
+    def _send_batch(self, batch):
+        """Publish (and log) a batch of messages in one pipelined round trip."""
+        pipe = self.publisher.pipeline()
+        for channel, message, sender in batch:
+            if self.resume_log_size:
+                keys, args = self._publish_logged_args(message, channel, sender)
+                pipe.eval(PUBLISH_LOGGED, keys=keys, args=args)
+            else:
+                keys, args = self._publish_args(channel, message, sender)
+                pipe.eval(PUBLISH, keys=keys, args=args)
+        replies = yield self._command('publish_batch', pipe.execute)
+        raise gen.Return(replies)
+
+    @gen.coroutine
+    def _heartbeat(self, channels=None):
+        pipe = self.publisher.pipeline()
+        self._register(pipe, self.subscriber.channels() if channels is None else channels)
+        try:
+            yield self._command('heartbeat', pipe.execute)
+        except TornadoRedisConnectionError as e:
+            logging.warning('Redis node heartbeat failed: %s', e)
+            return
+        for channel, member in list(self._removals):
+            yield self._remove_member(channel, member)
+
+    @gen.coroutine
+    def _shutdown(self, channels):
+        """Remove this node from Redis and disconnect."""
+        pipe = self.publisher.pipeline()
+        self._unregister(pipe, channels)
+        try:
+            yield gen.Task(pipe.execute)
+        except TornadoRedisConnectionError as e:
+            logging.warning('Could not remove the node from Redis: %s', e)
+        self.publisher.disconnect()
+
+    def shutdown(self, graceful=True):
+        channels = self.subscriber.channels()
+        super(RedisBackend, self).shutdown(graceful=graceful)
+        self.batcher.flush()
+        self.heartbeats.stop()
+        self.subscriber.close()
+        if self.invalidations is not None:
+            self.invalidations.close()
+        # Disconnects once the node is removed
+        IOLoop.current().add_future(self._shutdown(channels), lambda future: future.result())
@@ -2,13 +2,27 @@ import os
 import random
 
 
+_random = random.SystemRandom()
+
+
 class BaseBackend(object):
     """Base class for defining the backend API."""
 
+    # Process local backends cannot be shared by multiple server workers
+    process_local = True
+    # Backends which can keep a message log for resuming sessions
+    supports_resume = False
+    # Errors raised while the backend's server can't be reached
+    connection_errors = ()
+
+    def __init__(self, resume_log_size=0):
+        # Messages kept per channel for resuming sessions, 0 disables the log
+        self.resume_log_size = resume_log_size
+
     def _get_random_name(self, length=5):
         lower = 10 ** (length - 1)
         upper = 10 ** length - 1
-        return '{}'.format(random.SystemRandom().randint(lower, upper))
+        return '{}'.format(_random.randint(lower, upper))
 
     def create_room(self, owner):  # pragma: no cover
         raise NotImplementedError('Define in a subclass.')
@@ -31,6 +45,25 @@ class BaseBackend(object):
     def broadcast(self, message, channel, sender):  # pragma: no cover
         raise NotImplementedError('Define in a subclass.')
 
+    def subscriber_count(self):
+        """Number of subscribers on this process if the backend can list them."""
+        try:
+            return sum(1 for _ in self.get_subscribers())
+        except NotImplementedError:
+            return None
+
+    def room_count(self):
+        """Number of rooms if the backend can count them cheaply.
+
+        Backends which ask another process may return the count of the
+        previous call, or None until they know it.
+        """
+        return None
+
+    def get_log(self, channel, since):  # pragma: no cover
+        """Return (seq, sender, message) of the logged messages after seq since."""
+        raise NotImplementedError('Define in a subclass.')
+
     def shutdown(self, graceful=True):
         for subscriber in self.get_subscribers():
             code = 4200 if graceful else 4100
@@ -0,0 +1,394 @@
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import socket
+import tempfile
+
+from collections import namedtuple, OrderedDict
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+from tornado.websocket import WebSocketClosedError
+
+from .. import metrics
+from ..frames import prepare_message
+from .base import BaseBackend
+from .memory import Backend as MemoryBackend
+
+
+Member = namedtuple('Member', ['uuid', 'peer', 'channel', 'key'])
+
+
+class BrokerPeer(object):
+    """Server process connected to the broker."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.members = set()
+
+    def send(self, data):
+        if not self.stream.closed():
+            self.stream.write(json.dumps(data).encode('utf-8') + b'\n')
+
+
+class BrokerRooms(MemoryBackend):
+    """Memory backend noting when rooms are created, joined or expire."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = False
+
+    def create_room(self, user):
+        self.changed = True
+        return super().create_room(user)
+
+    def join_room(self, name, user):
+        room = super().join_room(name, user)
+        self.changed = True
+        return room
+
+    def _expire_room(self, name):
+        self.changed = True
+        super()._expire_room(name)
+
+    def stop(self):
+        """Stop expiring rooms."""
+        self._expiries.stop()
+
+
+class Broker(TCPServer):
+    """Shares room state and channel messages between local server processes.
+
+    Room state is kept in a memory backend where each subscriber is a
+    member socket of one of the connected processes. Rooms are written to
+    ``state_path`` at most once a snapshot interval while they change and
+    loaded by the next broker, so rooms survive the broker's process.
+    Subscriptions are not saved, the processes register them again when
+    they reconnect.
+    """
+
+    SNAPSHOT_INTERVAL = 1.0
+
+    def __init__(self, state_path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.rooms = BrokerRooms()
+        self.state_path = state_path
+        self.peers = set()
+        self._snapshots = None
+        if state_path is not None:
+            self._load()
+            self._snapshots = PeriodicCallback(self._save, self.SNAPSHOT_INTERVAL * 1000)
+            self._snapshots.start()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                self.rooms.load_rooms(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.exception('Could not load the IPC broker state from %s', self.state_path)
+
+    def _save(self):
+        if not self.rooms.changed:
+            return
+        self.rooms.changed = False
+        temp = self.state_path + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.rooms.dump_rooms(), f)
+            os.replace(temp, self.state_path)
+        except OSError:
+            self.rooms.changed = True
+            logging.exception('Could not save the IPC broker state to %s', self.state_path)
+
+    def stop(self):
+        """Stop listening and disconnect all processes."""
+        super().stop()
+        for peer in list(self.peers):
+            peer.stream.close()
+        self.rooms.stop()
+        if self._snapshots is not None:
+            self._snapshots.stop()
+            self._save()
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        peer = BrokerPeer(stream)
+        self.peers.add(peer)
+        while True:
+            try:
+                line = yield stream.read_until(b'\n')
+            except StreamClosedError:
+                break
+            try:
+                request = json.loads(line.decode('utf-8'))
+                self.handle_request(peer, request)
+            except (ValueError, KeyError):
+                logging.warning('Invalid broker request: {}'.format(line))
+        self.peers.discard(peer)
+        for member in peer.members:
+            self.rooms.remove_subscriber(member.channel, member)
+
+    def handle_request(self, peer, request):
+        op = request['op']
+        if op == 'publish':
+            self.publish(peer, request['channel'], request['message'], request['sender'])
+            return
+        response = {'id': request['id']}
+        try:
+            if op == 'create_room':
+                response['result'] = self.rooms.create_room(request['user'])
+            elif op == 'join_room':
+                response['result'] = self.rooms.join_room(request['name'], request['user'])
+            elif op == 'get_room':
+                response['result'] = self.rooms.get_room(request['name'])
+            elif op == 'room_count':
+                response['result'] = self.rooms.room_count()
+            elif op == 'add_subscriber':
+                member = Member(request['uuid'], peer, request['channel'], request['key'])
+                self.rooms.add_subscriber(member.channel, member)
+                peer.members.add(member)
+            elif op == 'remove_subscriber':
+                member = Member(request['uuid'], peer, request['channel'], request['key'])
+                self.rooms.remove_subscriber(member.channel, member)
+                peer.members.discard(member)
+            else:
+                raise ValueError('Unknown operation.')
+        except (KeyError, ValueError) as e:
+            response['error'] = e.__class__.__name__
+            response['reason'] = str(e.args[0]) if e.args else ''
+        peer.send(response)
+
+    def publish(self, origin, channel, message, sender):
+        """Forward a message to the other processes subscribed to the channel."""
+        peers = set(member.peer for member in self.rooms.get_subscribers(channel))
+        peers.discard(origin)
+        data = {'op': 'message', 'channel': channel, 'message': message, 'sender': sender}
+        for peer in peers:
+            peer.send(data)
+
+
+class Backend(BaseBackend):
+    """Shares channels between processes on one host over a Unix domain socket.
+
+    The first process to take the broker lock runs the broker in its
+    IOLoop, every process (including the broker's own) connects to it as a
+    client. Messages are delivered to local subscribers directly and only
+    forwarded by the broker to other processes with subscribers. When the
+    broker goes away the other processes reconnect right away, one of them
+    takes over as the broker, and all of them register their subscribers
+    with it again.
+
+    The broker's process counts the rooms directly. Since metrics are
+    collected synchronously the other processes return the count of the
+    previous call to ``room_count`` and ask the broker again meanwhile.
+    """
+
+    process_local = False
+    connection_errors = (StreamClosedError, )
+    ENV_KEY = 'SHOESTRING_IPC_PATH'
+    ERRORS = {'KeyError': KeyError, 'ValueError': ValueError}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        default = os.path.join(tempfile.gettempdir(), 'shoestring.sock')
+        self.path = os.environ.get(self.ENV_KEY, default)
+        self.broker = None
+        self._lock = None
+        self._stream = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._subscriptions = {}
+        self._closed = False
+        self._room_count = None
+        self._counting_rooms = None
+
+    def _start_broker(self):
+        """Try to become the broker for this socket path."""
+        lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            lock.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        # Removes the stale socket of a previous broker
+        sock = bind_unix_socket(self.path)
+        self._lock = lock
+        self.broker = Broker(state_path=self.path + '.state')
+        self.broker.add_socket(sock)
+        logging.info('Started IPC broker on %s', self.path)
+        return True
+
+    @gen.coroutine
+    def _connect(self):
+        loop = IOLoop.current()
+        while True:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                if not os.path.exists(self.path):
+                    raise StreamClosedError()
+                connected = stream.connect(self.path)
+                if connected is None:
+                    # Immediate connection errors close the stream without a future
+                    raise StreamClosedError()
+                yield connected
+            except StreamClosedError:
+                stream.close()
+                if not self._start_broker():
+                    # Another process is starting the broker
+                    yield gen.Task(loop.add_timeout, loop.time() + 0.1)
+            else:
+                self._read(stream)
+                self._resubscribe(stream)
+                raise gen.Return(stream)
+
+    def _get_stream(self):
+        if self._stream is None:
+            self._stream = self._connect()
+        return self._stream
+
+    def _resubscribe(self, stream):
+        """Register local subscribers after reconnecting to a new broker."""
+        for channel, subscribers in self._subscriptions.items():
+            for subscriber in subscribers:
+                self._send(stream, self._subscriber_request('add_subscriber', channel, subscriber))
+
+    @gen.coroutine
+    def _read(self, stream):
+        while True:
+            try:
+                line = yield stream.read_until(b'\n')
+            except StreamClosedError:
+                break
+            try:
+                data = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning('Invalid broker message: {}'.format(line))
+                continue
+            if data.get('op') == 'message':
+                self._deliver(data['channel'], data['message'], data['sender'])
+            elif data.get('id') in self._pending:
+                future = self._pending.pop(data['id'])
+                if 'error' in data:
+                    future.set_exception(self.ERRORS[data['error']](data['reason']))
+                else:
+                    future.set_result(data.get('result'))
+        logging.warning('Lost connection to the IPC broker.')
+        self._stream = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(StreamClosedError())
+        if not self._closed:
+            # Reconnect now so idle processes get their subscribers back
+            IOLoop.current().add_future(self._get_stream(), lambda future: future.result())
+
+    def _send(self, stream, data):
+        stream.write(json.dumps(data).encode('utf-8') + b'\n')
+
+    @gen.coroutine
+    def _request(self, op, **params):
+        stream = yield self._get_stream()
+        params['op'] = op
+        params['id'] = next(self._ids)
+        future = self._pending[params['id']] = Future()
+        self._send(stream, params)
+        result = yield future
+        raise gen.Return(result)
+
+    def _subscriber_request(self, op, channel, subscriber):
+        return {'op': op, 'id': next(self._ids), 'channel': channel,
+                'uuid': subscriber.uuid, 'key': id(subscriber)}
+
+    def _deliver(self, channel, message, sender):
+        message = prepare_message(message)
+        peers = list(self.get_subscribers(channel))
+        delivered = 0
+        for peer in peers:
+            if peer.uuid != sender:
+                try:
+                    peer.write_message(message)
+                except WebSocketClosedError:
+                    # Remove dead peer
+                    self.remove_subscriber(channel, peer)
+                else:
+                    delivered += 1
+        metrics.MESSAGES_DELIVERED.inc(delivered)
+
+    @gen.coroutine
+    def create_room(self, user):
+        room = yield self._request('create_room', user=user)
+        raise gen.Return(room)
+
+    @gen.coroutine
+    def join_room(self, name, user):
+        room = yield self._request('join_room', name=name, user=user)
+        raise gen.Return(room)
+
+    @gen.coroutine
+    def get_room(self, name):
+        members = yield self._request('get_room', name=name)
+        raise gen.Return(members)
+
+    @gen.coroutine
+    def add_subscriber(self, channel, subscriber):
+        yield self._request(
+            'add_subscriber', channel=channel, uuid=subscriber.uuid, key=id(subscriber))
+        self._subscriptions.setdefault(channel, OrderedDict())[subscriber] = None
+
+    @gen.coroutine
+    def remove_subscriber(self, channel, subscriber):
+        subscribers = self._subscriptions.get(channel, {})
+        if subscriber in subscribers:
+            del subscribers[subscriber]
+            if not subscribers:
+                del self._subscriptions[channel]
+            yield self._request(
+                'remove_subscriber', channel=channel, uuid=subscriber.uuid, key=id(subscriber))
+
+    def get_subscribers(self, channel=None):
+        if channel is not None:
+            yield from self._subscriptions.get(channel, {})
+        else:
+            for subscribers in self._subscriptions.values():
+                yield from subscribers
+
+    def room_count(self):
+        if self.broker is not None:
+            return self.broker.rooms.room_count()
+        if self._counting_rooms is None and not self._closed:
+            self._counting_rooms = self._request('room_count')
+            IOLoop.current().add_future(self._counting_rooms, self._rooms_counted)
+        return self._room_count
+
+    def _rooms_counted(self, future):
+        self._counting_rooms = None
+        try:
+            self._room_count = future.result()
+        except StreamClosedError:
+            self._room_count = None
+
+    @gen.coroutine
+    def broadcast(self, message, channel, sender):
+        self._deliver(channel, message, sender)
+        stream = yield self._get_stream()
+        self._send(stream, {
+            'op': 'publish', 'channel': channel, 'message': message, 'sender': sender})
+
+    def shutdown(self, graceful=True):
+        super().shutdown(graceful=graceful)
+        self._closed = True
+        if self.broker is not None:
+            self.broker.stop()
+            os.remove(self.path)
+            self._lock.close()
+            self.broker, self._lock = None, None
@@ -1,25 +1,64 @@
-from collections import defaultdict
+import itertools
+
+from collections import deque, OrderedDict
+from datetime import timedelta
 
 from tornado.websocket import WebSocketClosedError
 
+from .. import metrics
+from ..frames import prepare_message, sequence_message
+from ..timers import TimingWheel
 from .base import BaseBackend
+from .names import NameAllocator
 
 
 class Backend(BaseBackend):
-    """In memory channel backend."""
+    """In memory channel backend.
+
+    With a resume log each channel keeps a ring buffer of its last messages,
+    dropped ``LOG_TTL`` after the channel was last used without subscribers.
+    Sequence numbers are shared by all channels so they never repeat, even
+    once a channel's log has been dropped.
+    """
+
+    supports_resume = True
+
+    # Digits of new room names and the share of names in use before
+    # new names get another digit.
+    ROOM_NAME_LENGTH = 5
+    ROOM_NAME_WIDEN_AT = 0.9
+    # Rooms without subscribers are removed after this long, like the
+    # expiry of Redis room keys.
+    ROOM_TTL = timedelta(hours=1)
+    # Logs of channels without subscribers are dropped after this long,
+    # like the expiry of Redis channel logs.
+    LOG_TTL = timedelta(hours=1)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._rooms = defaultdict(dict)
-        self._subscriptions = defaultdict(list)
+        self._names = NameAllocator(self.ROOM_NAME_LENGTH, self.ROOM_NAME_WIDEN_AT)
+        self._expiries = TimingWheel(self._expire_room)
+        self._log_expiries = TimingWheel(self._expire_log)
+        # Room name -> {member uuid: subscribed}
+        self._rooms = {}
+        # Channel -> insertion ordered set of subscribers. Channels are
+        # only present while they have at least one subscriber.
+        self._subscriptions = {}
+        # Channel -> ring buffer of (seq, sender, message)
+        self._logs = {}
+        self._seq = itertools.count(1)
 
     def create_room(self, user):
-        room = self._get_random_name()
-        while room in self._rooms:
-            room = self._get_random_name()
-        self._rooms[room][user] = False
+        room = self._names.allocate()
+        self._rooms[room] = {user: False}
+        self._expiries.schedule(room, self.ROOM_TTL.total_seconds())
         return room
 
+    def _expire_room(self, name):
+        if name in self._rooms and name not in self._subscriptions:
+            del self._rooms[name]
+            self._names.release(name)
+
     def join_room(self, name, user):
         if name in self._rooms:
             self._rooms[name][user] = False
@@ -32,33 +71,80 @@ class Backend(BaseBackend):
             return self._rooms[name]
         else:
             raise KeyError('Unknown room.')
-        
-    def add_subscriber(self, channel, subscriber):
-        if self._rooms.get(channel, {}).get(subscriber.uuid, False):
-            raise ValueError('Already subscribed.')
-        else:
-            self._rooms.get(channel, {})[subscriber.uuid] = True
-        self._subscriptions[channel].append(subscriber)
 
+    def add_subscriber(self, channel, subscriber):
+        members = self._rooms.get(channel)
+        if members is not None:
+            if members.get(subscriber.uuid, False):
+                raise ValueError('Already subscribed.')
+            members[subscriber.uuid] = True
+            self._expiries.cancel(channel)
+        self._log_expiries.cancel(channel)
+        self._subscriptions.setdefault(channel, OrderedDict())[subscriber] = None
 
     def remove_subscriber(self, channel, subscriber):
-        try:
-            self._subscriptions[channel].remove(subscriber)
-        except ValueError:
-            pass
-        else:
-            self._rooms.get(channel, {})[subscriber.uuid] = False
+        subscribers = self._subscriptions.get(channel)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        del subscribers[subscriber]
+        if not subscribers:
+            del self._subscriptions[channel]
+            if channel in self._logs:
+                self._log_expiries.schedule(channel, self.LOG_TTL.total_seconds())
+        members = self._rooms.get(channel)
+        if members is not None:
+            members[subscriber.uuid] = False
+            if not subscribers:
+                self._expiries.schedule(channel, self.ROOM_TTL.total_seconds())
+
+    def dump_rooms(self):
+        """Return the rooms and their members as JSON serializable data."""
+        rooms = {name: list(members) for name, members in self._rooms.items()}
+        return {'rooms': rooms, 'names': self._names.dump()}
+
+    def load_rooms(self, state):
+        """Restore rooms from ``dump_rooms``, all members unsubscribed."""
+        self._names.load(state['names'])
+        for name, members in state['rooms'].items():
+            self._rooms[name] = dict.fromkeys(members, False)
+            self._expiries.schedule(name, self.ROOM_TTL.total_seconds())
 
     def get_subscribers(self, channel=None):
         if channel is not None:
-            yield from self._subscriptions[channel]
+            yield from self._subscriptions.get(channel, ())
         else:
-            for participants in self._subscriptions.values():
-                for p in participants:
-                    yield p
+            for subscribers in self._subscriptions.values():
+                yield from subscribers
+
+    def room_count(self):
+        return len(self._rooms)
+
+    def get_log(self, channel, since):
+        since = int(since)
+        return [entry for entry in self._logs.get(channel, ()) if entry[0] > since]
+
+    def _log_message(self, channel, message, sender):
+        """Add the message to the channel's log and wrap it with its seq."""
+        log = self._logs.get(channel)
+        if log is None:
+            log = self._logs[channel] = deque(maxlen=self.resume_log_size)
+        seq = next(self._seq)
+        log.append((seq, sender, message))
+        if channel not in self._subscriptions:
+            self._log_expiries.schedule(channel, self.LOG_TTL.total_seconds())
+        return sequence_message(seq, message)
+
+    def _expire_log(self, channel):
+        if channel not in self._subscriptions:
+            self._logs.pop(channel, None)
 
     def broadcast(self, message, channel, sender):
-        peers = self.get_subscribers(channel)
+        if self.resume_log_size:
+            message = self._log_message(channel, message, sender)
+        message = prepare_message(message)
+        # Copy the peers since dead peers are removed while sending
+        peers = list(self.get_subscribers(channel))
+        delivered = 0
         for peer in peers:
             if peer.uuid != sender:
                 try:
@@ -66,3 +152,11 @@ class Backend(BaseBackend):
                 except WebSocketClosedError:
                     # Remove dead peer
                     self.remove_subscriber(channel, peer)
+                else:
+                    delivered += 1
+        metrics.MESSAGES_DELIVERED.inc(delivered)
+
+    def shutdown(self, graceful=True):
+        super().shutdown(graceful=graceful)
+        self._expiries.stop()
+        self._log_expiries.stop()
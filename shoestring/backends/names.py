@@ -0,0 +1,72 @@
+import random
+
+
+class NameAllocator(object):
+    """Hands out unused random numeric room names in constant time.
+
+    Names of each length are drawn from a lazily shuffled pool (a sparse
+    Fisher-Yates shuffle) so allocating and releasing a name never retries.
+    Once more than ``widen_at`` of the current length's names are in use new
+    names get one more digit, names of different lengths never collide.
+    """
+
+    def __init__(self, length=5, widen_at=0.9):
+        if length < 1:
+            raise ValueError('Room names need at least one digit.')
+        self.length = length
+        self.widen_at = widen_at
+        self._random = random.SystemRandom()
+        # Length -> [names left in the pool, {pool position: value}]
+        self._pools = {}
+
+    def _pool(self, length):
+        pool = self._pools.get(length)
+        if pool is None:
+            pool = self._pools[length] = [self._size(length), {}]
+        return pool
+
+    def _size(self, length):
+        return 9 * 10 ** (length - 1)
+
+    def in_use(self, length=None):
+        """Number of allocated names of the given (default current) length."""
+        length = length or self.length
+        return self._size(length) - self._pool(length)[0]
+
+    def allocate(self):
+        """Return a random name which is not in use."""
+        size = self._size(self.length)
+        remaining, swaps = self._pool(self.length)
+        while remaining == 0 or (size - remaining) >= self.widen_at * size:
+            self.length += 1
+            size = self._size(self.length)
+            remaining, swaps = self._pool(self.length)
+        index = self._random.randrange(remaining)
+        last = remaining - 1
+        value = swaps.pop(index, index)
+        if index != last:
+            # Move the last name of the pool into the free slot
+            swaps[index] = swaps.pop(last, last)
+        self._pools[self.length][0] = last
+        return str(10 ** (self.length - 1) + value)
+
+    def release(self, name):
+        """Return a name to its pool so it can be allocated again."""
+        length = len(name)
+        value = int(name) - 10 ** (length - 1)
+        remaining, swaps = self._pool(length)
+        if value != remaining:
+            swaps[remaining] = value
+        self._pools[length][0] = remaining + 1
+
+    def dump(self):
+        """Return the allocator state as JSON serializable data."""
+        pools = {str(length): [remaining, {str(k): v for k, v in swaps.items()}]
+                 for length, (remaining, swaps) in self._pools.items()}
+        return {'length': self.length, 'pools': pools}
+
+    def load(self, state):
+        """Replace the allocator state with data from ``dump``."""
+        self.length = state['length']
+        self._pools = {int(length): [remaining, {int(k): v for k, v in swaps.items()}]
+                       for length, (remaining, swaps) in state['pools'].items()}
@@ -2,24 +2,338 @@ import datetime
 import json
 import logging
 import os
-import signal
+import random
+import re
+import socket
+import time
+import uuid
+import zlib
 
+from collections import Counter, OrderedDict, defaultdict
+from functools import partial
 from urllib.parse import urlparse
 
+from tornado import gen
+from tornado.concurrent import Future, is_future
+from tornado.escape import to_unicode, utf8
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.stack_context import ExceptionStackContext, NullContext
 from tornado.websocket import WebSocketClosedError
 
+from .. import metrics
+from ..frames import prepare_message, sequence_message
 from .base import BaseBackend
 
 try:
     from redis import Redis
+    from redis.exceptions import (
+        ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError)
     from tornadoredis import Client
+    from tornadoredis.exceptions import ConnectionError as TornadoRedisConnectionError
     from tornadoredis.pubsub import BaseSubscriber
 except ImportError as e:  # pragma: no cover
     msg = 'The redis backend requires installing redis-py and tornado-redis.'
     raise ImportError(msg) from e
 
 
+# Room membership scripts. KEYS[1] is the room hash and KEYS[2] holds the
+# number of subscribed members so each operation is a single atomic call.
+# Scripts changing the members of a room publish its key on the channel
+# given as their last ARGV, which invalidates it in the nodes' room caches.
+
+# Rooms are also indexed in a sorted set scored by the time (in ARGV[3])
+# their key expires, +inf while subscribed, so they can be counted without
+# scanning the keys. Creating a room drops the expired ones from the index.
+# KEYS[2] is the index.
+CREATE_ROOM = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], '')
+redis.call('expire', KEYS[1], ARGV[2])
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[3])
+redis.call('zadd', KEYS[2], ARGV[3] + ARGV[2], KEYS[1])
+return 1
+"""
+
+JOIN_ROOM = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('hsetnx', KEYS[1], ARGV[1], '') == 1 then
+    redis.call('publish', ARGV[2], KEYS[1])
+end
+return 1
+"""
+
+# KEYS[3] is the set of nodes with subscribers on the channel, KEYS[4] the
+# node's key, KEYS[5] the room index and ARGV[2] the node. Adding refreshes
+# the node's entries with the node TTL in ARGV[4], see the node heartbeat.
+# On removal ARGV[3] is '1' when the node has no subscribers left on the
+# channel, ARGV[4] is the room TTL and ARGV[5] the current time.
+
+ADD_SUBSCRIBER = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('sadd', KEYS[3], ARGV[2])
+    redis.call('expire', KEYS[3], ARGV[4])
+    redis.call('set', KEYS[4], '', 'EX', ARGV[4])
+    return 0
+end
+if redis.call('hget', KEYS[1], ARGV[1]) == 'subscribed' then
+    return -1
+end
+redis.call('hset', KEYS[1], ARGV[1], 'subscribed')
+redis.call('incr', KEYS[2])
+redis.call('persist', KEYS[1])
+redis.call('persist', KEYS[2])
+redis.call('zadd', KEYS[5], '+inf', KEYS[1])
+redis.call('sadd', KEYS[3], ARGV[2])
+redis.call('expire', KEYS[3], ARGV[4])
+redis.call('set', KEYS[4], '', 'EX', ARGV[4])
+redis.call('publish', ARGV[3], KEYS[1])
+return 1
+"""
+
+REMOVE_SUBSCRIBER = """
+if ARGV[3] == '1' then
+    redis.call('srem', KEYS[3], ARGV[2])
+end
+if redis.call('hget', KEYS[1], ARGV[1]) ~= 'subscribed' then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], '')
+if redis.call('decr', KEYS[2]) <= 0 then
+    redis.call('del', KEYS[2])
+    redis.call('expire', KEYS[1], ARGV[4])
+    redis.call('zadd', KEYS[5], ARGV[5] + ARGV[4], KEYS[1])
+end
+redis.call('publish', ARGV[6], KEYS[1])
+return 1
+"""
+
+# Whether a node other than the given one in the node set is alive, that
+# is its key (prefix followed by the node) has not expired. Dead nodes
+# found on the way are removed from the set.
+LIVE_NODES = """
+local function other_node_alive(nodes, node, prefix)
+    for _, other in ipairs(redis.call('smembers', nodes)) do
+        if other ~= node then
+            if redis.call('exists', prefix .. other) == 1 then
+                return true
+            end
+            redis.call('srem', nodes, other)
+        end
+    end
+    return false
+end
+"""
+
+# Publish only when another live node has subscribers on the channel.
+# KEYS[1] is the channel's node set, ARGV[1] the publishing node and
+# ARGV[4] the node key prefix.
+PUBLISH = LIVE_NODES + """
+if other_node_alive(KEYS[1], ARGV[1], ARGV[4]) then
+    return redis.call('publish', ARGV[2], ARGV[3])
+end
+return 0
+"""
+
+# Log the message to the channel's stream, trimmed to about ARGV[5] entries
+# and expiring after ARGV[6] seconds, and publish it with the stream id as
+# its seq when another live node has subscribers. KEYS[1] is the channel's
+# node set, KEYS[2] the stream and ARGV[7] the node key prefix. Returns the
+# seq.
+PUBLISH_LOGGED = LIVE_NODES + """
+redis.replicate_commands()
+local seq = redis.call('xadd', KEYS[2], 'MAXLEN', '~', ARGV[5], '*',
+                       'sender', ARGV[3], 'message', ARGV[4])
+redis.call('expire', KEYS[2], ARGV[6])
+if other_node_alive(KEYS[1], ARGV[1], ARGV[7]) then
+    redis.call('publish', ARGV[2], cjson.encode(
+        {sender=ARGV[3], node=ARGV[1], message=ARGV[4], seq=seq}))
+end
+return seq
+"""
+
+SEQ_PATTERN = re.compile(r'^(\d+)-(\d+)$')
+
+
+class Backoff(object):
+    """Exponentially growing reconnect delays.
+
+    Each delay is picked at random from the upper half of the current step
+    so nodes which lost Redis together don't reconnect in lockstep.
+    """
+
+    def __init__(self, initial=0.1, maximum=30):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def delay(self):
+        step = min(self.maximum, self.initial * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(step / 2, step)
+
+    def reset(self):
+        self.attempts = 0
+
+
 class RedisSubscriber(BaseSubscriber):
+    """Pub/sub connection which survives Redis restarts and failovers.
+
+    When the connection drops the local sockets stay open. Subscriptions
+    made meanwhile are only recorded, and once Redis accepts connections
+    again every channel with subscribers is subscribed again. Redis may
+    have lost its keys meanwhile, so ``resubscribed`` is then called with
+    the channels to register the node on them again.
+
+    The client connects with a blocking socket, so each reconnect attempt
+    first probes Redis with a non-blocking connection and the client only
+    connects once Redis accepts connections. The client's connect is still
+    limited to ``CONNECT_TIMEOUT`` seconds.
+    """
+
+    CONNECT_TIMEOUT = 0.5
+
+    def __init__(self, tornado_redis_client, node=None, resubscribed=None):
+        super().__init__(tornado_redis_client)
+        # Don't let an unresponsive host stall the IOLoop
+        self.redis.connection.timeout = self.CONNECT_TIMEOUT
+        self.node = node
+        self.resubscribed = resubscribed
+        self.io_loop = IOLoop.current()
+        self.backoff = Backoff()
+        # Time the connection was lost, None while connected
+        self.outage = None
+        self._reconnected = None
+        self._reconnect_timeout = None
+        self._closed = False
+
+    def subscribe(self, channel_name, subscriber, callback=None):
+        if self.outage is None:
+            super().subscribe(channel_name, subscriber, callback=callback)
+            return
+        # Subscribed on Redis once the connection is back
+        self.subscribers[channel_name][subscriber] += 1
+        self.subscriber_count[channel_name] += 1
+        if callback is not None:
+            callback(True)
+
+    def unsubscribe(self, channel_name, subscriber):
+        if self.outage is None:
+            super().unsubscribe(channel_name, subscriber)
+            return
+        self.subscribers[channel_name][subscriber] -= 1
+        if self.subscribers[channel_name][subscriber] <= 0:
+            del self.subscribers[channel_name][subscriber]
+        self.subscriber_count[channel_name] -= 1
+        if self.subscriber_count[channel_name] <= 0:
+            del self.subscriber_count[channel_name]
+
+    def close(self):
+        self._closed = True
+        if self._reconnect_timeout is not None:
+            self.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        if self.outage is None:
+            super().close()
+        else:
+            self.subscribers = defaultdict(Counter)
+            self.subscriber_count = Counter()
+
+    def _channels(self):
+        return {channel for channel, count in self.subscriber_count.items() if count > 0}
+
+    def channels(self):
+        """Channels with local subscribers."""
+        return self._channels()
+
+    def _disconnected(self):
+        logging.warning('Dropped Redis connection, reconnecting.')
+        metrics.REDIS_DISCONNECTS.inc(connection='pubsub')
+        self.outage = self.io_loop.time()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        self._reconnect_timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.backoff.delay(), self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_timeout = None
+        self.io_loop.add_future(self._probe(), self._probed)
+
+    @gen.coroutine
+    def _probe(self):
+        """Whether Redis accepts connections, found out without blocking."""
+        connection = self.redis.connection
+        if connection.unix_socket_path:
+            family, address = socket.AF_UNIX, connection.unix_socket_path
+        else:
+            family, address = socket.AF_INET, (connection.host, connection.port)
+        stream = IOStream(socket.socket(family, socket.SOCK_STREAM), io_loop=self.io_loop)
+        try:
+            connected = stream.connect(address)
+            if connected is None:
+                # Immediate connection errors close the stream without a future
+                raise gen.Return(False)
+            yield gen.with_timeout(
+                datetime.timedelta(seconds=self.CONNECT_TIMEOUT), connected, io_loop=self.io_loop)
+        except (StreamClosedError, socket.error, gen.TimeoutError):
+            raise gen.Return(False)
+        finally:
+            stream.close()
+        raise gen.Return(True)
+
+    def _probed(self, future):
+        if self._closed:
+            return
+        if not future.result():
+            logging.debug('Redis is not accepting connections yet.')
+            self._schedule_reconnect()
+            return
+        try:
+            self.redis.connection.connect()
+        except TornadoRedisConnectionError as e:
+            logging.debug('Redis reconnect failed: %s', e)
+            self._schedule_reconnect()
+            return
+        self._reconnected = self.io_loop.time()
+        metrics.REDIS_OUTAGE_SECONDS.observe(self._reconnected - self.outage, connection='pubsub')
+        channels = self._channels()
+        if not channels:
+            self._resubscribed(channels)
+            return
+        with ExceptionStackContext(self._resubscribe_failed):
+            self.redis.subscribe(
+                list(channels), callback=lambda result: self._resubscribed(channels))
+
+    def _resubscribe_failed(self, typ, value, tb):
+        logging.warning('Redis resubscribe failed: %s', value)
+        self.redis.connection.disconnect()
+        self._schedule_reconnect()
+        return True
+
+    def _resubscribed(self, channels):
+        now = self.io_loop.time()
+        logging.info('Redis connection restored after %.1fs, resubscribed %d channels.',
+                     now - self.outage, len(channels))
+        metrics.REDIS_RECOVERY_SECONDS.observe(now - self._reconnected, connection='pubsub')
+        self.outage = None
+        self.backoff.reset()
+        if not channels:
+            return
+        if self.resubscribed is not None:
+            self.resubscribed(channels)
+        with NullContext():
+            self.redis.listen(self.on_message)
+            # Catch up with sockets which came and went while resubscribing
+            current = self._channels()
+            if current - channels:
+                self.redis.subscribe(list(current - channels))
+            if channels - current:
+                self.redis.unsubscribe(list(channels - current))
 
     def on_message(self, msg):
         """Handle new message on the Redis channel."""
@@ -30,11 +344,19 @@ class RedisSubscriber(BaseSubscriber):
             try:
                 message = json.loads(msg.body)
                 sender = message['sender']
-                message = message['message']
+                node = message.get('node')
+                if 'seq' in message:
+                    message = sequence_message(message['seq'], message['message'])
+                else:
+                    message = prepare_message(message['message'])
             except (ValueError, KeyError):
                 logging.warning('Invalid channel mesage: {}'.format(msg.body))
             else:
+                if node is not None and node == self.node:
+                    # Already delivered by the publishing backend
+                    return
                 subscribers = list(self.subscribers[msg.channel].keys())
+                delivered = 0
                 for subscriber in subscribers:
                     if sender != subscriber.uuid:
                         try:
@@ -42,25 +364,395 @@ class RedisSubscriber(BaseSubscriber):
                         except WebSocketClosedError:
                             # Remove dead peer
                             self.unsubscribe(msg.channel, subscriber)
-        elif msg.kind == 'disconnect':
+                        else:
+                            delivered += 1
+                metrics.MESSAGES_DELIVERED.inc(delivered)
+        elif msg.kind == 'disconnect' and not self._closed:
             # Disconnected from the Redis server
-            # Trigger a graceful shutdown
-            logging.warn('Dropped Redis connection.')
-            signal.alarm(1)
+            self._disconnected()
+
+
+class ShardedSubscriber(object):
+    """Spreads channel subscriptions over several pub/sub connections.
+
+    Each channel is assigned to one shard by the CRC32 of its name so a
+    single connection and its parser are no longer the limit on incoming
+    messages, and losing a connection only affects its share of channels.
+    Every shard keeps its own subscribe/unsubscribe bookkeeping.
+    """
+
+    def __init__(self, clients, node=None, resubscribed=None):
+        self.shards = [RedisSubscriber(client, node=node, resubscribed=resubscribed)
+                       for client in clients]
+
+    def shard(self, channel):
+        """Subscriber connection handling the channel."""
+        return self.shards[zlib.crc32(utf8(channel)) % len(self.shards)]
+
+    def subscribe(self, channel, subscriber, callback=None):
+        self.shard(channel).subscribe(channel, subscriber, callback=callback)
+
+    def unsubscribe(self, channel, subscriber):
+        self.shard(channel).unsubscribe(channel, subscriber)
+
+    def channels(self):
+        """Channels with local subscribers on any shard."""
+        return set().union(*(shard.channels() for shard in self.shards))
+
+    def get_subscribers(self, channel=None):
+        if channel is not None:
+            # Avoid adding empty entries to the shard's subscribers
+            subscribers = self.shard(channel).subscribers
+            yield from (subscribers[channel].keys() if channel in subscribers else ())
+        else:
+            for shard in self.shards:
+                for subscribers in shard.subscribers.values():
+                    yield from subscribers
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class PublishBatcher(object):
+    """Collects outgoing publishes and sends them to Redis in batches.
+
+    Messages added during one IOLoop iteration, or within ``max_delay``
+    seconds of the first one, are passed to ``send`` as one list of
+    (channel, message, sender) so they go out in a single pipelined round
+    trip. A batch is sent right away once it holds ``max_size`` messages.
+    When ``send`` returns a future only one batch is in flight at a time,
+    so messages always reach Redis in the order they were added. ``send``
+    returns (or resolves to) the replies for the batch, and the ``result``
+    future of a message, if it was added with one, is set to its reply.
+
+    When sending fails with one of the given connection ``errors`` the
+    batch is put back and sending is retried with backoff. Meanwhile at
+    most ``max_pending`` messages are kept, the oldest are dropped first
+    and their result set to None. A batch which failed part way may be
+    published twice.
+    """
+
+    def __init__(self, send, max_size=100, max_delay=0, max_pending=10000, errors=(),
+                 io_loop=None):
+        self.send = send
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.errors = errors
+        self.io_loop = io_loop or IOLoop.current()
+        self.backoff = Backoff()
+        self.pending = []
+        # Result futures (or None) of the pending messages
+        self._results = []
+        # Time sending started to fail, None while Redis is reachable
+        self.outage = None
+        self._reconnected = None
+        self._scheduled = None
+        self._sending = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, channel, message, sender, result=None):
+        self.pending.append((channel, message, sender))
+        self._results.append(result)
+        if self.outage is not None:
+            # Sent by the next retry
+            self._trim()
+        elif len(self.pending) >= self.max_size:
+            self.flush()
+        elif self._scheduled is None:
+            self._schedule()
+
+    def _trim(self):
+        dropped = len(self.pending) - self.max_pending
+        if dropped > 0:
+            del self.pending[:dropped]
+            self._resolve(self._results[:dropped], None)
+            del self._results[:dropped]
+            metrics.REDIS_PUBLISH_DROPPED.inc(dropped)
+
+    def _resolve(self, results, replies):
+        if replies is None:
+            replies = [None] * len(results)
+        for result, reply in zip(results, replies):
+            if result is not None:
+                result.set_result(reply)
+
+    def _schedule(self):
+        if self.max_delay:
+            self._scheduled = self.io_loop.add_timeout(
+                self.io_loop.time() + self.max_delay, self.flush)
+        else:
+            # Runs once the callbacks and events of this iteration are handled
+            self._scheduled = True
+            self.io_loop.add_callback(self.flush)
+
+    def flush(self):
+        """Send the next batch of pending messages unless one is in flight."""
+        if self._scheduled not in (None, True):
+            self.io_loop.remove_timeout(self._scheduled)
+        self._scheduled = None
+        if self._sending or not self.pending:
+            return
+        batch, self.pending = self.pending[:self.max_size], self.pending[self.max_size:]
+        results, self._results = self._results[:self.max_size], self._results[self.max_size:]
+        metrics.REDIS_PUBLISH_BATCH_SIZE.observe(len(batch))
+        try:
+            replies = self.send(batch)
+        except self.errors as e:
+            self._failed(batch, results, e)
+            return
+        except Exception:
+            # The batch is lost
+            self._resolve(results, None)
+            raise
+        if is_future(replies):
+            self._sending = True
+            self.io_loop.add_future(replies, partial(self._sent, batch, results))
+        else:
+            self._succeeded()
+            self._resolve(results, replies)
+            if self.pending:
+                self._schedule()
+
+    def _sent(self, batch, results, future):
+        self._sending = False
+        try:
+            replies = future.result()
+        except self.errors as e:
+            self._failed(batch, results, e)
+        except Exception:
+            self._resolve(results, None)
+            raise
+        else:
+            self._succeeded()
+            self._resolve(results, replies)
+        finally:
+            if self.outage is None:
+                # Messages added meanwhile have already waited a round trip
+                self.flush()
+
+    def _failed(self, batch, results, error):
+        # Put the batch back in front to keep the order
+        self.pending[:0] = batch
+        self._results[:0] = results
+        self._trim()
+        if self.outage is None:
+            logging.warning('Dropped Redis publisher connection: %s', error)
+            metrics.REDIS_DISCONNECTS.inc(connection='publish')
+            self.outage = self.io_loop.time()
+        self._scheduled = self.io_loop.add_timeout(
+            self.io_loop.time() + self.backoff.delay(), self.flush)
+
+    def _succeeded(self):
+        now = self.io_loop.time()
+        if self.outage is not None:
+            logging.info('Redis publisher connection restored after %.1fs, %d messages buffered.',
+                         now - self.outage, len(self.pending))
+            metrics.REDIS_OUTAGE_SECONDS.observe(now - self.outage, connection='publish')
+            self.outage = None
+            self._reconnected = now
+            self.backoff.reset()
+        if self._reconnected is not None and not self.pending:
+            # Everything buffered during the outage is sent
+            metrics.REDIS_RECOVERY_SECONDS.observe(now - self._reconnected, connection='publish')
+            self._reconnected = None
+
+
+class RoomCache(object):
+    """Bounded cache of room members keyed by the room's Redis key.
+
+    Entries are dropped when any node publishes a change to the room on the
+    invalidation channel and at the latest ``ttl`` seconds after they were
+    read. The least recently used entry is evicted when the cache is full.
+    Cached member dicts are shared and must not be modified.
+    """
+
+    def __init__(self, ttl=5, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation so reads racing one are not cached
+        self.generation = 0
+        # Key -> (expiry, members) in least recently used order
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached members of the room or None."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expiry, members = entry
+            if time.monotonic() <= expiry:
+                self.hits += 1
+                metrics.ROOM_CACHE_LOOKUPS.inc(result='hit')
+                self._entries.move_to_end(key)
+                return members
+            del self._entries[key]
+        self.misses += 1
+        metrics.ROOM_CACHE_LOOKUPS.inc(result='miss')
+        return None
+
+    def add(self, key, members, generation):
+        """Cache members read while the cache was at the given generation."""
+        if generation != self.generation or self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, members)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    @property
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class InvalidationSubscriber(RedisSubscriber):
+    """Pub/sub connection dropping changed rooms from the room cache.
+
+    Invalidations published while the connection is down are lost, so the
+    whole cache is cleared when it drops and again once it is back.
+    """
+
+    def __init__(self, tornado_redis_client, cache, channel):
+        super().__init__(tornado_redis_client)
+        self.cache = cache
+        try:
+            self.subscribe(channel, cache)
+        except TornadoRedisConnectionError:
+            # Subscribed once Redis can be reached
+            self._disconnected()
+
+    def on_message(self, msg):
+        if msg and msg.kind == 'message':
+            key = msg.body.decode('utf-8') if isinstance(msg.body, bytes) else msg.body
+            self.cache.invalidate(key)
+        else:
+            super().on_message(msg)
+
+    def _disconnected(self):
+        self.cache.clear()
+        super()._disconnected()
+
+    def _resubscribed(self, channels):
+        self.cache.clear()
+        super()._resubscribed(channels)
 
 
 class Backend(BaseBackend):
-    """Redis channel backend."""
+    """Redis channel backend.
+
+    Each backend is a node with its own id. Messages are delivered to the
+    node's own subscribers directly and only published to Redis when
+    another node has subscribers on the channel, as tracked in a set of
+    nodes per channel. Each node has a key expiring after ``NODE_TTL``
+    which it refreshes with a heartbeat, along with its entries in the
+    node sets of its channels. Nodes whose key has expired are skipped and
+    dropped from the node sets, and sets of dead nodes expire. A node
+    removes its entries when it shuts down. With a resume log messages
+    are also added to a trimmed Redis stream per channel and the stream
+    ids are their seqs. Logged messages are batched like publishes, and
+    the node's own subscribers get them once Redis has returned the seq.
+
+    Room members are cached by each node, see ``RoomCache``, so most
+    socket handshakes don't need a Redis round trip.
+
+    Members which could not be marked unsubscribed while Redis was
+    unreachable are removed again by the next heartbeat, or right before
+    the member subscribes on this node again.
+    """
+
+    process_local = False
+    supports_resume = True
+    connection_errors = (RedisConnectionError, RedisTimeoutError, TornadoRedisConnectionError)
 
     KEY_FORMAT = 'shoestring-room:{}'
+    COUNT_FORMAT = 'shoestring-room-count:{}'
+    NODES_FORMAT = 'shoestring-channel-nodes:{}'
+    NODE_KEY_FORMAT = 'shoestring-node:{}'
+    LOG_FORMAT = 'shoestring-channel-log:{}'
+    ROOMS_KEY = 'shoestring-rooms'
     ENV_KEY = 'SHOESTRING_REDIS_URL'
+    SHARDS_ENV_KEY = 'SHOESTRING_REDIS_PUBSUB_SHARDS'
+    BATCH_SIZE_ENV_KEY = 'SHOESTRING_REDIS_PUBLISH_BATCH_SIZE'
+    BATCH_DELAY_ENV_KEY = 'SHOESTRING_REDIS_PUBLISH_DELAY'
+    BUFFER_ENV_KEY = 'SHOESTRING_REDIS_PUBLISH_BUFFER'
+    ROOM_CACHE_ENV_KEY = 'SHOESTRING_REDIS_ROOM_CACHE_TTL'
+    INVALIDATE_CHANNEL = 'shoestring-room-invalidate'
+    ROOM_TTL = datetime.timedelta(hours=1)
+    # Nodes send a heartbeat every third of the TTL
+    NODE_TTL = datetime.timedelta(seconds=60)
+    # Seconds the publisher may block the IOLoop connecting to Redis and
+    # waiting for a reply, failing with a timeout error beyond that
+    CONNECT_TIMEOUT = 0.5
+    SOCKET_TIMEOUT = 1.0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.node = uuid.uuid4().hex
         info = self.parse_redis_parameters()
         db_number = info.pop('db', 0)
-        self.publisher = Redis(db=db_number, **info)
-        self.subscriber = RedisSubscriber(Client(selected_db=db_number, **info))
+        self.publisher = Redis(
+            db=db_number, socket_connect_timeout=self.CONNECT_TIMEOUT,
+            socket_timeout=self.SOCKET_TIMEOUT, **info)
+        self.subscriber = ShardedSubscriber(
+            [Client(selected_db=db_number, **info) for _ in range(self.parse_shard_count())],
+            node=self.node, resubscribed=self._heartbeat)
+        self.batcher = PublishBatcher(
+            self._send_batch, *self.parse_publish_batch(), max_pending=self.parse_publish_buffer(),
+            errors=(RedisConnectionError, RedisTimeoutError))
+        self.rooms, self.invalidations = self._room_cache(db_number, info)
+        scripts = {
+            'create_room': CREATE_ROOM,
+            'join_room': JOIN_ROOM,
+            'add_subscriber': ADD_SUBSCRIBER,
+            'remove_subscriber': REMOVE_SUBSCRIBER,
+            'publish': PUBLISH,
+        }
+        self.scripts = {
+            name: self._timed(name, self.publisher.register_script(script))
+            for name, script in scripts.items()}
+        # Queued on pipelines, which are timed as a whole
+        self.publish_script = self.publisher.register_script(PUBLISH)
+        self.publish_logged_script = self.publisher.register_script(PUBLISH_LOGGED)
+        # (channel, member uuid) still marked subscribed in Redis
+        self._removals = set()
+        self.heartbeats = PeriodicCallback(self._heartbeat, self._node_ttl() * 1000 / 3)
+        self.heartbeats.start()
+
+    def _room_cache(self, db_number, info):
+        """Room cache and its invalidation subscriber, both None when disabled."""
+        ttl = self.parse_room_cache_ttl()
+        if not ttl:
+            return None, None
+        rooms = RoomCache(ttl=ttl)
+        client = Client(selected_db=db_number, **info)
+        return rooms, InvalidationSubscriber(client, rooms, self.INVALIDATE_CHANNEL)
+
+    def _timed(self, command, func):
+        """Wrap a Redis call to record its latency."""
+        histogram = metrics.REDIS_COMMAND_SECONDS
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, command=command)
+        return timed
 
     def parse_redis_parameters(self):
         """Parse Redis host, port, db, password info from the OS environment."""
@@ -83,74 +775,321 @@ class Backend(BaseBackend):
         else:
             return {}
 
+    def parse_shard_count(self):
+        """Number of pub/sub connections from the OS environment."""
+        value = os.environ.get(self.SHARDS_ENV_KEY, '1')
+        try:
+            shards = int(value)
+        except ValueError:
+            shards = 0
+        if shards < 1:
+            raise RuntimeError('Invalid number of Redis pub/sub shards: {}'.format(value))
+        return shards
+
+    def parse_publish_batch(self):
+        """Maximum publish batch size and delay in seconds from the OS environment.
+
+        The delay is given in milliseconds. By default publishes are sent at
+        the end of the IOLoop iteration that produced them.
+        """
+        size = os.environ.get(self.BATCH_SIZE_ENV_KEY, '100')
+        delay = os.environ.get(self.BATCH_DELAY_ENV_KEY, '0')
+        try:
+            max_size = int(size)
+        except ValueError:
+            max_size = 0
+        if max_size < 1:
+            raise RuntimeError('Invalid Redis publish batch size: {}'.format(size))
+        try:
+            max_delay = float(delay)
+        except ValueError:
+            max_delay = -1
+        if max_delay < 0:
+            raise RuntimeError('Invalid Redis publish delay: {}'.format(delay))
+        return max_size, max_delay / 1000
+
+    def parse_publish_buffer(self):
+        """Publishes kept while Redis is unreachable from the OS environment."""
+        value = os.environ.get(self.BUFFER_ENV_KEY, '10000')
+        try:
+            size = int(value)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise RuntimeError('Invalid Redis publish buffer size: {}'.format(value))
+        return size
+
+    def parse_room_cache_ttl(self):
+        """Seconds room members are cached for from the OS environment, 0 disables the cache."""
+        value = os.environ.get(self.ROOM_CACHE_ENV_KEY, '5')
+        try:
+            ttl = float(value)
+        except ValueError:
+            ttl = -1
+        if ttl < 0:
+            raise RuntimeError('Invalid Redis room cache TTL: {}'.format(value))
+        return ttl
+
     def _room_key(self, name):
         return self.KEY_FORMAT.format(name)
 
+    def _count_key(self, name):
+        return self.COUNT_FORMAT.format(name)
+
+    def _nodes_key(self, channel):
+        return self.NODES_FORMAT.format(channel)
+
+    def _log_key(self, channel):
+        return self.LOG_FORMAT.format(channel)
+
+    def _node_key(self, node=''):
+        return self.NODE_KEY_FORMAT.format(node)
+
+    def _log_range_start(self, since):
+        """First stream id after the seq since."""
+        match = SEQ_PATTERN.match(since)
+        if match is None:
+            raise ValueError('Invalid seq: {}'.format(since))
+        return '{}-{}'.format(match.group(1), int(match.group(2)) + 1)
+
+    def _parse_log(self, entries):
+        log = []
+        for seq, fields in entries:
+            fields = [f.decode('utf-8') if isinstance(f, bytes) else f for f in fields]
+            fields = dict(zip(fields[::2], fields[1::2]))
+            seq = seq.decode('utf-8') if isinstance(seq, bytes) else seq
+            log.append((seq, fields['sender'], fields['message']))
+        return log
+
+    def _publish_logged_args(self, message, channel, sender):
+        keys = [self._nodes_key(channel), self._log_key(channel)]
+        args = [self.node, channel, sender, message, self.resume_log_size, self._room_ttl(),
+                self._node_key()]
+        return keys, args
+
+    def _subscriber_keys(self, channel):
+        return [self._room_key(channel), self._count_key(channel), self._nodes_key(channel),
+                self._node_key(self.node), self.ROOMS_KEY]
+
+    def _create_room_args(self, owner):
+        return [owner, self._room_ttl(), int(time.time())]
+
+    def _remove_subscriber_args(self, member, last):
+        return [member, self.node, last, self._room_ttl(), int(time.time()),
+                self.INVALIDATE_CHANNEL]
+
+    def _room_count_args(self):
+        # Rooms expiring after now, subscribed rooms never expire
+        return self.ROOMS_KEY, '({}'.format(int(time.time())), '+inf'
+
+    def _has_subscribers(self, channel):
+        return any(True for _ in self.get_subscribers(channel))
+
+    def _room_ttl(self):
+        return int(self.ROOM_TTL.total_seconds())
+
+    def _node_ttl(self):
+        return int(self.NODE_TTL.total_seconds())
+
+    def _register(self, pipe, channels):
+        """Queue refreshing this node's key and its entries in the channels' node sets."""
+        ttl = self._node_ttl()
+        pipe.set(self._node_key(self.node), '')
+        pipe.expire(self._node_key(self.node), ttl)
+        for channel in channels:
+            key = self._nodes_key(channel)
+            pipe.sadd(key, self.node)
+            pipe.expire(key, ttl)
+
+    def _unregister(self, pipe, channels):
+        """Queue removing this node's key and its entries in the channels' node sets."""
+        for channel in channels:
+            pipe.srem(self._nodes_key(channel), self.node)
+        pipe.delete(self._node_key(self.node))
+
+    def _heartbeat(self, channels=None):
+        """Register this node on the given channels, by default all with local subscribers."""
+        pipe = self.publisher.pipeline(transaction=False)
+        self._register(pipe, self.subscriber.channels() if channels is None else channels)
+        try:
+            self._timed('heartbeat', pipe.execute)()
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            logging.warning('Redis node heartbeat failed: %s', e)
+            return
+        for channel, member in list(self._removals):
+            self._remove_member(channel, member)
+
+    def _cached_room(self, key):
+        """Cached members of the room or None, also while invalidations may be missed."""
+        if self.rooms is None or self.invalidations.outage is not None:
+            return None
+        return self.rooms.get(key)
+
+    def _cache_room(self, key, members, generation):
+        if self.rooms is not None and self.invalidations.outage is None:
+            self.rooms.add(key, members, generation)
+
+    def _invalidate_room(self, key):
+        # Other nodes are told by the membership scripts
+        if self.rooms is not None:
+            self.rooms.invalidate(key)
+
     def create_room(self, owner):
         created = False
         while not created:
             room = self._get_random_name()
-            key = self._room_key(room)
-            if not self.publisher.exists(key):
-                created = True
-                self.publisher.hset(key, owner, '')
-                # Set the room to expire in an hour
-                self.publisher.expire(key, datetime.timedelta(hours=1))
+            # Create the room with an expiry if the name is not taken
+            created = self.scripts['create_room'](
+                keys=[self._room_key(room), self.ROOMS_KEY], args=self._create_room_args(owner))
         return room
 
     def join_room(self, name, user):
         key = self._room_key(name)
-        if self.publisher.exists(key):
-            self.publisher.hset(key, user, '')
+        joined = self.scripts['join_room'](keys=[key], args=[user, self.INVALIDATE_CHANNEL])
+        self._invalidate_room(key)
+        if joined:
             return name
         else:
             raise KeyError('Unknown room.')
 
     def get_room(self, name):
         key = self._room_key(name)
-        result = self.publisher.hgetall(key)
+        members = self._cached_room(key)
+        if members is not None:
+            return members
+        generation = self.rooms.generation if self.rooms is not None else None
+        result = self._timed('hgetall', self.publisher.hgetall)(key)
         if not result:
             raise KeyError('Unknown room.')
         members = {}
-        for key, value in result.items():
-            members[key.decode('utf-8')] = bool(value)
+        for member, value in result.items():
+            members[member.decode('utf-8')] = bool(value)
+        self._cache_room(key, members, generation)
         return members
 
     def add_subscriber(self, channel, subscriber):
+        keys = self._subscriber_keys(channel)
+        # Marks the member as subscribed, removes any expiry on the room
+        # and adds this node to the channel's nodes
+        args = [subscriber.uuid, self.node, self.INVALIDATE_CHANNEL, self._node_ttl()]
+        if (channel, subscriber.uuid) in self._removals:
+            # The member's previous socket closed while Redis was unreachable
+            self._remove_member(channel, subscriber.uuid)
+        try:
+            result = self.scripts['add_subscriber'](keys=keys, args=args)
+        except self.connection_errors:
+            # Redis may have marked the member subscribed before failing
+            self._removals.add((channel, subscriber.uuid))
+            raise
+        self._invalidate_room(keys[0])
+        if result < 0:
+            raise ValueError('Already subscribed.')
         self.subscriber.subscribe(channel, subscriber)
-        key = self._room_key(channel)
-        if self.publisher.exists(key):
-            if self.publisher.hget(key, subscriber.uuid):
-                raise ValueError('Already subscribed.')
-            self.publisher.hset(key, subscriber.uuid, 'subscribed')
-            # Remove any expiry on the room
-            self.publisher.persist(key)
 
     def remove_subscriber(self, channel, subscriber):
         self.subscriber.unsubscribe(channel, subscriber)
-        key = self._room_key(channel)
-        if self.publisher.exists(key):
-            self.publisher.hset(key, subscriber.uuid, '')
-            if not any(self.publisher.hvals(key)):
-                # Set the room to expire in an hour
-                self.publisher.expire(key, datetime.timedelta(hours=1))
+        self._remove_member(channel, subscriber.uuid)
+
+    def _remove_member(self, channel, member):
+        keys = self._subscriber_keys(channel)
+        last = '0' if self._has_subscribers(channel) else '1'
+        # Set the room to expire when the last member unsubscribes
+        args = self._remove_subscriber_args(member, last)
+        try:
+            self.scripts['remove_subscriber'](keys=keys, args=args)
+        except self.connection_errors as e:
+            logging.warning('Could not remove %s from channel %s in Redis: %s', member, channel, e)
+            self._removals.add((channel, member))
+            return
+        self._removals.discard((channel, member))
+        self._invalidate_room(keys[0])
 
     def get_subscribers(self, channel=None):
-        if channel is not None:
-            yield from self.subscriber.subscribers[channel].keys()
-        else:
-            for subscribers in self.subscriber.subscribers.values():
-                for s in subscribers:
-                    yield s
+        return self.subscriber.get_subscribers(channel)
 
-    def broadcast(self, message, channel, sender):
-        message = json.dumps({
+    def room_count(self):
+        return self._timed('zcount', self.publisher.zcount)(*self._room_count_args())
+
+    def _deliver(self, channel, message, sender):
+        """Write the message to this node's subscribers of the channel."""
+        message = prepare_message(message)
+        peers = list(self.get_subscribers(channel))
+        delivered = 0
+        for peer in peers:
+            if peer.uuid != sender:
+                try:
+                    peer.write_message(message)
+                except WebSocketClosedError:
+                    # Remove dead peer
+                    self.subscriber.unsubscribe(channel, peer)
+                else:
+                    delivered += 1
+        metrics.MESSAGES_DELIVERED.inc(delivered)
+
+    def _publish_message(self, message, sender):
+        return json.dumps({
             'sender': sender,
+            'node': self.node,
             'message': message
         })
-        self.publisher.publish(channel, message)
+
+    def _publish_args(self, channel, message, sender):
+        keys = [self._nodes_key(channel)]
+        args = [self.node, channel, self._publish_message(message, sender), self._node_key()]
+        return keys, args
+
+    def _send_batch(self, batch):
+        """Publish (and log) a batch of messages in one pipelined round trip."""
+        pipe = self.publisher.pipeline(transaction=False)
+        for channel, message, sender in batch:
+            if self.resume_log_size:
+                keys, args = self._publish_logged_args(message, channel, sender)
+                self.publish_logged_script(keys=keys, args=args, client=pipe)
+            else:
+                keys, args = self._publish_args(channel, message, sender)
+                self.publish_script(keys=keys, args=args, client=pipe)
+        return self._timed('publish_batch', pipe.execute)()
+
+    def _logged(self, channel, message, sender, future):
+        """Deliver a logged message to local subscribers once it has its seq."""
+        seq = future.result()
+        if seq is None:
+            # Dropped from the batcher's buffer during a Redis outage
+            return
+        if isinstance(seq, Exception):
+            logging.warning('Could not log message on %s: %s', channel, seq)
+            return
+        self._deliver(channel, sequence_message(to_unicode(seq), message), sender)
+
+    def get_log(self, channel, since):
+        entries = self._timed('xrange', self.publisher.execute_command)(
+            'XRANGE', self._log_key(channel), self._log_range_start(since), '+')
+        return self._parse_log(entries)
+
+    def broadcast(self, message, channel, sender):
+        if self.resume_log_size:
+            # Logged with the other publishes of this IOLoop iteration, also
+            # buffered during Redis outages
+            logged = Future()
+            self.batcher.add(channel, message, sender, result=logged)
+            IOLoop.current().add_future(logged, partial(self._logged, channel, message, sender))
+            return
+        self._deliver(channel, message, sender)
+        # Sent with the other publishes of this IOLoop iteration
+        self.batcher.add(channel, message, sender)
 
     def shutdown(self, graceful=True):
+        channels = self.subscriber.channels()
         super().shutdown(graceful=graceful)
+        self.batcher.flush()
+        self.heartbeats.stop()
         self.subscriber.close()
+        if self.invalidations is not None:
+            self.invalidations.close()
+        pipe = self.publisher.pipeline(transaction=False)
+        self._unregister(pipe, channels)
+        try:
+            pipe.execute()
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            logging.warning('Could not remove the node from Redis: %s', e)
         self.publisher.connection_pool.disconnect()
@@ -0,0 +1,265 @@
+"""Microbenchmarks of the backend API with fake subscribers.
+
+Drives a backend directly, without sockets or HTTP, timing each API call:
+creating, joining and getting rooms, adding and removing subscribers,
+broadcasting to rooms of 2, 10 and 100 peers and shutting down with 100k
+subscribers. Each case reports the best of a number of rounds.
+
+Results can be saved as a JSON baseline and later runs compared against it.
+Cases slower than the baseline by more than the threshold are flagged and
+the exit status is 1, so a backend change can be checked before merging:
+
+    python -m shoestring.benchmarks.backends --save baseline.json
+    python -m shoestring.benchmarks.backends --compare baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import uuid
+
+from tornado import gen
+from tornado.concurrent import is_future
+from tornado.ioloop import IOLoop
+
+from ..app import get_backend_class
+
+
+class Subscriber(object):
+    """Fake websocket."""
+
+    __slots__ = ('uuid', )
+
+    def __init__(self, user=None):
+        self.uuid = user or uuid.uuid4().hex
+
+    def write_message(self, message):
+        pass
+
+    def close(self, code=None, reason=None):
+        pass
+
+
+@gen.coroutine
+def resolve(result):
+    """Wait for the result of asynchronous backends."""
+    if is_future(result):
+        result = yield result
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def drain(backend):
+    """Wait until batching backends have published every pending message."""
+    batcher = getattr(backend, 'batcher', None)
+    while batcher is not None and (batcher.pending or batcher._sending):
+        batcher.flush()
+        yield gen.moment
+
+
+@gen.coroutine
+def create_rooms(backend, count):
+    rooms = []
+    for _ in range(count):
+        room = yield resolve(backend.create_room(uuid.uuid4().hex))
+        rooms.append(room)
+    raise gen.Return(rooms)
+
+
+@gen.coroutine
+def bench_create_room(backend, ops):
+    owners = [uuid.uuid4().hex for _ in range(ops)]
+    start = time.perf_counter()
+    for owner in owners:
+        result = backend.create_room(owner)
+        if is_future(result):
+            yield result
+    raise gen.Return(time.perf_counter() - start)
+
+
+@gen.coroutine
+def bench_join_room(backend, ops):
+    rooms = yield create_rooms(backend, ops)
+    start = time.perf_counter()
+    for room in rooms:
+        result = backend.join_room(room, uuid.uuid4().hex)
+        if is_future(result):
+            yield result
+    raise gen.Return(time.perf_counter() - start)
+
+
+@gen.coroutine
+def bench_get_room(backend, ops):
+    rooms = yield create_rooms(backend, ops)
+    start = time.perf_counter()
+    for room in rooms:
+        result = backend.get_room(room)
+        if is_future(result):
+            yield result
+    raise gen.Return(time.perf_counter() - start)
+
+
+@gen.coroutine
+def subscribe(backend, rooms):
+    subscribers = [(room, Subscriber()) for room in rooms]
+    start = time.perf_counter()
+    for room, subscriber in subscribers:
+        result = backend.add_subscriber(room, subscriber)
+        if is_future(result):
+            yield result
+    raise gen.Return((subscribers, time.perf_counter() - start))
+
+
+@gen.coroutine
+def bench_add_subscriber(backend, ops):
+    rooms = yield create_rooms(backend, ops)
+    _, elapsed = yield subscribe(backend, rooms)
+    raise gen.Return(elapsed)
+
+
+@gen.coroutine
+def bench_remove_subscriber(backend, ops):
+    rooms = yield create_rooms(backend, ops)
+    subscribers, elapsed = yield subscribe(backend, rooms)
+    start = time.perf_counter()
+    for room, subscriber in subscribers:
+        result = backend.remove_subscriber(room, subscriber)
+        if is_future(result):
+            yield result
+    raise gen.Return(time.perf_counter() - start)
+
+
+def bench_broadcast(peers):
+
+    @gen.coroutine
+    def bench(backend, ops):
+        rooms = yield create_rooms(backend, 1)
+        yield subscribe(backend, rooms * peers)
+        sender = uuid.uuid4().hex
+        message = json.dumps({'candidate': 'candidate:1 1 UDP 2130706431 192.168.1.10 54321 typ host'})
+        start = time.perf_counter()
+        for _ in range(ops):
+            result = backend.broadcast(message, channel=rooms[0], sender=sender)
+            if is_future(result):
+                yield result
+        yield drain(backend)
+        raise gen.Return(time.perf_counter() - start)
+
+    return bench
+
+
+def bench_shutdown(subscribers):
+
+    @gen.coroutine
+    def bench(backend, ops):
+        # Rooms of two peers
+        rooms = yield create_rooms(backend, subscribers // 2)
+        yield subscribe(backend, rooms * 2)
+        start = time.perf_counter()
+        backend.shutdown()
+        raise gen.Return(time.perf_counter() - start)
+
+    # Shutting down is a single operation which consumes the backend
+    bench.ops = 1
+    bench.shuts_down = True
+    return bench
+
+
+def get_cases(shutdown_subscribers):
+    return [
+        ('create_room', bench_create_room),
+        ('join_room', bench_join_room),
+        ('get_room', bench_get_room),
+        ('add_subscriber', bench_add_subscriber),
+        ('remove_subscriber', bench_remove_subscriber),
+        ('broadcast_2', bench_broadcast(2)),
+        ('broadcast_10', bench_broadcast(10)),
+        ('broadcast_100', bench_broadcast(100)),
+        ('shutdown_{}'.format(shutdown_subscribers), bench_shutdown(shutdown_subscribers)),
+    ]
+
+
+def run(backend_name, cases, ops, rounds):
+    """Best seconds per operation of each case."""
+    backend_class = get_backend_class(backend_name)
+    loop = IOLoop.current()
+    results = {}
+    for name, bench in cases:
+        count = getattr(bench, 'ops', ops)
+        best = float('inf')
+        for _ in range(rounds):
+            backend = backend_class()
+            try:
+                elapsed = loop.run_sync(lambda: bench(backend, count))
+            finally:
+                if not getattr(bench, 'shuts_down', False):
+                    backend.shutdown()
+            best = min(best, elapsed / count)
+        results[name] = best
+    return results
+
+
+def compare(baseline, results, threshold):
+    """Print the change of each case, returning the regressed cases."""
+    regressions = []
+    for backend, timings in sorted(results.items()):
+        print(backend)
+        for name, seconds in timings.items():
+            previous = baseline.get(backend, {}).get(name)
+            if previous is None:
+                print('  {:<20} {:>12.2f}us  (no baseline)'.format(name, seconds * 1e6))
+                continue
+            change = seconds / previous - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((backend, name))
+            print('  {:<20} {:>12.2f}us  baseline {:>12.2f}us  {:+7.1%}{}'.format(
+                name, seconds * 1e6, previous * 1e6, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', action='append',
+                        help='Backend module (repeatable). Defaults to the memory backend.')
+    parser.add_argument('--ops', default=10000, type=int, help='Operations per round.')
+    parser.add_argument('--rounds', default=5, type=int)
+    parser.add_argument('--shutdown-subscribers', default=100000, type=int)
+    parser.add_argument('--save', metavar='PATH', help='Write the results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare against a JSON baseline.')
+    parser.add_argument('--threshold', default=0.2, type=float,
+                        help='Slowdown flagged as a regression (0.2 is 20%%).')
+    args = parser.parse_args()
+
+    cases = get_cases(args.shutdown_subscribers)
+    results = {}
+    for backend in args.backend or ['shoestring.backends.memory']:
+        results[backend] = run(backend, cases, args.ops, args.rounds)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+    else:
+        for backend, timings in sorted(results.items()):
+            print(backend)
+            for name, seconds in timings.items():
+                print('  {:<20} {:>12.2f}us'.format(name, seconds * 1e6))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'ops': args.ops,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if regressions:
+        print('{} regression(s) beyond {:.0%}'.format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,155 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from functools import partial
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.websocket import websocket_connect
+
+
+def percentile(values, percent):
+    """Return the value at the given percent (0-100) of the sorted values."""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(values):
+    """Summarize latency samples as milliseconds."""
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': (max(values) if values else float('nan')) * 1000,
+    }
+
+
+def rss(pid):
+    """Resident set size of the process in bytes (Linux only, NaN elsewhere)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def free_port():
+    """Find an unused local TCP port."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    """Block until something accepts connections on the local port."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        except OSError:
+            time.sleep(0.1)
+        else:
+            return
+    raise RuntimeError('Nothing listening on port {}.'.format(port))
+
+
+@contextmanager
+def run_server(port, backend, env=None, args=()):
+    """Run the signaling server in a subprocess."""
+    environ = dict(os.environ)
+    environ.update(env or {})
+    command = [
+        sys.executable, '-m', 'shoestring',
+        '--port={}'.format(port), '--backend={}'.format(backend),
+        '--logging=warning',
+    ]
+    command.extend(args)
+    process = subprocess.Popen(command, env=environ)
+    try:
+        wait_for_port(port)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class LatencyProxy(TCPServer):
+    """TCP proxy which adds a fixed delay to traffic in both directions."""
+
+    def __init__(self, target, delay, **kwargs):
+        super().__init__(**kwargs)
+        self.target = target
+        self.delay = delay
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        upstream = IOStream(socket.socket())
+        try:
+            yield upstream.connect(self.target)
+        except StreamClosedError:
+            stream.close()
+        else:
+            self._pipe(stream, upstream)
+            self._pipe(upstream, stream)
+
+    def _forward(self, stream, data):
+        if data is None:
+            stream.close()
+        elif not stream.closed():
+            stream.write(data)
+
+    @gen.coroutine
+    def _pipe(self, source, destination):
+        loop = IOLoop.current()
+        # Half of the added round trip is spent in each direction
+        delay = self.delay / 2
+        while True:
+            try:
+                data = yield source.read_bytes(65536, partial=True)
+            except StreamClosedError:
+                data = None
+            loop.add_timeout(loop.time() + delay, partial(self._forward, destination, data))
+            if data is None:
+                break
+
+
+class SignalClient(object):
+    """Room participant talking to the server over HTTP and websockets."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.http = AsyncHTTPClient()
+
+    @gen.coroutine
+    def create_room(self):
+        response = yield self.http.fetch(self.base_url + '/rooms', method='POST', body='')
+        raise gen.Return(json.loads(response.body.decode('utf-8')))
+
+    @gen.coroutine
+    def join_room(self, room):
+        response = yield self.http.fetch(self.base_url + '/rooms/{}'.format(room))
+        raise gen.Return(json.loads(response.body.decode('utf-8')))
+
+    @gen.coroutine
+    def connect(self, info, channel=None):
+        url = '{}?token={}'.format(info['socket'], info['token'])
+        if channel is not None:
+            url += '&channel={}'.format(channel)
+        socket = yield websocket_connect(url)
+        raise gen.Return(socket)
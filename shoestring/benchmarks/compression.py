@@ -0,0 +1,63 @@
+"""Bytes on the wire and CPU cost of permessage-deflate compression.
+
+Builds server frames for a replayed offer/answer exchange (SDP and ICE
+candidate messages) at each compression level and reports the frame bytes
+per exchange and the CPU time to compress and to inflate one message. A
+broadcast compresses its message once for all peers with the same options.
+
+    python -m shoestring.benchmarks.compression --levels 1 6 9 --window-bits 15 12
+"""
+import argparse
+import json
+import time
+
+from ..deflate import DeflateOptions, deflate, inflate
+from ..frames import encode_frame
+from .load import script
+
+
+def measure(messages, options, repeat):
+    """Frame bytes per exchange and CPU seconds per message to encode and inflate."""
+    size = sum(len(encode_frame(m, deflate=options)) for m in messages)
+    start = time.process_time()
+    for _ in range(repeat):
+        for message in messages:
+            encode_frame(message, deflate=options)
+    encode = (time.process_time() - start) / (repeat * len(messages))
+    if options is None:
+        return size, encode, 0
+    payloads = [deflate(m.encode('utf-8'), options) for m in messages]
+    start = time.process_time()
+    for _ in range(repeat):
+        for payload in payloads:
+            inflate(payload)
+    decode = (time.process_time() - start) / (repeat * len(messages))
+    return size, encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--levels', nargs='+', default=[1, 3, 6, 9], type=int)
+    parser.add_argument('--mem-level', default=8, type=int)
+    parser.add_argument('--window-bits', nargs='+', default=[15], type=int)
+    parser.add_argument('--min-size', default=256, type=int)
+    parser.add_argument('--repeat', default=200, type=int)
+    args = parser.parse_args()
+
+    messages = [json.dumps(m) for m in script()]
+    baseline, encode, _ = measure(messages, None, args.repeat)
+    print('{} messages per exchange, {} bytes of text'.format(
+        len(messages), sum(len(m) for m in messages)))
+    print('{:<22} {:>8} bytes/exchange {:>7} {:>8.1f}us encode/msg'.format(
+        'uncompressed', baseline, '', encode * 1e6))
+    for window_bits in args.window_bits:
+        for level in args.levels:
+            options = DeflateOptions(level, args.mem_level, window_bits, args.min_size)
+            size, encode, decode = measure(messages, options, args.repeat)
+            print('{:<22} {:>8} bytes/exchange {:>6.0%} {:>8.1f}us encode/msg {:>6.1f}us inflate/msg'.format(
+                'level {} window {}'.format(level, window_bits), size, size / baseline - 1,
+                encode * 1e6, decode * 1e6))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,77 @@
+"""CPU cost of fanning out large signaling messages to a room.
+
+Compares writing a plain message to every socket, which encodes the text
+and builds the websocket frame per peer, with an encoded message whose
+frame is built once and shared by every peer's stream.
+
+    python -m shoestring.benchmarks.fanout --peers 100 --size 16384
+"""
+import argparse
+import json
+import time
+
+from tornado.websocket import WebSocketProtocol13
+
+from ..frames import EncodedMessage
+from ..handlers import SocketHandler
+
+
+class NullStream(object):
+    """Stream which only counts the bytes written to it."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data, callback=None):
+        self.written += len(data)
+        if callback is not None:
+            callback()
+
+    def closed(self):
+        return False
+
+
+def make_peer():
+    """Socket handler with a protocol connection writing to a null stream."""
+    peer = SocketHandler.__new__(SocketHandler)
+    peer.initialize(backend=None)
+    peer.request = None
+    peer.stream = NullStream()
+    peer.ws_connection = WebSocketProtocol13(peer)
+    return peer
+
+
+def sdp_blob(size):
+    """JSON signaling message of roughly the given size."""
+    line = 'a=candidate:1 1 UDP 2130706431 192.168.1.10 54321 typ host\\r\\n'
+    return json.dumps({'sdp': {'type': 'offer', 'sdp': line * (size // len(line) + 1)}})
+
+
+def run(peers, message, repeat, prepare):
+    start = time.process_time()
+    for _ in range(repeat):
+        payload = prepare(message)
+        for peer in peers:
+            peer.write_message(payload)
+    return (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', default=100, type=int)
+    parser.add_argument('--size', default=16384, type=int, help='Approximate message size in bytes.')
+    parser.add_argument('--repeat', default=500, type=int)
+    args = parser.parse_args()
+
+    peers = [make_peer() for _ in range(args.peers)]
+    message = sdp_blob(args.size)
+    per_peer = run(peers, message, args.repeat, lambda m: m)
+    shared = run(peers, message, args.repeat, EncodedMessage)
+    print('{} peers, {} byte message'.format(args.peers, len(message)))
+    print('per peer encoding: {:8.1f}us CPU per broadcast'.format(per_peer * 1e6))
+    print('encoded once:      {:8.1f}us CPU per broadcast ({:.0%} saved)'.format(
+        shared * 1e6, 1 - shared / per_peer))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,108 @@
+"""Cross-process message throughput and per hop latency of local backends.
+
+Two backend instances share a channel: one broadcasts and the other has the
+subscriber, so every message takes the backend's process to process hop
+(the IPC broker's Unix socket or Redis pub/sub).
+
+    python -m shoestring.benchmarks.ipc_throughput --messages 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from importlib import import_module
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .base import summarize
+
+
+BACKENDS = (
+    'shoestring.backends.ipc',
+    'shoestring.backends.redis',
+)
+
+
+class Sink(object):
+    """Fake subscriber recording the arrival of each message."""
+
+    def __init__(self):
+        self.uuid = uuid.uuid4().hex
+        self.received = 0
+        self.latencies = []
+        self.expected = None
+        self.done = Future()
+
+    def write_message(self, message):
+        self.received += 1
+        self.latencies.append(IOLoop.current().time() - json.loads(message)['sent'])
+        if self.received == self.expected:
+            self.done.set_result(None)
+
+    def expect(self, count):
+        self.received, self.latencies, self.done = 0, [], Future()
+        self.expected = count
+        return self.done
+
+
+@gen.coroutine
+def measure(backend_name, messages, rounds):
+    backend_class = getattr(import_module(backend_name), 'Backend')
+    receiver, sender = backend_class(), backend_class()
+    loop = IOLoop.current()
+    sink = Sink()
+    channel = uuid.uuid4().hex
+    yield gen.maybe_future(receiver.add_subscriber(channel, sink))
+    # Let pub/sub subscriptions settle
+    yield gen.Task(loop.add_timeout, loop.time() + 0.5)
+
+    # Latency: one message in flight at a time
+    latencies = []
+    for _ in range(rounds):
+        done = sink.expect(1)
+        message = json.dumps({'sent': loop.time()})
+        yield gen.maybe_future(sender.broadcast(message, channel=channel, sender='bench'))
+        yield done
+        latencies.extend(sink.latencies)
+
+    # Throughput: send everything back to back
+    done = sink.expect(messages)
+    start = loop.time()
+    for _ in range(messages):
+        message = json.dumps({'sent': loop.time()})
+        sender.broadcast(message, channel=channel, sender='bench')
+    yield done
+    elapsed = loop.time() - start
+
+    yield gen.maybe_future(receiver.remove_subscriber(channel, sink))
+    sender.shutdown()
+    receiver.shutdown()
+    raise gen.Return((messages / elapsed, summarize(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', default=20000, type=int)
+    parser.add_argument('--rounds', default=2000, type=int, help='Sequential latency samples.')
+    parser.add_argument('--backend', action='append', help='Backend module(s) to compare.')
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    os.environ.setdefault('SHOESTRING_IPC_PATH', os.path.join(tempdir, 'bench.sock'))
+    loop = IOLoop.current()
+    try:
+        for backend in args.backend or BACKENDS:
+            rate, result = loop.run_sync(lambda: measure(backend, args.messages, args.rounds))
+            print('{:<28} {:>10.0f} msg/s  hop p50={p50:.3f}ms p99={p99:.3f}ms'.format(
+                backend, rate, **result))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
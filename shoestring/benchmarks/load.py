@@ -0,0 +1,182 @@
+"""End-to-end signaling load against a local server.
+
+Starts the server, creates rooms with ``POST /rooms``, joins the other
+peers with ``GET /rooms/<id>`` and connects every peer to its room's socket.
+Peers then replay SDP offers/answers and ICE candidates at the given rate,
+which the server fans out to the rest of the room. Reports connection setup
+time, delivery latency, delivered messages per second and server RSS per
+connection for each backend. The Redis backends need a local redis-server.
+
+    python -m shoestring.benchmarks.load --rooms 100 --room-size 4 --rate 5
+"""
+import argparse
+import json
+import random
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .base import free_port, rss, run_server, summarize, SignalClient
+
+
+BACKENDS = (
+    'shoestring.backends.memory',
+    'shoestring.backends.redis',
+    'shoestring.backends.asyncredis',
+)
+
+
+def sdp(kind, candidates=4):
+    """Session description roughly the size a browser produces."""
+    lines = ['v=0', 'o=- 4611731400430051336 2 IN IP4 127.0.0.1', 's=-', 't=0 0',
+             'a=group:BUNDLE audio video data']
+    for media in ('audio', 'video', 'application'):
+        lines.append('m={} 9 UDP/TLS/RTP/SAVPF 111 103 104 9 0 8 106 105 13 110'.format(media))
+        lines.extend(['c=IN IP4 0.0.0.0', 'a=rtcp:9 IN IP4 0.0.0.0',
+                      'a=ice-ufrag:4ZcD', 'a=ice-pwd:2/1muCWoOi3uLifh0NuRHlBD',
+                      'a=fingerprint:sha-256 ' + ':'.join(['7B'] * 32),
+                      'a=setup:actpass', 'a=mid:{}'.format(media), 'a=sendrecv', 'a=rtcp-mux'])
+        lines.extend('a=rtpmap:{} opus/48000/2'.format(n) for n in range(96, 110))
+        lines.extend('a=ssrc:{} cname:4TOk42mSjXCkVIa6'.format(n) for n in range(candidates))
+    return {'type': kind, 'sdp': '\r\n'.join(lines) + '\r\n'}
+
+
+def candidate(index):
+    return {'candidate': 'candidate:{} 1 udp 2122260223 192.168.1.{} {} typ host generation 0'.format(
+        index, index % 255, 50000 + index), 'sdpMid': 'data', 'sdpMLineIndex': 0}
+
+
+def script(candidates=6):
+    """Messages of one offer/answer exchange in the order peers send them."""
+    messages = [{'sdp': sdp('offer')}]
+    messages.extend({'candidate': candidate(i)} for i in range(candidates))
+    messages.append({'sdp': sdp('answer')})
+    return messages
+
+
+class Peer(object):
+
+    def __init__(self, info, socket):
+        self.info = info
+        self.socket = socket
+
+
+@gen.coroutine
+def connect(client, info, setup):
+    start = time.perf_counter()
+    socket = yield client.connect(info)
+    setup.append(time.perf_counter() - start)
+    raise gen.Return(Peer(info, socket))
+
+
+@gen.coroutine
+def room(client, size, setup):
+    """Create a room, join the other peers and connect every peer."""
+    start = time.perf_counter()
+    owner = yield client.create_room()
+    setup.append(time.perf_counter() - start)
+    infos = [owner]
+    for _ in range(size - 1):
+        start = time.perf_counter()
+        info = yield client.join_room(owner['room'])
+        setup.append(time.perf_counter() - start)
+        infos.append(info)
+    peers = yield [connect(client, info, setup) for info in infos]
+    raise gen.Return(peers)
+
+
+@gen.coroutine
+def send(peer, messages, rate, deadline):
+    """Replay the exchange at the rate (messages per second) until the deadline."""
+    loop = IOLoop.current()
+    interval = 1 / rate
+    # Spread peers out so they don't all send in the same tick
+    yield gen.Task(loop.add_timeout, loop.time() + random.random() * interval)
+    sent = 0
+    while loop.time() < deadline:
+        message = dict(messages[sent % len(messages)], sent=time.time(), sender=peer.info['user'])
+        peer.socket.write_message(json.dumps(message))
+        sent += 1
+        yield gen.Task(loop.add_timeout, loop.time() + interval)
+    raise gen.Return(sent)
+
+
+@gen.coroutine
+def receive(peer, latencies):
+    while True:
+        message = yield peer.socket.read_message()
+        if message is None:
+            break
+        latencies.append(time.time() - json.loads(message)['sent'])
+
+
+@gen.coroutine
+def measure(base_url, pid, rooms, size, rate, duration):
+    client = SignalClient(base_url)
+    loop = IOLoop.current()
+    idle = rss(pid)
+    setup = []
+    start = time.perf_counter()
+    peers = yield [room(client, size, setup) for _ in range(rooms)]
+    peers = [peer for group in peers for peer in group]
+    setup_total = time.perf_counter() - start
+    connected = rss(pid)
+    latencies = []
+    readers = [receive(peer, latencies) for peer in peers]
+    messages = script()
+    start = time.perf_counter()
+    deadline = loop.time() + duration
+    sent = yield [send(peer, messages, rate, deadline) for peer in peers]
+    # Let the last messages arrive before closing
+    yield gen.Task(loop.add_timeout, loop.time() + 1)
+    elapsed = time.perf_counter() - start
+    for peer in peers:
+        peer.socket.close()
+    yield readers
+    raise gen.Return({
+        'connections': len(peers),
+        'setup': summarize(setup),
+        'setup_total': setup_total,
+        'sent': sum(sent),
+        'latency': summarize(latencies),
+        'throughput': len(latencies) / elapsed,
+        'rss': connected,
+        'rss_per_connection': (connected - idle) / len(peers),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='Backend to load (repeatable). Defaults to memory and redis.')
+    parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/0')
+    parser.add_argument('--rooms', default=100, type=int)
+    parser.add_argument('--room-size', default=4, type=int, help='Peers per room.')
+    parser.add_argument('--rate', default=5, type=float, help='Messages per second per peer.')
+    parser.add_argument('--duration', default=10, type=float)
+    args = parser.parse_args()
+
+    backends = args.backend or BACKENDS[:2]
+    loop = IOLoop.current()
+    env = {'SHOESTRING_REDIS_URL': args.redis_url}
+    print('{} rooms of {} peers, {} messages/s per peer for {}s'.format(
+        args.rooms, args.room_size, args.rate, args.duration))
+    for backend in backends:
+        port = free_port()
+        with run_server(port, backend, env=env) as process:
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            result = loop.run_sync(lambda: measure(
+                base_url, process.pid, args.rooms, args.room_size, args.rate, args.duration))
+        print(backend)
+        print('  setup:      {connections} connections in {setup_total:.2f}s, '
+              'p50={setup[p50]:.2f}ms p99={setup[p99]:.2f}ms per request'.format(**result))
+        print('  latency:    n={latency[count]} p50={latency[p50]:.2f}ms p99={latency[p99]:.2f}ms '
+              'max={latency[max]:.2f}ms'.format(**result))
+        print('  throughput: {sent} sent, {throughput:.0f} delivered messages/s'.format(**result))
+        print('  memory:     {:.1f}MB RSS, {:.1f}KB per connection'.format(
+            result['rss'] / 2 ** 20, result['rss_per_connection'] / 2 ** 10))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,98 @@
+"""Memory and subscribe/unsubscribe cost of the memory backend registry.
+
+Creates many rooms, then churns their members connecting and disconnecting
+sockets on the room and user channels while also looking up unknown
+channels. Memory should stay flat across churn rounds and the cost of a
+subscribe/unsubscribe pair should not depend on the channel size.
+
+    python -m shoestring.benchmarks.memory_registry --rooms 100000
+"""
+import argparse
+import time
+import tracemalloc
+import uuid
+
+from ..backends.memory import Backend
+
+
+class Subscriber(object):
+    """Fake websocket."""
+
+    __slots__ = ('uuid', )
+
+    def __init__(self, user=None):
+        self.uuid = user or uuid.uuid4().hex
+
+    def write_message(self, message):
+        pass
+
+
+def create_rooms(backend, count):
+    """Rooms with an owner and a guest."""
+    rooms = []
+    for _ in range(count):
+        owner, guest = uuid.uuid4().hex, uuid.uuid4().hex
+        room = backend.create_room(owner)
+        backend.join_room(room, guest)
+        rooms.append((room, owner, guest))
+    return rooms
+
+
+def churn(backend, rooms):
+    """Every member connects and disconnects with new sockets."""
+    for room, owner, guest in rooms:
+        sockets = [Subscriber(owner), Subscriber(guest), Subscriber(owner)]
+        backend.add_subscriber(room, sockets[0])
+        backend.add_subscriber(room, sockets[1])
+        backend.add_subscriber(owner, sockets[2])
+        list(backend.get_subscribers(channel=uuid.uuid4().hex))
+        backend.remove_subscriber(owner, sockets[2])
+        backend.remove_subscriber(room, sockets[1])
+        backend.remove_subscriber(room, sockets[0])
+
+
+def subscribe_cost(backend, size, repeat=10000):
+    """Average seconds for one add/remove pair in a channel of the given size."""
+    channel = uuid.uuid4().hex
+    members = [Subscriber() for _ in range(size)]
+    for member in members:
+        backend.add_subscriber(channel, member)
+    subscriber = Subscriber()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        backend.add_subscriber(channel, subscriber)
+        backend.remove_subscriber(channel, members[0])
+        backend.remove_subscriber(channel, subscriber)
+        backend.add_subscriber(channel, members[0])
+    elapsed = time.perf_counter() - start
+    for member in members:
+        backend.remove_subscriber(channel, member)
+    return elapsed / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', default=100000, type=int)
+    parser.add_argument('--rounds', default=5, type=int)
+    args = parser.parse_args()
+
+    backend = Backend()
+    rooms = create_rooms(backend, args.rooms)
+    tracemalloc.start()
+    for number in range(args.rounds):
+        start = time.perf_counter()
+        churn(backend, rooms)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        print('churn round {}: {:.2f}us/room, traced memory {:.3f} MiB'.format(
+            number + 1, elapsed / args.rooms * 1e6, current / 2 ** 20))
+    tracemalloc.stop()
+
+    for size in (10, 1000, 100000):
+        cost = subscribe_cost(backend, size)
+        print('channel with {:>6} subscribers: {:.3f}us per subscribe/unsubscribe'.format(
+            size, cost / 2 * 1e6))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
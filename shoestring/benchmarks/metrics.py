@@ -0,0 +1,78 @@
+"""CPU overhead of the metrics instrumentation on the broadcast path.
+
+Broadcasts through the memory backend to peers writing to null streams,
+once with the metrics recorded and once with the metric updates replaced
+by no-ops, and reports the difference per broadcast.
+
+    python -m shoestring.benchmarks.metrics --peers 10 --repeat 20000
+"""
+import argparse
+import time
+import uuid
+
+from contextlib import contextmanager
+from unittest import mock
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .. import metrics
+from ..backends.memory import Backend
+from ..handlers import SocketHandler
+from .fanout import make_peer
+
+
+@contextmanager
+def disabled():
+    """Replace counter and histogram updates with no-ops."""
+    with mock.patch.object(metrics.Counter, 'inc', lambda *args, **kwargs: None), \
+            mock.patch.object(metrics.Histogram, 'observe', lambda *args, **kwargs: None):
+        yield
+
+
+def make_socket(backend, channel):
+    socket = SocketHandler.__new__(SocketHandler)
+    socket.backend = backend
+    socket.channel = channel
+    socket.uuid = uuid.uuid4().hex
+    return socket
+
+
+@gen.coroutine
+def run(socket, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        yield socket._broadcast('{"type": "candidate"}')
+    raise gen.Return((time.process_time() - start) / repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', default=10, type=int)
+    parser.add_argument('--repeat', default=20000, type=int)
+    parser.add_argument('--rounds', default=5, type=int, help='Alternating rounds, the fastest counts.')
+    args = parser.parse_args()
+
+    backend = Backend()
+    channel = backend.create_room(uuid.uuid4().hex)
+    for _ in range(args.peers):
+        peer = make_peer()
+        peer.uuid = uuid.uuid4().hex
+        backend.add_subscriber(channel, peer)
+    socket = make_socket(backend, channel)
+    loop = IOLoop.current()
+    bare, instrumented = [], []
+    for _ in range(args.rounds):
+        with disabled():
+            bare.append(loop.run_sync(lambda: run(socket, args.repeat)))
+        instrumented.append(loop.run_sync(lambda: run(socket, args.repeat)))
+    bare, instrumented = min(bare), min(instrumented)
+    backend._expiries.stop()
+    print('{} peers, {} broadcasts'.format(args.peers, args.repeat))
+    print('metrics disabled: {:6.2f}us CPU per broadcast'.format(bare * 1e6))
+    print('metrics enabled:  {:6.2f}us CPU per broadcast ({:+.2f}us, {:+.1%})'.format(
+        instrumented * 1e6, (instrumented - bare) * 1e6, instrumented / bare - 1))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
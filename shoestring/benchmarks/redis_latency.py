@@ -0,0 +1,101 @@
+"""Signaling latency of the blocking and non-blocking Redis backends.
+
+A local proxy adds an artificial round trip time in front of Redis. Pairs of
+peers exchange timestamped messages while other clients keep creating rooms
+and opening/closing sockets, which drives backend calls on the server.
+
+    python -m shoestring.benchmarks.redis_latency --rtt 5 --rooms 20
+"""
+import argparse
+import json
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .base import free_port, run_server, summarize, LatencyProxy, SignalClient
+
+
+BACKENDS = (
+    'shoestring.backends.redis',
+    'shoestring.backends.asyncredis',
+)
+
+
+@gen.coroutine
+def pair(client):
+    """Create a room with two connected peers."""
+    owner = yield client.create_room()
+    guest = yield client.join_room(owner['room'])
+    sender = yield client.connect(owner)
+    receiver = yield client.connect(guest)
+    raise gen.Return((sender, receiver))
+
+
+@gen.coroutine
+def ping(sender, receiver, interval, deadline, samples):
+    """Send timestamped messages and record the delivery latency."""
+    loop = IOLoop.current()
+    while loop.time() < deadline:
+        sender.write_message(json.dumps({'sent': loop.time()}))
+        message = yield receiver.read_message()
+        if message is None:
+            break
+        samples.append(loop.time() - json.loads(message)['sent'])
+        yield gen.Task(loop.add_timeout, loop.time() + interval)
+
+
+@gen.coroutine
+def churn(client, deadline):
+    """Keep the backend busy with room creation and socket open/close."""
+    loop = IOLoop.current()
+    while loop.time() < deadline:
+        info = yield client.create_room()
+        socket = yield client.connect(info)
+        socket.close()
+
+
+@gen.coroutine
+def measure(base_url, rooms, churners, duration, interval):
+    client = SignalClient(base_url)
+    pairs = yield [pair(client) for _ in range(rooms)]
+    deadline = IOLoop.current().time() + duration
+    samples = []
+    workers = [ping(s, r, interval, deadline, samples) for s, r in pairs]
+    workers.extend(churn(client, deadline) for _ in range(churners))
+    yield workers
+    for sender, receiver in pairs:
+        sender.close()
+        receiver.close()
+    raise gen.Return(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--rtt', default=5, type=float, help='Added Redis RTT in milliseconds.')
+    parser.add_argument('--rooms', default=20, type=int)
+    parser.add_argument('--churn', default=4, type=int, help='Concurrent room churn clients.')
+    parser.add_argument('--duration', default=10, type=float)
+    parser.add_argument('--interval', default=0.05, type=float)
+    args = parser.parse_args()
+
+    loop = IOLoop.current()
+    proxy_port = free_port()
+    proxy = LatencyProxy((args.redis_host, args.redis_port), args.rtt / 1000)
+    proxy.listen(proxy_port, address='127.0.0.1')
+    env = {'SHOESTRING_REDIS_URL': 'redis://127.0.0.1:{}/0'.format(proxy_port)}
+    print('Redis RTT +{}ms, {} rooms, {} churn clients'.format(args.rtt, args.rooms, args.churn))
+    for backend in BACKENDS:
+        port = free_port()
+        with run_server(port, backend, env=env):
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            samples = loop.run_sync(lambda: measure(
+                base_url, args.rooms, args.churn, args.duration, args.interval))
+        result = summarize(samples)
+        print('{:<32} n={count:<7} p50={p50:8.2f}ms p99={p99:8.2f}ms max={max:8.2f}ms'.format(
+            backend, **result))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
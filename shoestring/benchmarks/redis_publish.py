@@ -0,0 +1,100 @@
+"""Redis publish throughput with many rooms broadcasting at once.
+
+One node holds the sending socket of every room and a second node a
+receiving socket, so every broadcast is published through Redis. Each
+IOLoop iteration every room sends one message, as when many sockets are
+readable together. Reports delivered messages per second and the mean
+publish pipeline size for each maximum batch size
+(SHOESTRING_REDIS_PUBLISH_BATCH_SIZE), where a batch size of 1 publishes
+each message in its own round trip. Needs a local redis-server or
+SHOESTRING_REDIS_URL.
+
+    python -m shoestring.benchmarks.redis_publish --batch-sizes 1 10 100 --rooms 1000
+"""
+import argparse
+import os
+import uuid
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .. import metrics
+from ..app import get_backend_class
+from ..backends.redis import Backend
+
+
+class Socket(object):
+    """Fake subscriber counting the messages written to it."""
+
+    def __init__(self, state):
+        self.uuid = uuid.uuid4().hex
+        self.state = state
+
+    def write_message(self, message):
+        self.state['received'] += 1
+        if self.state['received'] == self.state['expected']:
+            self.state['done'].set_result(None)
+
+    def close(self, code=None, reason=None):
+        pass
+
+
+def batch_stats():
+    entry = metrics.REDIS_PUBLISH_BATCH_SIZE.values.get((), [[0], 0.0])
+    return sum(entry[0]), entry[1]
+
+
+@gen.coroutine
+def measure(backend_name, batch_size, delay, room_count, rounds):
+    os.environ[Backend.BATCH_SIZE_ENV_KEY] = str(batch_size)
+    os.environ[Backend.BATCH_DELAY_ENV_KEY] = str(delay)
+    backend_class = get_backend_class(backend_name)
+    sender, receiver = backend_class(), backend_class()
+    loop = IOLoop.current()
+    state = {'received': 0, 'expected': room_count * rounds, 'done': Future()}
+    rooms = []
+    for _ in range(room_count):
+        room = uuid.uuid4().hex
+        local, remote = Socket(state), Socket(state)
+        yield gen.maybe_future(sender.add_subscriber(room, local))
+        yield gen.maybe_future(receiver.add_subscriber(room, remote))
+        rooms.append((room, local, remote))
+    # Let pub/sub subscriptions settle
+    yield gen.Task(loop.add_timeout, loop.time() + 1)
+    batches, batched = batch_stats()
+    start = loop.time()
+    for _ in range(rounds):
+        for room, local, remote in rooms:
+            sender.broadcast('x' * 200, room, local.uuid)
+        yield gen.moment
+    yield state['done']
+    elapsed = loop.time() - start
+    count, total = batch_stats()
+    for room, local, remote in rooms:
+        yield gen.maybe_future(sender.remove_subscriber(room, local))
+        yield gen.maybe_future(receiver.remove_subscriber(room, remote))
+    sender.shutdown()
+    receiver.shutdown()
+    raise gen.Return((state['expected'] / elapsed, (total - batched) / max(1, count - batches)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', default='shoestring.backends.redis',
+                        choices=['shoestring.backends.redis', 'shoestring.backends.asyncredis'])
+    parser.add_argument('--batch-sizes', nargs='+', default=[1, 10, 100, 1000], type=int)
+    parser.add_argument('--delay', default=0, type=float, help='Maximum batch delay in ms')
+    parser.add_argument('--rooms', default=1000, type=int)
+    parser.add_argument('--rounds', default=20, type=int)
+    args = parser.parse_args()
+
+    loop = IOLoop.current()
+    for batch_size in args.batch_sizes:
+        rate, mean = loop.run_sync(lambda: measure(
+            args.backend, batch_size, args.delay, args.rooms, args.rounds))
+        print('batch size {:>5} {:>10.0f} msg/s {:>8.1f} msg/pipeline'.format(batch_size, rate, mean))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
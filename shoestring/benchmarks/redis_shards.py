@@ -0,0 +1,81 @@
+"""Incoming Redis pub/sub throughput as the number of subscriber shards grows.
+
+A backend subscribes one fake socket to each of a number of channels while a
+thread floods those channels through a redis-py pipeline. The receive rate is
+reported for each shard count (SHOESTRING_REDIS_PUBSUB_SHARDS). Needs a
+local redis-server or SHOESTRING_REDIS_URL.
+
+    python -m shoestring.benchmarks.redis_shards --shards 1 2 4 8 --channels 200
+"""
+import argparse
+import json
+import os
+import threading
+import uuid
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from ..backends.redis import Backend
+
+
+class Counter(object):
+    """Fake subscriber counting the messages written to it."""
+
+    def __init__(self, state):
+        self.uuid = uuid.uuid4().hex
+        self.state = state
+
+    def write_message(self, message):
+        self.state['received'] += 1
+        if self.state['received'] == self.state['expected']:
+            self.state['done'].set_result(None)
+
+
+def flood(publisher, channels, messages, batch=1000):
+    payload = json.dumps({'sender': 'bench', 'message': 'x' * 200})
+    pipe = publisher.pipeline(transaction=False)
+    for i in range(messages):
+        pipe.publish(channels[i % len(channels)], payload)
+        if i % batch == batch - 1:
+            pipe.execute()
+    pipe.execute()
+
+
+@gen.coroutine
+def measure(shards, channel_count, messages):
+    os.environ[Backend.SHARDS_ENV_KEY] = str(shards)
+    backend = Backend()
+    loop = IOLoop.current()
+    state = {'received': 0, 'expected': messages, 'done': Future()}
+    channels = [uuid.uuid4().hex for _ in range(channel_count)]
+    for channel in channels:
+        backend.subscriber.subscribe(channel, Counter(state))
+    # Let pub/sub subscriptions settle
+    yield gen.Task(loop.add_timeout, loop.time() + 1)
+    start = loop.time()
+    thread = threading.Thread(target=flood, args=(backend.publisher, channels, messages))
+    thread.start()
+    yield state['done']
+    elapsed = loop.time() - start
+    thread.join()
+    backend.shutdown()
+    raise gen.Return(messages / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', nargs='+', default=[1, 2, 4, 8], type=int)
+    parser.add_argument('--channels', default=200, type=int)
+    parser.add_argument('--messages', default=100000, type=int)
+    args = parser.parse_args()
+
+    loop = IOLoop.current()
+    for shards in args.shards:
+        rate = loop.run_sync(lambda: measure(shards, args.channels, args.messages))
+        print('{:>3} shards {:>10.0f} msg/s'.format(shards, rate))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
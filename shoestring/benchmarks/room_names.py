@@ -0,0 +1,74 @@
+"""Room creation latency of the memory backend as the name space fills up.
+
+Fills a backend to each occupancy of the five digit room names and times
+creating further rooms. The old approach, drawing random names until one
+is unused, is timed on the same rooms for comparison. Widening is disabled
+so the occupancy stays at the measured level.
+
+    python -m shoestring.benchmarks.room_names --rooms 2000
+"""
+import argparse
+import time
+
+from ..backends.base import BaseBackend
+from ..backends.memory import Backend as MemoryBackend
+from .base import summarize
+
+
+OCCUPANCY = (0.1, 0.5, 0.95)
+
+
+def retry_create(backend):
+    """Room creation drawing names until an unused one is found."""
+    room = BaseBackend._get_random_name(backend)
+    while room in backend._rooms:
+        room = BaseBackend._get_random_name(backend)
+    backend._rooms[room] = {}
+    return room
+
+
+def retry_remove(backend, room):
+    del backend._rooms[room]
+
+
+def allocator_create(backend):
+    return backend.create_room('bench')
+
+
+def allocator_remove(backend, room):
+    del backend._rooms[room]
+    backend._names.release(room)
+
+
+def measure(create, remove, occupancy, rooms):
+    backend = MemoryBackend()
+    backend._names.widen_at = 1
+    size = 9 * 10 ** (backend._names.length - 1)
+    for _ in range(int(size * occupancy)):
+        backend.create_room('bench')
+    samples = []
+    for _ in range(rooms):
+        start = time.perf_counter()
+        room = create(backend)
+        samples.append(time.perf_counter() - start)
+        # Keep the occupancy level for the next sample
+        remove(backend, room)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', default=2000, type=int, help='Rooms created per occupancy level.')
+    args = parser.parse_args()
+
+    for occupancy in OCCUPANCY:
+        for name, create, remove in (
+                ('retry', retry_create, retry_remove),
+                ('allocator', allocator_create, allocator_remove)):
+            result = measure(create, remove, occupancy, args.rooms)
+            print('{:>4.0%} occupied {:<10} p50={p50:.4f}ms p99={p99:.4f}ms max={max:.4f}ms'.format(
+                occupancy, name, **result))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
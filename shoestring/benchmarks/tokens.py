@@ -0,0 +1,81 @@
+"""CPU cost of minting and verifying room tokens.
+
+Reports mint and verify rates of JWT and compact room tokens, then compares
+verifying every token with the verified token cache, replaying handshakes
+where each token is used for a number of connections (the room channel,
+the user's own channel and reconnects).
+
+    python -m shoestring.benchmarks.tokens --tokens 1000 --reuse 4
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+import jwt
+
+from ..tokens import CompactTokens, TokenCache
+
+
+SECRET = 'benchmark-secret'
+
+
+def make_tokens(count):
+    expires = datetime.datetime.utcnow() + datetime.timedelta(hours=8)
+    return [jwt.encode({'room': str(random.randint(10000, 99999)), 'uuid': uuid.uuid4().hex,
+                        'exp': expires}, SECRET).decode('utf-8') for _ in range(count)]
+
+
+def mint_jwt(room, user, expires):
+    return jwt.encode({'room': room, 'uuid': user, 'exp': expires}, SECRET).decode('utf-8')
+
+
+def rate(func, args):
+    """Calls per second of func over the argument tuples."""
+    start = time.process_time()
+    for arg in args:
+        func(*arg)
+    return len(args) / (time.process_time() - start)
+
+
+def compare_formats(count):
+    compact = CompactTokens(SECRET)
+    expires = int(time.time()) + 8 * 3600
+    claims = [(str(random.randint(10000, 99999)), uuid.uuid4().hex, expires) for _ in range(count)]
+    for name, mint, verify in (
+            ('jwt', mint_jwt, lambda token: jwt.decode(token, SECRET)),
+            ('compact', compact.encode, compact.decode)):
+        tokens = [(mint(*c), ) for c in claims]
+        print('{:<8} mint {:>9.0f} tokens/s  verify {:>9.0f} tokens/s  {:>3} bytes'.format(
+            name, rate(mint, claims), rate(verify, tokens), len(tokens[0][0])))
+
+
+def run(cache, handshakes):
+    start = time.process_time()
+    for token in handshakes:
+        cache.decode(token)
+    return (time.process_time() - start) / len(handshakes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tokens', default=1000, type=int)
+    parser.add_argument('--reuse', default=4, type=int, help='Handshakes per token.')
+    args = parser.parse_args()
+
+    compare_formats(args.tokens * args.reuse)
+    tokens = make_tokens(args.tokens)
+    handshakes = tokens * args.reuse
+    random.shuffle(handshakes)
+    uncached = run(TokenCache(SECRET, max_size=0), handshakes)
+    cache = TokenCache(SECRET, max_size=len(tokens))
+    cached = run(cache, handshakes)
+    print('{} handshakes, {} per token'.format(len(handshakes), args.reuse))
+    print('verify every token: {:6.1f}us CPU per handshake'.format(uncached * 1e6))
+    print('token cache:        {:6.1f}us CPU per handshake ({:.0%} saved, {hits} hits, {misses} misses)'.format(
+        cached * 1e6, 1 - cached / uncached, **cache.stats))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
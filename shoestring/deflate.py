@@ -0,0 +1,173 @@
+import struct
+import zlib
+
+from collections import namedtuple
+
+from tornado.escape import utf8
+from tornado.log import gen_log
+from tornado.websocket import WebSocketProtocol13
+
+
+# Trailer every deflate block flushed with Z_SYNC_FLUSH ends with
+TAIL = b'\x00\x00\xff\xff'
+# Largest message a client may send compressed, guards against zip bombs
+MAX_INFLATED_SIZE = 1024 * 1024
+RSV1 = 0x40
+
+
+class InflateError(ValueError):
+
+    def __init__(self, code, reason):
+        self.code = code
+        self.reason = reason
+        super().__init__('{} ({})'.format(reason, code))
+
+
+DeflateOptions = namedtuple('DeflateOptions', 'level mem_level window_bits min_size')
+
+
+def get_deflate_options(settings):
+    """Compression options from the application settings, None when disabled.
+
+    Raises ValueError for out of range settings.
+    """
+    options = DeflateOptions(
+        level=settings.get('compression_level', 0),
+        mem_level=settings.get('compression_mem_level', 8),
+        window_bits=settings.get('compression_window_bits', 15),
+        min_size=settings.get('compression_min_size', 256))
+    if not 0 <= options.level <= 9:
+        raise ValueError('Compression level must be between 0 and 9.')
+    if not 1 <= options.mem_level <= 9:
+        raise ValueError('Compression memory level must be between 1 and 9.')
+    if not 9 <= options.window_bits <= 15:
+        raise ValueError('Compression window bits must be between 9 and 15.')
+    if options.min_size < 0:
+        raise ValueError('Compression minimum size must not be negative.')
+    return options if options.level else None
+
+
+def parse_extensions(header):
+    """Split a Sec-WebSocket-Extensions header into (name, params) offers."""
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            params[key.strip()] = value.strip().strip('"') or None
+        offers.append((parts[0], params))
+    return offers
+
+
+def negotiate(header, options):
+    """Accept the first usable permessage-deflate offer.
+
+    Returns the options to compress with and the response header or None.
+    The server never takes over the compression context between messages,
+    so the compressed frame of a message can be shared by every socket with
+    the same options, and asks the client to do the same so no inflate
+    state is kept per connection.
+    """
+    known = {'server_no_context_takeover', 'client_no_context_takeover',
+             'server_max_window_bits', 'client_max_window_bits'}
+    for name, params in parse_extensions(header or ''):
+        if name != 'permessage-deflate' or not set(params) <= known:
+            continue
+        window_bits = options.window_bits
+        if 'server_max_window_bits' in params:
+            try:
+                window_bits = min(window_bits, int(params['server_max_window_bits']))
+            except (TypeError, ValueError):
+                continue
+        if window_bits < 9:
+            # zlib can't produce raw deflate streams with a 256 byte window
+            continue
+        response = 'permessage-deflate; server_no_context_takeover; client_no_context_takeover'
+        if window_bits < 15:
+            response += '; server_max_window_bits={}'.format(window_bits)
+        return options._replace(window_bits=window_bits), response
+    return None
+
+
+def deflate(data, options):
+    """Compress a message payload on its own as a permessage-deflate body."""
+    compressor = zlib.compressobj(
+        options.level, zlib.DEFLATED, -options.window_bits, options.mem_level)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-len(TAIL)]
+
+
+def inflate(data, max_size=MAX_INFLATED_SIZE):
+    """Decompress a message body, raising InflateError if it is too big or invalid."""
+    decompressor = zlib.decompressobj(-15)
+    try:
+        result = decompressor.decompress(data + TAIL, max_size)
+    except zlib.error as e:
+        raise InflateError(code=1007, reason='Invalid compressed message.') from e
+    if decompressor.unconsumed_tail:
+        raise InflateError(code=1009, reason='Compressed message too big.')
+    return result
+
+
+class DeflateProtocol(WebSocketProtocol13):
+    """RFC 6455 protocol with the permessage-deflate extension (RFC 7692).
+
+    Tornado 4.0 aborts connections on frames with reserved bits set, this
+    accepts RSV1 on the first frame of compressed messages and inflates them
+    before they reach the handler. Outgoing frames are compressed by the
+    handler, see ``SocketHandler.write_message``.
+    """
+
+    def __init__(self, handler, options, extension_header):
+        super().__init__(handler)
+        self.deflate = options
+        self.extension_header = extension_header
+        self._compressed = False
+
+    def _accept_connection(self):
+        # Same as WebSocketProtocol13 plus the extension response header
+        subprotocol_header = ''
+        subprotocols = self.request.headers.get('Sec-WebSocket-Protocol', '')
+        subprotocols = [s.strip() for s in subprotocols.split(',')]
+        if subprotocols:
+            selected = self.handler.select_subprotocol(subprotocols)
+            if selected:
+                assert selected in subprotocols
+                subprotocol_header = 'Sec-WebSocket-Protocol: %s\r\n' % selected
+        self.stream.write(utf8(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n'
+            'Sec-WebSocket-Extensions: %s\r\n'
+            '%s'
+            '\r\n' % (self._challenge_response(), self.extension_header, subprotocol_header)))
+        self._run_callback(self.handler.open, *self.handler.open_args, **self.handler.open_kwargs)
+        self._receive_frame()
+
+    def _on_frame_start(self, data):
+        header, length = struct.unpack('BB', data)
+        opcode = header & 0xf
+        if header & RSV1:
+            # Only the first frame of a data message may be marked compressed
+            if opcode & 0x8 or opcode == 0:
+                self._abort()
+                return
+            self._compressed = True
+            data = struct.pack('BB', header & ~RSV1, length)
+        elif opcode in (0x1, 0x2):
+            self._compressed = False
+        super()._on_frame_start(data)
+
+    def _handle_message(self, opcode, data):
+        if opcode in (0x1, 0x2) and self._compressed:
+            try:
+                data = inflate(data)
+            except InflateError as e:
+                gen_log.debug('Rejected compressed websocket message: %s', e)
+                self.close(code=e.code, reason=e.reason)
+                return
+        super()._handle_message(opcode, data)
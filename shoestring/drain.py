@@ -0,0 +1,71 @@
+import logging
+import math
+import random
+
+from collections import deque
+
+from tornado.ioloop import IOLoop
+
+from . import metrics
+
+
+class DrainScheduler(object):
+    """Close sockets in rate limited batches spread over a time window.
+
+    Sockets are closed least recently active first, a batch every
+    ``INTERVAL`` seconds, so clients reconnect to the other nodes a few at
+    a time instead of all at once. The close reason carries a random
+    reconnect delay of up to ``jitter`` milliseconds as ``retry=<ms>``
+    which clients wait before reconnecting.
+    """
+
+    INTERVAL = 0.25
+
+    def __init__(self, subscribers, window, jitter=1000, code=4200, io_loop=None):
+        self.io_loop = io_loop or IOLoop.current()
+        self.window = window
+        self.jitter = jitter
+        self.code = code
+        # Sockets without any activity sort first
+        self.pending = deque(sorted(subscribers, key=lambda s: getattr(s, 'last_active', 0)))
+        self.total = len(self.pending)
+        batches = max(1, math.ceil(window / self.INTERVAL))
+        self.batch_size = max(1, math.ceil(self.total / batches))
+        self.callback = None
+        self._timeout = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def reason(self):
+        return 'Server shutdown. retry={}'.format(random.randint(0, self.jitter))
+
+    def start(self, callback=None):
+        """Start closing sockets, calling back once all of them are closed."""
+        self.callback = callback
+        logging.info('Draining %d connections over %.1fs in batches of %d.',
+                     self.total, self.window, self.batch_size)
+        metrics.DRAIN_REMAINING.set_function(self.__len__)
+        self._close_batch()
+
+    def stop(self):
+        """Stop closing sockets, leaving the rest open."""
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        metrics.DRAIN_REMAINING.remove()
+
+    def _close_batch(self):
+        self._timeout = None
+        for _ in range(min(self.batch_size, len(self.pending))):
+            subscriber = self.pending.popleft()
+            subscriber.close(code=self.code, reason=self.reason())
+            metrics.DRAIN_CLOSED.inc()
+        if self.pending:
+            self._timeout = self.io_loop.add_timeout(
+                self.io_loop.time() + self.INTERVAL, self._close_batch)
+            return
+        logging.info('Drained %d connections.', self.total)
+        metrics.DRAIN_REMAINING.remove()
+        if self.callback is not None:
+            self.callback()
@@ -0,0 +1,69 @@
+import struct
+
+from tornado.escape import json_encode, utf8
+
+from .deflate import RSV1, deflate as deflate_payload
+
+
+def encode_frame(message, opcode=0x1, deflate=None):
+    """Build an unmasked, final websocket frame as sent by the server.
+
+    With permessage-deflate options messages of at least ``min_size`` bytes
+    are compressed, unless that doesn't make them any smaller.
+    """
+    data = utf8(message)
+    first = 0x80 | opcode
+    if deflate is not None and len(data) >= deflate.min_size:
+        compressed = deflate_payload(data, deflate)
+        if len(compressed) < len(data):
+            data, first = compressed, first | RSV1
+    length = len(data)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + data
+
+
+class EncodedMessage(str):
+    """Text message which caches its websocket frame.
+
+    Broadcasting the same instance to many sockets builds the frame once and
+    writes the same bytes to each stream. Compressed frames are cached per
+    set of permessage-deflate options.
+    """
+
+    @property
+    def frame(self):
+        try:
+            return self._frame
+        except AttributeError:
+            self._frame = encode_frame(self)
+            return self._frame
+
+    def get_frame(self, deflate=None):
+        """Frame of the message compressed with the given options."""
+        if deflate is None:
+            return self.frame
+        try:
+            frames = self._deflated
+        except AttributeError:
+            frames = self._deflated = {}
+        frame = frames.get(deflate)
+        if frame is None:
+            frame = frames[deflate] = encode_frame(self, deflate=deflate)
+        return frame
+
+
+def prepare_message(message):
+    """Wrap text messages which are about to be sent to several peers."""
+    if isinstance(message, str) and not isinstance(message, EncodedMessage):
+        return EncodedMessage(message)
+    return message
+
+
+def sequence_message(seq, message):
+    """Wrap a logged message with its sequence number for resumable sessions."""
+    return EncodedMessage(json_encode({'seq': seq, 'message': message}))
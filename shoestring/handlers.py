@@ -2,15 +2,26 @@ import datetime
 import logging
 import os
 import random
+import time
 import uuid
 
+from collections import deque
 from urllib.parse import urlparse
 
 import jwt
 
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.escape import json_encode
 from tornado.httputil import url_concat
-from tornado.web import RequestHandler, HTTPError
-from tornado.websocket import WebSocketHandler
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.web import RequestHandler, HTTPError, asynchronous
+from tornado.websocket import WebSocketHandler, WebSocketClosedError, WebSocketProtocol13
+
+from . import metrics
+from .deflate import DeflateProtocol, negotiate
+from .frames import encode_frame, sequence_message, EncodedMessage
 
 
 class BackendMixin(object):
@@ -29,7 +40,63 @@ class TokenError(Exception):
 
 
 class SocketHandler(BackendMixin, WebSocketHandler):
-    """Websocket signal handler."""
+    """Websocket signal handler.
+
+    Outgoing frames are written one batch at a time. Frames sent while a
+    batch is still being flushed wait in a queue bounded by the
+    ``outbound_max_messages`` and ``outbound_max_bytes`` settings. When the
+    queue overflows the ``outbound_policy`` setting decides what happens:
+
+    * ``close`` (default) evicts the slow consumer with close code 4400
+    * ``drop`` discards the oldest queued frames
+    * ``coalesce`` discards queued frames identical to the new one and then
+      the oldest frames
+
+    With a ``batch_window`` setting (in milliseconds) incoming messages are
+    held for up to the window and relayed to the channel together as one
+    frame, even when the window holds a single message::
+
+        {"batch": ["<message>", "<message>", ...]}
+
+    where each item is the original message text in the order received.
+
+    With a ``resume_log_size`` setting the backend keeps the last messages
+    of each channel and delivers every message as::
+
+        {"seq": <seq>, "message": "<message>"}
+
+    A client reconnecting with the ``last_seq`` argument gets the messages
+    it missed replayed. Live messages are held back until the replayed ones
+    have been written. A message can arrive both replayed and live, clients
+    drop seqs they have already seen.
+
+    With a ``compression_level`` setting clients offering the
+    permessage-deflate extension get messages of at least
+    ``compression_min_size`` bytes compressed. See
+    :func:`shoestring.deflate.get_deflate_options` for the other settings.
+
+    Sockets opened while the backend can't be reached are closed with code
+    4101 so the client retries later.
+    """
+
+    OUTBOUND_POLICIES = ('close', 'drop', 'coalesce')
+    # Frames and bytes queued by all sockets of the process
+    outbound_totals = {'messages': 0, 'bytes': 0}
+
+    def initialize(self, backend):
+        super().initialize(backend)
+        self._outbound = deque()
+        self._outbound_bytes = 0
+        self._outbound_writing = False
+        self._evicted = False
+        # Live (message, binary) held back while missed messages are replayed
+        self._held = None
+        self._batch = []
+        self._batch_timeout = None
+        # Negotiated permessage-deflate options
+        self._deflate = None
+        # Time of the last message in either direction, idle sockets are drained first
+        self.last_active = 0
 
     def check_origin(self, origin):
         allowed = super().check_origin(origin)
@@ -37,17 +104,51 @@ class SocketHandler(BackendMixin, WebSocketHandler):
         matched = any(parsed.netloc == host for host in self.settings.get('allowed_hosts', []))
         return self.settings.get('debug', False) or allowed or matched
 
+    @asynchronous
+    def get(self, *args, **kwargs):
+        options = self.application.compression
+        if options is None or self.request.headers.get('Sec-WebSocket-Version') != '13':
+            return super().get(*args, **kwargs)
+        negotiated = negotiate(self.request.headers.get('Sec-WebSocket-Extensions'), options)
+        if negotiated is None:
+            return super().get(*args, **kwargs)
+        # Same as WebSocketHandler.get apart from the protocol, which
+        # tornado 4.0 doesn't allow to replace
+        self.open_args = args
+        self.open_kwargs = kwargs
+        headers = self.request.headers
+        if headers.get('Upgrade', '').lower() != 'websocket':
+            self.set_status(400)
+            self.finish('Can "Upgrade" only to "WebSocket".')
+            return
+        connection = [s.strip().lower() for s in headers.get('Connection', '').split(',')]
+        if 'upgrade' not in connection:
+            self.set_status(400)
+            self.finish('"Connection" must be "Upgrade".')
+            return
+        origin = headers.get('Origin', headers.get('Sec-Websocket-Origin'))
+        if origin is not None and not self.check_origin(origin):
+            self.set_status(403)
+            self.finish('Cross origin websockets not allowed')
+            return
+        self.stream = self.request.connection.detach()
+        self.stream.set_close_callback(self.on_connection_close)
+        self._deflate, extension_header = negotiated
+        self.ws_connection = DeflateProtocol(self, self._deflate, extension_header)
+        self.ws_connection.accept_connection()
+
+    @gen.coroutine
     def _get_channel(self):
         token = self.get_argument('token', None)
         if not token:
             raise TokenError(code=4300, reason='Missing token.')
         try:
-            info = jwt.decode(token, self.settings['secret'])
+            info = self.application.tokens.decode(token)
         except (jwt.DecodeError, jwt.ExpiredSignature):
             raise TokenError(code=4000, reason='Invalid token.')
         channel = self.get_argument('channel', None)
         try:
-            members = self.backend.get_room(info['room'])
+            members = yield gen.maybe_future(self.backend.get_room(info['room']))
         except KeyError:
             raise TokenError(code=4300, reason='Invalid channel.')
         else:
@@ -60,38 +161,219 @@ class SocketHandler(BackendMixin, WebSocketHandler):
             else:
                 raise TokenError(code=4300, reason='Invalid channel.')
             uuid = info['uuid']
-            return (channel, uuid)
+            raise gen.Return((channel, uuid))
 
+    @gen.coroutine
     def open(self):
         """Subscribe to channel updates on a new connection."""
+        # Backends may be asynchronous so messages and close events
+        # wait until the subscription has been resolved.
+        metrics.SOCKETS_OPENED.inc()
+        self.channel, self.uuid = None, None
+        self.subscribed = Future()
         try:
-            self.channel, self.uuid = self._get_channel()
+            self.channel, self.uuid = yield self._get_channel()
         except TokenError as e:
             self.channel, self.uuid = None, None
             self.close(code=e.code, reason=e.reason)
+        except self.backend.connection_errors as e:
+            self._backend_unavailable(e)
         else:
+            last_seq = self._last_seq()
+            if last_seq is not None:
+                self._held = []
             try:
-                self.backend.add_subscriber(self.channel, self)
+                yield gen.maybe_future(self.backend.add_subscriber(self.channel, self))
             except ValueError:
                 self.channel, self.uuid = None, None
                 self.close(code=4300, reason='Invalid channel.')
+            except self.backend.connection_errors as e:
+                self._backend_unavailable(e)
+            else:
+                if last_seq is not None:
+                    yield self._resume(last_seq)
+        finally:
+            self._release_held()
+            self.subscribed.set_result(None)
+
+    def _backend_unavailable(self, error):
+        """Close the socket so the client retries once the backend is back."""
+        logging.warning('Backend unavailable, closing socket: %s', error)
+        self.channel, self.uuid = None, None
+        self.close(code=4101, reason='Backend unavailable.')
+
+    def _last_seq(self):
+        """Seq the client resumes after, None when not resuming."""
+        if not self.settings.get('resume_log_size'):
+            return None
+        return self.get_argument('last_seq', None)
+
+    @gen.coroutine
+    def _resume(self, last_seq):
+        """Replay the messages missed since the client's last seen seq."""
+        try:
+            missed = yield gen.maybe_future(self.backend.get_log(self.channel, last_seq))
+        except ValueError:
+            logging.warning('Invalid last seq %r on channel %s.', last_seq, self.channel)
+            return
+        for seq, sender, message in missed:
+            if sender != self.uuid:
+                self._write_message(sequence_message(seq, message))
+
+    def _release_held(self):
+        """Write the live messages received while replaying."""
+        held, self._held = self._held, None
+        for message, binary in held or ():
+            try:
+                self._write_message(message, binary=binary)
+            except WebSocketClosedError:
+                break
 
+    @gen.coroutine
     def on_message(self, message):
         """Broadcast updates to other interested clients."""
+        self.last_active = time.monotonic()
+        yield self.subscribed
         if self.channel is not None and self.uuid is not None:
-            self.backend.broadcast(message, channel=self.channel, sender=self.uuid)
+            window = self.settings.get('batch_window', 0)
+            if window:
+                self._batch.append(message)
+                if self._batch_timeout is None:
+                    loop = IOLoop.current()
+                    self._batch_timeout = loop.add_timeout(
+                        loop.time() + window / 1000, self._flush_batch)
+            else:
+                yield self._broadcast(message)
+
+    @gen.coroutine
+    def _broadcast(self, message):
+        metrics.MESSAGES_BROADCAST.inc()
+        start = time.perf_counter()
+        try:
+            yield gen.maybe_future(
+                self.backend.broadcast(message, channel=self.channel, sender=self.uuid))
+        finally:
+            metrics.BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+    @gen.coroutine
+    def _flush_batch(self):
+        """Relay the messages collected during the batch window."""
+        if self._batch_timeout is not None:
+            IOLoop.current().remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        messages, self._batch = self._batch, []
+        if not messages:
+            return
+        yield self._broadcast(json_encode({'batch': messages}))
+
+    @property
+    def outbound_depth(self):
+        """Messages and bytes queued behind the write currently being flushed."""
+        return len(self._outbound), self._outbound_bytes
 
+    def _track_outbound(self, messages, size):
+        """Account for frames added to (or taken from) the queue."""
+        self._outbound_bytes += size
+        self.outbound_totals['messages'] += messages
+        self.outbound_totals['bytes'] += size
+
+    def _take_outbound(self):
+        """Empty the queue and return its frames."""
+        frames, self._outbound = self._outbound, deque()
+        self._track_outbound(-len(frames), -self._outbound_bytes)
+        return frames
+
+    def write_message(self, message, binary=False):
+        if self._held is not None:
+            # Written once the missed messages have been replayed
+            self._held.append((message, binary))
+            return
+        self._write_message(message, binary=binary)
+
+    def _write_message(self, message, binary=False):
+        """Queue a message, writing the shared frame of an encoded message as is."""
+        connection = self.ws_connection
+        if connection is None or self._evicted:
+            raise WebSocketClosedError()
+        self.last_active = time.monotonic()
+        if not isinstance(connection, WebSocketProtocol13) or connection.mask_outgoing:
+            return super().write_message(message, binary=binary)
+        if isinstance(message, dict):
+            message = json_encode(message)
+        if isinstance(message, EncodedMessage) and not binary:
+            frame = message.get_frame(self._deflate)
+        else:
+            frame = encode_frame(message, opcode=0x2 if binary else 0x1, deflate=self._deflate)
+        try:
+            self._write_frame(frame)
+        except StreamClosedError:
+            connection._abort()
+
+    def _write_frame(self, frame):
+        if not self._outbound_writing:
+            self._outbound_writing = True
+            self.stream.write(frame, callback=self._on_outbound_flushed)
+            return
+        self._outbound.append(frame)
+        self._track_outbound(1, len(frame))
+        max_messages = self.settings.get('outbound_max_messages', 1000)
+        max_bytes = self.settings.get('outbound_max_bytes', 1024 * 1024)
+        if len(self._outbound) > max_messages or self._outbound_bytes > max_bytes:
+            self._outbound_overflow(frame, max_messages, max_bytes)
+
+    def _outbound_overflow(self, frame, max_messages, max_bytes):
+        policy = self.settings.get('outbound_policy', 'close')
+        logging.warning('Slow consumer %s on channel %s: %d messages (%d bytes) queued.',
+                        self.uuid, self.channel, len(self._outbound), self._outbound_bytes)
+        if policy == 'coalesce':
+            kept = deque(f for f in self._outbound if f != frame)
+            kept.append(frame)
+            self._track_outbound(len(kept) - len(self._outbound),
+                                 sum(len(f) for f in kept) - self._outbound_bytes)
+            self._outbound = kept
+        if policy in ('drop', 'coalesce'):
+            while len(self._outbound) > 1 and (
+                    len(self._outbound) > max_messages or self._outbound_bytes > max_bytes):
+                self._track_outbound(-1, -len(self._outbound.popleft()))
+        else:
+            self._evicted = True
+            self._take_outbound()
+            self.close(code=4400, reason='Slow consumer.')
+
+    def _on_outbound_flushed(self):
+        if not self._outbound or self.stream.closed():
+            self._outbound_writing = False
+            self._take_outbound()
+            return
+        frames = self._take_outbound()
+        last = frames.pop()
+        try:
+            for frame in frames:
+                self.stream.write(frame)
+            self.stream.write(last, callback=self._on_outbound_flushed)
+        except StreamClosedError:
+            self._outbound_writing = False
+
+    @gen.coroutine
     def on_close(self):
         """Remove subscription."""
+        metrics.SOCKETS_CLOSED.inc(code=str(self.close_code))
+        # Queued frames will never be written
+        self._take_outbound()
+        yield self.subscribed
         if self.channel is not None:
-            self.backend.remove_subscriber(self.channel, self)
+            yield self._flush_batch()
+            yield gen.maybe_future(self.backend.remove_subscriber(self.channel, self))
 
 
 class RoomHandlerMixin(object):
     """Helper methods for handling rooms."""
 
     def build_room_token(self, room, user):
-        """Build a JSON web token for the room/user."""
+        """Build a JSON web token or compact token for the room/user."""
+        if self.settings.get('token_format', 'jwt') == 'compact':
+            expires = time.time() + datetime.timedelta(hours=8).total_seconds()
+            return self.application.tokens.compact.encode(room, user, expires)
         return jwt.encode({
             'room': room,
             'uuid': user,
@@ -107,9 +389,11 @@ class RoomHandlerMixin(object):
 class CreateRoomHandler(BackendMixin, RoomHandlerMixin, RequestHandler):
     """Create rooms."""
 
+    @gen.coroutine
     def post(self):
         user = uuid.uuid4().hex
-        room = self.backend.create_room(user)
+        room = yield gen.maybe_future(self.backend.create_room(user))
+        metrics.ROOMS_CREATED.inc()
         result = {
             'room': room,
             'user': user,
@@ -122,12 +406,14 @@ class CreateRoomHandler(BackendMixin, RoomHandlerMixin, RequestHandler):
 class GetRoomHandler(BackendMixin, RoomHandlerMixin, RequestHandler):
     """Join room."""
 
+    @gen.coroutine
     def get(self, room):
         user = uuid.uuid4().hex
         try:
-            room = self.backend.join_room(room, user)
+            room = yield gen.maybe_future(self.backend.join_room(room, user))
         except KeyError:
             raise HTTPError(404)
+        metrics.ROOMS_JOINED.inc()
         result = {
             'room': room,
             'user': user,
@@ -142,3 +428,11 @@ class IndexHandler(RequestHandler):
 
     def get(self):
         self.render('index.html')
+
+
+class MetricsHandler(RequestHandler):
+    """Expose metrics in the Prometheus text format."""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.REGISTRY.render())
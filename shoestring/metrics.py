@@ -0,0 +1,222 @@
+"""Process metrics exposed in the Prometheus text format.
+
+Counters and histograms are updated on the hot paths so they only do a
+dict lookup and an addition. Gauges are computed when the metrics are
+collected.
+"""
+import bisect
+import logging
+import time
+
+from collections import OrderedDict
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+    def samples(self):  # pragma: no cover
+        raise NotImplementedError('Define in a subclass.')
+
+    def render(self):
+        lines = self.header()
+        for suffix, labels, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(self.labels, labels, extra), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels) if labels else ()
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '_total', key, (), value
+
+
+class Histogram(Metric):
+    """Distribution of observed values over cumulative buckets."""
+
+    kind = 'histogram'
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or self.BUCKETS)
+        # Label values -> [per bucket counts (last is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels) if labels else ()
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, **labels):
+        entry = self.values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def time(self, **labels):
+        """Context manager observing the duration of the block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield '_bucket', key, [('le', _format_value(bound))], cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Gauge(Metric):
+    """Current value computed by callbacks when the metrics are collected."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # Label values -> callback
+        self.callbacks = OrderedDict()
+
+    def set_function(self, func, **labels):
+        self.callbacks[self._key(labels)] = func
+
+    def remove(self, **labels):
+        self.callbacks.pop(self._key(labels), None)
+
+    def samples(self):
+        for key, func in self.callbacks.items():
+            try:
+                value = func()
+            except Exception:
+                # A broken gauge should not fail the whole collection
+                logging.exception('Failed to collect %s.', self.name)
+                continue
+            if value is not None:
+                yield '', key, (), value
+
+
+class Registry(object):
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+ROOMS_CREATED = REGISTRY.register(Counter(
+    'shoestring_rooms_created', 'Rooms created.'))
+ROOMS_JOINED = REGISTRY.register(Counter(
+    'shoestring_rooms_joined', 'Rooms joined.'))
+SOCKETS_OPENED = REGISTRY.register(Counter(
+    'shoestring_sockets_opened', 'Websocket connections opened.'))
+SOCKETS_CLOSED = REGISTRY.register(Counter(
+    'shoestring_sockets_closed', 'Websocket connections closed by close code.', labels=('code', )))
+MESSAGES_BROADCAST = REGISTRY.register(Counter(
+    'shoestring_messages_broadcast', 'Messages broadcast by sockets.'))
+MESSAGES_DELIVERED = REGISTRY.register(Counter(
+    'shoestring_messages_delivered', 'Messages written to sockets by backends.'))
+BROADCAST_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_broadcast_seconds', 'Time to fan out a message through the backend.'))
+REDIS_COMMAND_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_redis_command_seconds', 'Redis command latency.', labels=('command', )))
+REDIS_PUBLISH_BATCH_SIZE = REGISTRY.register(Histogram(
+    'shoestring_redis_publish_batch_size', 'Messages sent to Redis per publish pipeline.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)))
+REDIS_PUBLISH_DROPPED = REGISTRY.register(Counter(
+    'shoestring_redis_publish_dropped', 'Buffered publishes dropped while Redis was unreachable.'))
+REDIS_DISCONNECTS = REGISTRY.register(Counter(
+    'shoestring_redis_disconnects', 'Lost Redis connections.', labels=('connection', )))
+REDIS_OUTAGE_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_redis_outage_seconds', 'Time until a lost Redis connection was reconnected.',
+    labels=('connection', ), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)))
+REDIS_RECOVERY_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_redis_recovery_seconds',
+    'Time from reconnecting to Redis until subscriptions and buffered publishes were restored.',
+    labels=('connection', )))
+ROOM_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'shoestring_room_cache_lookups', 'Room membership cache lookups by result.', labels=('result', )))
+IOLOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_ioloop_lag_seconds', 'Delay of the watchdog heartbeat on the IOLoop.'))
+TOKEN_VERIFY_SECONDS = REGISTRY.register(Histogram(
+    'shoestring_token_verify_seconds', 'Time to verify a room token signature.'))
+DRAIN_CLOSED = REGISTRY.register(Counter(
+    'shoestring_drain_closed', 'Sockets closed by the shutdown drain.'))
+DRAIN_REMAINING = REGISTRY.register(Gauge(
+    'shoestring_drain_remaining', 'Sockets waiting to be closed by the shutdown drain.'))
+SUBSCRIBERS = REGISTRY.register(Gauge(
+    'shoestring_subscribers', 'Live channel subscribers.', labels=('backend', )))
+ROOMS = REGISTRY.register(Gauge(
+    'shoestring_rooms', 'Rooms held by the backend.', labels=('backend', )))
+OUTBOUND_QUEUED_MESSAGES = REGISTRY.register(Gauge(
+    'shoestring_outbound_queued_messages', 'Messages queued behind pending socket writes.'))
+OUTBOUND_QUEUED_BYTES = REGISTRY.register(Gauge(
+    'shoestring_outbound_queued_bytes', 'Bytes queued behind pending socket writes.'))
@@ -0,0 +1,217 @@
+import errno
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from tornado.ioloop import IOLoop
+
+
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT)
+
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+# File descriptors of listening sockets handed to a new server process
+LISTEN_FDS_ENV_KEY = 'SHOESTRING_LISTEN_FDS'
+# Pipe the new server process writes to once it accepts connections
+READY_FD_ENV_KEY = 'SHOESTRING_READY_FD'
+# Socket of the service manager (systemd) for status notifications
+NOTIFY_SOCKET_ENV_KEY = 'NOTIFY_SOCKET'
+
+_worker_id = None
+
+
+def worker_id():
+    """Return the id of the current worker process or None for the parent."""
+    return _worker_id
+
+
+def bind_worker_sockets(port, address=None, backlog=128):
+    """Bind listening sockets which other workers can also bind with SO_REUSEPORT."""
+    sockets = []
+    flags = socket.AI_PASSIVE
+    infos = socket.getaddrinfo(address, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, flags)
+    for family, socktype, proto, canonname, sockaddr in set(infos):
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except socket.error as e:
+            if e.errno == errno.EAFNOSUPPORT:
+                continue
+            raise
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+def fork_workers(count, max_restarts=100):
+    """Start worker processes and supervise them from the parent.
+
+    Returns the worker id (0 to count - 1) in each child. The parent never
+    returns: it forwards shutdown signals to the workers, restarts workers
+    which exit (also cleanly) until it is shutting down itself and exits
+    once every worker has stopped.
+
+    Workers run in their own process groups so a signal sent to the
+    parent's group, such as Ctrl-C in a terminal, only reaches them once
+    through the parent. A second signal would force a fast shutdown.
+    Under systemd use ``KillMode=mixed`` for the same reason.
+    """
+    assert _worker_id is None
+    if IOLoop.initialized():
+        raise RuntimeError('Cannot start workers after the IOLoop has been created.')
+    logging.info('Starting %d worker processes', count)
+    children = {}
+    stopping = []
+
+    def start_child(number):
+        global _worker_id
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)
+            # Workers install their own shutdown handlers
+            for sig in FORWARDED_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            _worker_id = number
+            return number
+        else:
+            children[pid] = number
+            return None
+
+    def forward(sig, frame):
+        stopping.append(sig)
+        for pid in list(children.keys()):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    for sig in FORWARDED_SIGNALS:
+        signal.signal(sig, forward)
+    for number in range(count):
+        started = start_child(number)
+        if started is not None:
+            return started
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        number = children.pop(pid)
+        if os.WIFSIGNALED(status):
+            logging.warning('Worker %d (pid %d) killed by signal %d',
+                            number, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning('Worker %d (pid %d) exited with status %d',
+                            number, pid, os.WEXITSTATUS(status))
+        else:
+            logging.info('Worker %d (pid %d) stopped', number, pid)
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('Too many worker restarts, giving up.')
+        started = start_child(number)
+        if started is not None:
+            return started
+    sys.exit(0)
+
+
+def inherited_sockets():
+    """Listening sockets handed over by the previous server process, if any."""
+    fds = os.environ.pop(LISTEN_FDS_ENV_KEY, None)
+    if not fds:
+        return None
+    sockets = []
+    for fd in fds.split(','):
+        sock = socket.socket(fileno=int(fd))
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def notify_ready():
+    """Tell the previous server process and systemd that this one accepts connections.
+
+    A server started by a hot restart also reports itself as the main
+    process, so systemd keeps the service running once the previous
+    process exits.
+    """
+    fd = os.environ.pop(READY_FD_ENV_KEY, None)
+    if fd is None:
+        sd_notify('READY=1')
+        return
+    # Before the previous process can exit
+    sd_notify('MAINPID={}\nREADY=1'.format(os.getpid()))
+    try:
+        os.write(int(fd), b'1')
+    finally:
+        os.close(int(fd))
+
+
+def sd_notify(state):
+    """Send the state to the service manager if it set a notification socket."""
+    address = os.environ.get(NOTIFY_SOCKET_ENV_KEY)
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state.encode('utf-8'), address)
+    except socket.error as e:
+        logging.warning('Failed to notify the service manager: %s', e)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def spawn_successor(sockets, callback, command=None, env=None, io_loop=None):
+    """Start a new server process on the same listening sockets.
+
+    The sockets are inherited by the new process so connections queue in
+    the kernel's backlog and none are refused while it starts up. The
+    callback is run with True once it accepts connections or with False if
+    it exits first. The command defaults to the one this process runs and
+    the new process gets this process's environment updated with ``env``.
+    """
+    io_loop = io_loop or IOLoop.current()
+    command = command or [sys.executable, '-m', 'shoestring'] + sys.argv[1:]
+    fds = [sock.fileno() for sock in sockets]
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, **(env or {}))
+    env[LISTEN_FDS_ENV_KEY] = ','.join(str(fd) for fd in fds)
+    env[READY_FD_ENV_KEY] = str(write_fd)
+    try:
+        child = subprocess.Popen(command, env=env, pass_fds=fds + [write_fd])
+    finally:
+        os.close(write_fd)
+
+    def on_ready(fd, events):
+        io_loop.remove_handler(read_fd)
+        try:
+            ready = os.read(read_fd, 1) == b'1'
+        finally:
+            os.close(read_fd)
+        if not ready:
+            # Reap the failed process
+            child.poll()
+        callback(ready)
+
+    io_loop.add_handler(read_fd, on_ready, io_loop.READ)
+    logging.info('Started new server process %d', child.pid)
+    return child
@@ -9,7 +9,7 @@ from tornado import gen
 from tornado.options import options
 from tornado.testing import AsyncTestCase, LogTrapTestCase, ExpectLog, gen_test
 
-from ..__main__ import main, shutdown
+from ..__main__ import drain, main, restart, shutdown
 from ..app import ShoestringApplication
 from ..backends.base import BaseBackend
 from ..backends.memory import Backend as MemoryBackend
@@ -53,6 +53,53 @@ class ApplicationTestCase(unittest.TestCase):
         with self.assertRaises(ImportError):
             self.get_app(backend='shoestring.backends.base')
 
+    def test_invalid_outbound_policy(self):
+        """Slow consumer policy must be a known policy."""
+        with self.assertRaises(ValueError):
+            self.get_app(outbound_policy='ignore')
+
+    def test_invalid_token_format(self):
+        """Room tokens must use a known format."""
+        with self.assertRaises(ValueError):
+            self.get_app(token_format='xml')
+
+    def test_drain_shutdown(self):
+        """With a drain window sockets are closed before the backend shuts down."""
+        app = self.get_app(drain_window=5)
+        socket = Mock(uuid='XXX')
+        app.backend.add_subscriber('123', socket)
+        with patch.object(app.backend, 'shutdown') as mock_shutdown:
+            with patch('shoestring.drain.IOLoop'):
+                app.shutdown()
+            self.assertTrue(socket.close.called)
+            mock_shutdown.assert_called_with(graceful=True)
+
+    def test_compression(self):
+        """Compression is disabled unless a level is given."""
+        self.assertIsNone(self.get_app().compression)
+        app = self.get_app(compression_level=6, compression_window_bits=12)
+        self.assertEqual(app.compression.level, 6)
+        self.assertEqual(app.compression.window_bits, 12)
+
+    def test_invalid_compression(self):
+        """Compression settings must be within zlib's ranges."""
+        for invalid in ({'compression_level': 10}, {'compression_mem_level': 0},
+                        {'compression_window_bits': 8}, {'compression_min_size': -1}):
+            settings = {'compression_level': 1}
+            settings.update(invalid)
+            with self.assertRaises(ValueError):
+                self.get_app(**settings)
+
+    def test_resume_log(self):
+        """The resume log size is passed to the backend."""
+        app = self.get_app(resume_log_size=10)
+        self.assertEqual(app.backend.resume_log_size, 10)
+
+    def test_resume_unsupported_backend(self):
+        """Resuming sessions needs a backend which keeps a message log."""
+        with self.assertRaises(ValueError):
+            self.get_app(backend='shoestring.backends.ipc', resume_log_size=10)
+
     def test_shutdown(self):
         """Shutting down the application should shutdown the backend."""
         app = self.get_app()
@@ -66,12 +113,32 @@ class ApplicationTestCase(unittest.TestCase):
 class MainTestCase(AsyncTestCase, LogTrapTestCase):
     """Test application startup and graceful shutdown."""
 
+    def setUp(self):
+        super().setUp()
+        environ = patch.dict('os.environ', {'SHOESTRING_SECRET_KEY': 'XXXX'})
+        environ.start()
+        self.addCleanup(environ.stop)
+
     def get_app_defaults(self):
         """Default options for building the application instance."""
         return  {
             'debug': False,
             'backend': 'shoestring.backends.memory',
             'allowed_hosts': [],
+            'outbound_max_messages': 1000,
+            'outbound_max_bytes': 1024 * 1024,
+            'outbound_policy': 'close',
+            'batch_window': 0,
+            'token_format': 'jwt',
+            'token_cache_size': 10000,
+            'resume_log_size': 0,
+            'compression_level': 0,
+            'compression_mem_level': 8,
+            'compression_window_bits': 15,
+            'compression_min_size': 256,
+            'drain_window': 0,
+            'drain_reconnect_jitter': 1000,
+            'secret': 'XXXX',
         }
 
     @patch('shoestring.__main__.ShoestringApplication')
@@ -118,6 +185,167 @@ class MainTestCase(AsyncTestCase, LogTrapTestCase):
             expected['allowed_hosts'] = ['example.com', ]
             mock_app.assert_called_with(**expected)
 
+    @patch('shoestring.__main__.Watchdog')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_blocking_threshold(self, mock_app, mock_watchdog):
+        """Blocking threshold option should start a watchdog on the backend."""
+        with patch.object(options.mockable(), 'blocking_threshold', 50.0):
+            with patch('shoestring.__main__.parse_command_line'):
+                main(self.io_loop)
+        mock_watchdog.assert_called_with(threshold=0.05, io_loop=self.io_loop)
+        mock_watchdog.return_value.watch.assert_called_with(mock_app.return_value.backend)
+        self.assertTrue(mock_watchdog.return_value.start.called)
+
+    @patch('shoestring.__main__.Watchdog')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_no_watchdog(self, mock_app, mock_watchdog):
+        """The watchdog is disabled by default."""
+        main(self.io_loop)
+        self.assertFalse(mock_watchdog.called)
+
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_workers_process_local_backend(self, mock_app):
+        """Process local backends can't be used with multiple workers."""
+        with patch.object(options.mockable(), 'workers', 2):
+            with patch('shoestring.__main__.fork_workers') as mock_fork:
+                with patch('shoestring.__main__.parse_command_line'):
+                    with self.assertRaises(RuntimeError):
+                        main(self.io_loop)
+                self.assertFalse(mock_fork.called)
+        self.assertFalse(mock_app.called)
+
+    @patch('shoestring.__main__.HTTPServer')
+    @patch('shoestring.__main__.bind_worker_sockets')
+    @patch('shoestring.__main__.fork_workers')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_workers(self, mock_app, mock_fork, mock_bind, mock_server):
+        """Each worker binds its own listening socket after the fork."""
+        mock_fork.return_value = 1
+        mock_bind.return_value = [Mock(), ]
+        with patch.object(options.mockable(), 'workers', 2):
+            with patch.object(options.mockable(), 'backend', 'shoestring.backends.redis'):
+                with patch('shoestring.__main__.parse_command_line'):
+                    main(self.io_loop)
+        mock_fork.assert_called_with(2)
+        mock_bind.assert_called_with(8080)
+        mock_server.return_value.add_sockets.assert_called_with(mock_bind.return_value)
+
+    @patch('shoestring.__main__.HTTPServer')
+    @patch('shoestring.__main__.bind_worker_sockets')
+    @patch('shoestring.__main__.fork_workers')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_workers_share_secret(self, mock_app, mock_fork, mock_bind, mock_server):
+        """Without a configured secret one is generated before forking the workers."""
+        mock_bind.return_value = [Mock(), ]
+        with patch.dict('os.environ'):
+            del os.environ['SHOESTRING_SECRET_KEY']
+            with patch('shoestring.__main__.generate_secret', return_value='YYYY') as mock_generate:
+
+                def fork(count):
+                    self.assertTrue(mock_generate.called)
+                    return 1
+
+                mock_fork.side_effect = fork
+                with patch.object(options.mockable(), 'workers', 2):
+                    with patch.object(options.mockable(), 'backend', 'shoestring.backends.redis'):
+                        with patch('shoestring.__main__.parse_command_line'):
+                            main(self.io_loop)
+        self.assertEqual(mock_generate.call_count, 1)
+        self.assertEqual(mock_app.call_args[1]['secret'], 'YYYY')
+
+    @patch('shoestring.__main__.notify_ready')
+    @patch('shoestring.__main__.inherited_sockets')
+    @patch('shoestring.__main__.HTTPServer')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_inherited_sockets(self, mock_app, mock_server, mock_inherited, mock_ready):
+        """A hot restarted server accepts on the sockets of the previous one."""
+        mock_inherited.return_value = [Mock(), ]
+        with patch('shoestring.__main__.parse_command_line'):
+            main(self.io_loop)
+        mock_server.return_value.add_sockets.assert_called_with(mock_inherited.return_value)
+        self.assertTrue(mock_ready.called)
+
+    @patch('shoestring.__main__.signal.signal')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_restart_signal(self, mock_app, mock_signal):
+        """Hot restarts are enabled for backends shared between processes."""
+        with patch.object(options.mockable(), 'backend', 'shoestring.backends.redis'):
+            with patch('shoestring.__main__.parse_command_line'):
+                main(self.io_loop)
+        signals = [args[0] for args, kwargs in mock_signal.call_args_list]
+        self.assertIn(signal.SIGUSR2, signals)
+
+    @patch('shoestring.__main__.signal.signal')
+    @patch('shoestring.__main__.ShoestringApplication')
+    @gen_test
+    def test_restart_process_local_backend(self, mock_app, mock_signal):
+        """The memory backend's rooms would be lost by a hot restart."""
+        with ExpectLog('', 'Hot restart .* not supported'):
+            main(self.io_loop)
+        signals = [args[0] for args, kwargs in mock_signal.call_args_list]
+        self.assertNotIn(signal.SIGUSR2, signals)
+
+    @patch('shoestring.__main__.drain')
+    @patch('shoestring.__main__.spawn_successor')
+    def test_restart(self, mock_spawn, mock_drain):
+        """The server drains once the new process accepts connections."""
+        server = Mock(_stopping=False, _restarting=False)
+        application = Mock(settings={'secret': 'XXXX'})
+        sockets = [Mock(), ]
+        restart(server, application, sockets, ioloop=self.io_loop)
+        args, kwargs = mock_spawn.call_args
+        self.assertEqual(args[0], sockets)
+        self.assertEqual(kwargs['env'], {'SHOESTRING_SECRET_KEY': 'XXXX'})
+        self.assertFalse(mock_drain.called)
+        restart(server, application, sockets, ioloop=self.io_loop)
+        self.assertEqual(mock_spawn.call_count, 1)
+        args[1](True)
+        mock_drain.assert_called_with(server, application, ioloop=self.io_loop)
+
+    @patch('shoestring.__main__.drain')
+    @patch('shoestring.__main__.spawn_successor')
+    def test_failed_restart(self, mock_spawn, mock_drain):
+        """The server keeps serving when the new process fails to start."""
+        server = Mock(_stopping=False, _restarting=False)
+        restart(server, Mock(settings={'secret': 'XXXX'}), [Mock(), ], ioloop=self.io_loop)
+        args, kwargs = mock_spawn.call_args
+        args[1](False)
+        self.assertFalse(mock_drain.called)
+        self.assertFalse(server._restarting)
+
+    @patch('shoestring.__main__.shutdown')
+    def test_drain(self, mock_shutdown):
+        """Open connections are kept until they close."""
+        server = Mock()
+        application = Mock()
+        application.backend.subscriber_count.side_effect = [2, 1, 0]
+        ioloop = Mock()
+        drain(server, application, ioloop=ioloop)
+        server.stop.assert_called_with()
+        for _ in range(2):
+            self.assertFalse(mock_shutdown.called)
+            args, kwargs = ioloop.add_timeout.call_args
+            args[1]()
+        mock_shutdown.assert_called_with(server, application, graceful=True, ioloop=ioloop)
+
+    @patch('shoestring.__main__.shutdown')
+    def test_drain_timeout(self, mock_shutdown):
+        """Connections still open at the drain timeout are closed."""
+        server = Mock()
+        application = Mock()
+        application.backend.subscriber_count.return_value = 5
+        ioloop = Mock()
+        with patch.object(options.mockable(), 'drain_timeout', 0):
+            drain(server, application, ioloop=ioloop)
+        mock_shutdown.assert_called_with(server, application, graceful=True, ioloop=ioloop)
+
     @gen_test
     def test_graceful_shutdown(self):
         """Trigger graceful shutdown of the server and application."""
@@ -1,16 +1,29 @@
+import json
 import os
+import shutil
+import tempfile
 import time
+import unittest
 import uuid
 
 from contextlib import contextmanager
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.websocket import WebSocketClosedError
-from tornado.testing import AsyncTestCase, gen_test
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from tornadoredis.exceptions import ConnectionError as TornadoRedisConnectionError
 
+from ..backends.asyncredis import Backend as AsyncRedisBackend
+from ..backends.ipc import Backend as IPCBackend, Broker
 from ..backends.memory import Backend as MemoryBackend
-from ..backends.redis import Backend as RedisBackend
+from .. import metrics
+from ..backends.redis import (
+    Backend as RedisBackend, Backoff, InvalidationSubscriber, PublishBatcher, RedisSubscriber,
+    RoomCache, ShardedSubscriber)
 
 
 class BackendAPIMixin(object):
@@ -47,79 +60,89 @@ class BackendAPIMixin(object):
     def pause(self, seconds=0.1):
         yield gen.Task(self.io_loop.add_timeout, time.time() + seconds)
 
+    @gen_test
     def test_create_room(self):
         """Create a new room and return the name."""
-        room = self.backend.create_room('XXX')
+        room = yield gen.maybe_future(self.backend.create_room('XXX'))
         self.assertTrue(isinstance(room, str))
         self.assertGreaterEqual(len(room), 5)
 
+    @gen_test
     def test_join_room(self):
         """Join an existing room and return the name."""
-        room = self.backend.create_room('XXX')
-        result = self.backend.join_room(room, 'YYY')
+        room = yield gen.maybe_future(self.backend.create_room('XXX'))
+        result = yield gen.maybe_future(self.backend.join_room(room, 'YYY'))
         self.assertEqual(room, result)
 
+    @gen_test
     def test_join_room_missing(self):
         """Joining a room which doesn't exist raises a KeyError."""
         with self.assertRaises(KeyError):
-            result = self.backend.join_room('123', 'YYY')
+            result = yield gen.maybe_future(self.backend.join_room('123', 'YYY'))
 
+    @gen_test
     def test_get_room(self):
         """Get a list of members in the room with their subscription status."""
-        room = self.backend.create_room('XXX')
-        result = self.backend.get_room(room)
+        room = yield gen.maybe_future(self.backend.create_room('XXX'))
+        result = yield gen.maybe_future(self.backend.get_room(room))
         self.assertEqual(result, {'XXX': False})
-        self.backend.join_room(room, 'YYY')
-        result = self.backend.get_room(room)
+        yield gen.maybe_future(self.backend.join_room(room, 'YYY'))
+        result = yield gen.maybe_future(self.backend.get_room(room))
         self.assertEqual(result, {'XXX': False, 'YYY': False})
 
+    @gen_test
     def test_get_room_missing(self):
         """Getting a room which doesn't exist raises a KeyError."""
         with self.assertRaises(KeyError):
-            result = self.backend.get_room('123')
+            result = yield gen.maybe_future(self.backend.get_room('123'))
 
+    @gen_test
     def test_add_subscriber(self):
         """Subscribe a websocket to a channel."""
         socket = self.get_socket()
-        self.backend.add_subscriber('123', socket)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
         result = self.backend.get_subscribers(channel='123')
         self.assertEqual(list(result), [socket, ])
 
+    @gen_test
     def test_add_room_subscriber(self):
         """Subscribe a websocket to a room channel."""
         socket = self.get_socket()
-        room = self.backend.create_room(socket.uuid)
-        self.backend.add_subscriber(room, socket)
-        result = self.backend.get_room(room)
+        room = yield gen.maybe_future(self.backend.create_room(socket.uuid))
+        yield gen.maybe_future(self.backend.add_subscriber(room, socket))
+        result = yield gen.maybe_future(self.backend.get_room(room))
         self.assertEqual(result, {socket.uuid: True})
 
+    @gen_test
     def test_add_already_subscribed(self):
         """Sockets cannot subscribe to a room channel more than once."""
         socket = self.get_socket()
-        room = self.backend.create_room(socket.uuid)
-        self.backend.add_subscriber(room, socket)
+        room = yield gen.maybe_future(self.backend.create_room(socket.uuid))
+        yield gen.maybe_future(self.backend.add_subscriber(room, socket))
         with self.assertRaises(ValueError):
-            self.backend.add_subscriber(room, socket)
+            yield gen.maybe_future(self.backend.add_subscriber(room, socket))
 
+    @gen_test
     def test_remove_subscriber(self):
         """Remove websocket subscriber."""
         socket = self.get_socket()
-        self.backend.add_subscriber('123', socket)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
         result = self.backend.get_subscribers(channel='123')
         self.assertEqual(set(result), set([socket, ]))
-        self.backend.remove_subscriber('123', socket)
+        yield gen.maybe_future(self.backend.remove_subscriber('123', socket))
         result = self.backend.get_subscribers(channel='123')
         self.assertEqual(set(result), set([]))
 
+    @gen_test
     def test_remove_room_subscriber(self):
         """Remove websocket subscriber to a room channel and update status."""
         socket = self.get_socket()
-        room = self.backend.create_room(socket.uuid)
-        self.backend.add_subscriber(room, socket)
-        result = self.backend.get_room(room)
+        room = yield gen.maybe_future(self.backend.create_room(socket.uuid))
+        yield gen.maybe_future(self.backend.add_subscriber(room, socket))
+        result = yield gen.maybe_future(self.backend.get_room(room))
         self.assertEqual(result, {socket.uuid: True})
-        self.backend.remove_subscriber(room, socket)
-        result = self.backend.get_room(room)
+        yield gen.maybe_future(self.backend.remove_subscriber(room, socket))
+        result = yield gen.maybe_future(self.backend.get_room(room))
         self.assertEqual(result, {socket.uuid: False})
 
     @gen_test
@@ -127,9 +150,9 @@ class BackendAPIMixin(object):
         """Broadcast message to other channel subscribers."""
         socket = self.get_socket()
         peer = self.get_socket()
-        self.backend.add_subscriber('123', socket)
-        self.backend.add_subscriber('123', peer)
-        self.backend.broadcast(message='ping', channel='123', sender=socket.uuid)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
+        yield gen.maybe_future(self.backend.add_subscriber('123', peer))
+        yield gen.maybe_future(self.backend.broadcast(message='ping', channel='123', sender=socket.uuid))
         yield self.pause()
         peer.write_message.assert_called_with('ping')
         self.assertFalse(socket.write_message.called)
@@ -139,9 +162,9 @@ class BackendAPIMixin(object):
         """Broadcast message into single occupied channel."""
         socket = self.get_socket()
         peer = self.get_socket()
-        self.backend.add_subscriber('123', socket)
-        self.backend.add_subscriber('456', peer)
-        self.backend.broadcast(message='ping', channel='123', sender=socket.uuid)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
+        yield gen.maybe_future(self.backend.add_subscriber('456', peer))
+        yield gen.maybe_future(self.backend.broadcast(message='ping', channel='123', sender=socket.uuid))
         yield self.pause()
         self.assertFalse(peer.write_message.called)
         self.assertFalse(socket.write_message.called)
@@ -151,7 +174,7 @@ class BackendAPIMixin(object):
         """Broadcast message into empty channel."""
         socket = self.get_socket()
         peer = self.get_socket()
-        self.backend.broadcast(message='ping', channel='123', sender=socket.uuid)
+        yield gen.maybe_future(self.backend.broadcast(message='ping', channel='123', sender=socket.uuid))
         yield self.pause()
         self.assertFalse(peer.write_message.called)
         self.assertFalse(socket.write_message.called)
@@ -162,32 +185,34 @@ class BackendAPIMixin(object):
         socket = self.get_socket()
         peer = self.get_socket()
         peer.write_message.side_effect = WebSocketClosedError('Already closed.')
-        self.backend.add_subscriber('123', socket)
-        self.backend.add_subscriber('123', peer)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
+        yield gen.maybe_future(self.backend.add_subscriber('123', peer))
         result = self.backend.get_subscribers(channel='123')
         self.assertEqual(set(result), set([socket, peer]))
-        self.backend.broadcast(message='ping', channel='123', sender=socket.uuid)
+        yield gen.maybe_future(self.backend.broadcast(message='ping', channel='123', sender=socket.uuid))
         yield self.pause()
         result = self.backend.get_subscribers(channel='123')
         self.assertEqual(set(result), set([socket]))
 
+    @gen_test
     def test_graceful_shutdown(self):
         """Notify all subscribers when the server is shutting down gracefully."""
         socket = self.get_socket()
         peer = self.get_socket()
-        self.backend.add_subscriber('123', socket)
-        self.backend.add_subscriber('456', peer)
-        self.backend.shutdown(graceful=True)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
+        yield gen.maybe_future(self.backend.add_subscriber('456', peer))
+        yield gen.maybe_future(self.backend.shutdown(graceful=True))
         socket.close.assert_called_with(code=4200, reason='Server shutdown.')
         peer.close.assert_called_with(code=4200, reason='Server shutdown.')
 
+    @gen_test
     def test_fast_shutdown(self):
         """Notify all subscribers when the server is shutting down immediately."""
         socket = self.get_socket()
         peer = self.get_socket()
-        self.backend.add_subscriber('123', socket)
-        self.backend.add_subscriber('456', peer)
-        self.backend.shutdown(graceful=False)
+        yield gen.maybe_future(self.backend.add_subscriber('123', socket))
+        yield gen.maybe_future(self.backend.add_subscriber('456', peer))
+        yield gen.maybe_future(self.backend.shutdown(graceful=False))
         socket.close.assert_called_with(code=4100, reason='Server shutdown.')
         peer.close.assert_called_with(code=4100, reason='Server shutdown.')
 
@@ -196,8 +221,252 @@ class MemoryBackendTestCase(BackendAPIMixin, AsyncTestCase):
 
     backend_class = MemoryBackend
 
+    def test_unknown_channel(self):
+        """Looking up subscribers of an unknown channel doesn't store it."""
+        self.assertEqual(list(self.backend.get_subscribers(channel='123')), [])
+        self.assertNotIn('123', self.backend._subscriptions)
+
+    def test_empty_channel_reclaimed(self):
+        """Channels are removed with their last subscriber."""
+        socket = self.get_socket()
+        peer = self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', peer)
+        self.backend.remove_subscriber('123', socket)
+        self.assertEqual(list(self.backend.get_subscribers(channel='123')), [peer])
+        self.backend.remove_subscriber('123', peer)
+        self.assertNotIn('123', self.backend._subscriptions)
+
+    def test_subscriber_order(self):
+        """Subscribers are kept in the order they subscribed."""
+        sockets = [self.get_socket() for i in range(5)]
+        for socket in sockets:
+            self.backend.add_subscriber('123', socket)
+        self.backend.remove_subscriber('123', sockets[2])
+        del sockets[2]
+        self.assertEqual(list(self.backend.get_subscribers(channel='123')), sockets)
+
+    def test_room_names_unique(self):
+        """Rooms never reuse the name of an existing room."""
+        self.backend._names.length, self.backend._names.widen_at = 1, 1
+        rooms = [self.backend.create_room('XXX') for _ in range(12)]
+        self.assertEqual(len(set(rooms)), 12)
+        self.assertEqual(sorted(rooms[:9]), [str(i) for i in range(1, 10)])
+
+    def test_idle_room_expiry(self):
+        """Rooms without subscribers expire after the room TTL."""
+        room = self.backend.create_room('XXX')
+        self.assertIn(room, self.backend._expiries)
+        self.backend._expire_room(room)
+        with self.assertRaises(KeyError):
+            self.backend.get_room(room)
+
+    def test_subscribed_room_persists(self):
+        """Subscribing clears the expiry until the last subscriber leaves."""
+        first, second = self.get_socket(), self.get_socket()
+        room = self.backend.create_room(first.uuid)
+        self.backend.join_room(room, second.uuid)
+        self.backend.add_subscriber(room, first)
+        self.assertNotIn(room, self.backend._expiries)
+        self.backend.add_subscriber(room, second)
+        self.backend.remove_subscriber(room, first)
+        self.assertNotIn(room, self.backend._expiries)
+        self.backend.remove_subscriber(room, second)
+        self.assertIn(room, self.backend._expiries)
+        self.backend._expire_room(room)
+        with self.assertRaises(KeyError):
+            self.backend.get_room(room)
+
+    def test_expired_name_reused(self):
+        """Names of expired rooms return to the pool."""
+        room = self.backend.create_room('XXX')
+        in_use = self.backend._names.in_use()
+        self.backend._expire_room(room)
+        self.assertEqual(self.backend._names.in_use(), in_use - 1)
+
+    def test_resume_log(self):
+        """Messages are delivered with their seq and kept in the channel log."""
+        self.backend.resume_log_size = 2
+        socket, peer = self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', peer)
+        for message in ('a', 'b', 'c'):
+            self.backend.broadcast(message, channel='123', sender=socket.uuid)
+        args, kwargs = peer.write_message.call_args
+        self.assertEqual(json.loads(args[0]), {'seq': 3, 'message': 'c'})
+        self.assertEqual(self.backend.get_log('123', '0'), [(2, socket.uuid, 'b'), (3, socket.uuid, 'c')])
+        self.assertEqual(self.backend.get_log('123', '2'), [(3, socket.uuid, 'c')])
+        with self.assertRaises(ValueError):
+            self.backend.get_log('123', 'foo')
+
+    def test_resume_log_without_subscribers(self):
+        """Messages sent while a channel has no subscribers are logged."""
+        self.backend.resume_log_size = 10
+        socket = self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.broadcast('a', channel='123', sender='XXX')
+        self.backend.remove_subscriber('123', socket)
+        self.assertIn('123', self.backend._log_expiries)
+        self.backend.broadcast('b', channel='123', sender='XXX')
+        self.assertEqual(self.backend.get_log('123', '1'), [(2, 'XXX', 'b')])
+        self.backend.add_subscriber('123', socket)
+        self.assertNotIn('123', self.backend._log_expiries)
+
+    def test_resume_log_dropped(self):
+        """Channel logs expire without subscribers, seqs keep growing."""
+        self.backend.resume_log_size = 10
+        socket = self.get_socket()
+        self.backend.broadcast('a', channel='123', sender='XXX')
+        self.assertIn('123', self.backend._log_expiries)
+        self.backend._expire_log('123')
+        self.assertEqual(self.backend.get_log('123', '0'), [])
+        self.backend.add_subscriber('123', socket)
+        self.backend.broadcast('b', channel='123', sender='XXX')
+        self.assertEqual(self.backend.get_log('123', '0'), [(2, 'XXX', 'b')])
+        self.backend._expire_log('123')
+        self.assertEqual(self.backend.get_log('123', '0'), [(2, 'XXX', 'b')])
+
+    def test_no_resume_log(self):
+        """Messages are delivered as is without a resume log."""
+        socket, peer = self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', peer)
+        self.backend.broadcast('a', channel='123', sender=socket.uuid)
+        peer.write_message.assert_called_with('a')
+        self.assertEqual(self.backend.get_log('123', '0'), [])
+
+
+class IPCBackendTestCase(BackendAPIMixin, AsyncTestCase):
+
+    backend_class = IPCBackend
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shoestring.sock')
+        with self.environ('SHOESTRING_IPC_PATH', self.path):
+            super().setUp()
+
+    def tearDown(self):
+        self.backend.shutdown()
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    @gen_test
+    def test_shared_broker(self):
+        """Backends using the same socket path share rooms and channels."""
+        with self.environ('SHOESTRING_IPC_PATH', self.path):
+            other = self.backend_class()
+        socket = self.get_socket()
+        peer = self.get_socket()
+        room = yield self.backend.create_room(socket.uuid)
+        yield other.join_room(room, peer.uuid)
+        self.assertIsNotNone(self.backend.broker)
+        self.assertIsNone(other.broker)
+        yield self.backend.add_subscriber(room, socket)
+        yield other.add_subscriber(room, peer)
+        result = yield self.backend.get_room(room)
+        self.assertEqual(result, {socket.uuid: True, peer.uuid: True})
+        yield other.broadcast(message='ping', channel=room, sender=peer.uuid)
+        yield self.pause()
+        socket.write_message.assert_called_with('ping')
+        self.assertFalse(peer.write_message.called)
+        other.shutdown()
+
+    @gen_test
+    def test_broker_failover(self):
+        """Idle processes take over the broker with its rooms and resubscribe."""
+        with self.environ('SHOESTRING_IPC_PATH', self.path):
+            other = self.backend_class()
+        socket, peer = self.get_socket(), self.get_socket()
+        room = yield self.backend.create_room(socket.uuid)
+        yield other.join_room(room, peer.uuid)
+        yield other.add_subscriber(room, peer)
+        self.backend.shutdown()
+        # The idle process becomes the broker without making a request
+        for _ in range(20):
+            if other.broker is not None:
+                break
+            yield self.pause()
+        self.assertIsNotNone(other.broker)
+        with self.environ('SHOESTRING_IPC_PATH', self.path):
+            third = self.backend_class()
+        result = yield third.get_room(room)
+        self.assertEqual(result, {socket.uuid: False, peer.uuid: True})
+        yield third.add_subscriber(room, socket)
+        yield third.broadcast(message='ping', channel=room, sender=socket.uuid)
+        yield self.pause()
+        peer.write_message.assert_called_with('ping')
+        third.shutdown()
+        other.shutdown()
+
+    @gen_test
+    def test_room_count(self):
+        """Processes other than the broker's count the rooms in the background."""
+        with self.environ('SHOESTRING_IPC_PATH', self.path):
+            other = self.backend_class()
+        yield self.backend.create_room('XXX')
+        yield other.create_room('YYY')
+        self.assertEqual(self.backend.room_count(), 2)
+        self.assertIsNone(other.room_count())
+        yield self.pause()
+        self.assertEqual(other.room_count(), 2)
+        other.shutdown()
+
+    def test_broker_state(self):
+        """Brokers save their rooms and load the rooms of the previous broker."""
+        state_path = os.path.join(self.tempdir, 'broker.state')
+        broker = Broker(state_path=state_path)
+        broker.rooms._names.length = 3
+        room = broker.rooms.create_room('XXX')
+        broker.rooms.join_room(room, 'YYY')
+        broker.stop()
+        self.assertIsNone(broker.rooms._expiries._periodic)
+        successor = Broker(state_path=state_path)
+        self.assertEqual(successor.rooms.get_room(room), {'XXX': False, 'YYY': False})
+        self.assertEqual(successor.rooms._names.in_use(3), 1)
+        self.assertIn(room, successor.rooms._expiries)
+        successor.stop()
+
+    def test_broker_state_expiry(self):
+        """Expired rooms are left out of the next snapshot."""
+        state_path = os.path.join(self.tempdir, 'broker.state')
+        broker = Broker(state_path=state_path)
+        expired = broker.rooms.create_room('XXX')
+        kept = broker.rooms.create_room('YYY')
+        broker._save()
+        broker.rooms._expire_room(expired)
+        self.assertTrue(broker.rooms.changed)
+        broker.stop()
+        successor = Broker(state_path=state_path)
+        self.assertEqual(successor.rooms.get_room(kept), {'YYY': False})
+        with self.assertRaises(KeyError):
+            successor.rooms.get_room(expired)
+        successor.stop()
 
-class RedisBackendTestCase(BackendAPIMixin, AsyncTestCase):
+    def test_broker_state_invalid(self):
+        """Brokers start without rooms from an unreadable state file."""
+        state_path = os.path.join(self.tempdir, 'broker.state')
+        with open(state_path, 'w') as f:
+            f.write('{')
+        broker = Broker(state_path=state_path)
+        self.assertEqual(broker.rooms.room_count(), 0)
+        broker.stop()
+
+
+class RedisKeysMixin(object):
+    """Removes the keys left in Redis by each test."""
+
+    def tearDown(self):
+        info = RedisBackend.parse_redis_parameters(self.backend)
+        client = Redis(db=info.pop('db', 0), **info)
+        keys = list(client.scan_iter('shoestring-*'))
+        if keys:
+            client.delete(*keys)
+        client.connection_pool.disconnect()
+        super().tearDown()
+
+
+class RedisBackendTestCase(RedisKeysMixin, BackendAPIMixin, AsyncTestCase):
 
     backend_class = RedisBackend
 
@@ -236,8 +505,889 @@ class RedisBackendTestCase(BackendAPIMixin, AsyncTestCase):
         with self.environ('SHOESTRING_REDIS_URL', url):
             self.assertEqual(self.backend.parse_redis_parameters(), expected)
 
+    def test_room_expiry(self):
+        """Rooms only expire once the last subscribed member leaves."""
+        socket = self.get_socket()
+        peer = self.get_socket()
+        room = self.backend.create_room(socket.uuid)
+        self.backend.join_room(room, peer.uuid)
+        key = self.backend._room_key(room)
+        self.assertGreater(self.backend.publisher.ttl(key), 0)
+        self.backend.add_subscriber(room, socket)
+        self.backend.add_subscriber(room, peer)
+        self.assertIsNone(self.backend.publisher.ttl(key))
+        self.backend.remove_subscriber(room, socket)
+        self.assertIsNone(self.backend.publisher.ttl(key))
+        self.backend.remove_subscriber(room, peer)
+        self.assertGreater(self.backend.publisher.ttl(key), 0)
+        self.assertFalse(self.backend.publisher.exists(self.backend._count_key(room)))
+
+    def test_room_count(self):
+        """Rooms are counted until they expire, subscribed rooms never do."""
+        socket = self.get_socket()
+        room = self.backend.create_room(socket.uuid)
+        other = self.backend.create_room('YYY')
+        self.assertEqual(self.backend.room_count(), 2)
+        self.backend.add_subscriber(room, socket)
+        scores = self.backend.publisher.zrange(self.backend.ROOMS_KEY, 0, -1, withscores=True)
+        self.assertEqual(dict(scores)[self.backend._room_key(room).encode('utf-8')], float('inf'))
+        # Expire the other room
+        self.backend.publisher.delete(self.backend._room_key(other))
+        self.backend.publisher.zadd(self.backend.ROOMS_KEY, **{self.backend._room_key(other): 1})
+        self.assertEqual(self.backend.room_count(), 1)
+        self.backend.remove_subscriber(room, socket)
+        self.assertEqual(self.backend.room_count(), 1)
+        # Creating a room drops the expired ones from the index
+        self.backend.create_room('ZZZ')
+        self.assertEqual(self.backend.publisher.zcard(self.backend.ROOMS_KEY), 2)
+
+    def test_remove_unsubscribed_member(self):
+        """Removing a member which never subscribed leaves the count alone."""
+        socket = self.get_socket()
+        peer = self.get_socket()
+        room = self.backend.create_room(socket.uuid)
+        self.backend.add_subscriber(room, socket)
+        self.backend.remove_subscriber(room, peer)
+        key = self.backend._room_key(room)
+        self.assertIsNone(self.backend.publisher.ttl(key))
+        self.assertEqual(self.backend.get_room(room), {socket.uuid: True})
+
     def test_invalid_db(self):
         """DB must be a integer."""
         with self.environ('SHOESTRING_REDIS_URL', 'redis://example.com:1234/foo'):
             with self.assertRaises(RuntimeError):
                 self.backend.parse_redis_parameters()
+
+    def test_channel_nodes(self):
+        """Nodes are registered on a channel while they have subscribers."""
+        socket = self.get_socket()
+        peer = self.get_socket()
+        channel = uuid.uuid4().hex
+        key = self.backend._nodes_key(channel)
+        self.backend.add_subscriber(channel, socket)
+        self.backend.add_subscriber(channel, peer)
+        self.assertEqual(self.backend.publisher.smembers(key), {self.backend.node.encode('utf-8')})
+        self.backend.remove_subscriber(channel, socket)
+        self.assertTrue(self.backend.publisher.sismember(key, self.backend.node))
+        self.backend.remove_subscriber(channel, peer)
+        self.assertFalse(self.backend.publisher.sismember(key, self.backend.node))
+
+    def test_publish_for_remote_nodes(self):
+        """Messages are only published when another node has subscribers."""
+        socket = self.get_socket()
+        channel = uuid.uuid4().hex
+        self.backend.add_subscriber(channel, socket)
+        keys, args = self.backend._publish_args(channel, 'ping', 'XXX')
+        self.assertEqual(self.backend.scripts['publish'](keys=keys, args=args), 0)
+        other = self.backend_class()
+        peer = self.get_socket()
+        other.add_subscriber(channel, peer)
+        # Wait for both nodes' pub/sub subscriptions
+        self.io_loop.run_sync(self.pause)
+        self.assertEqual(self.backend.scripts['publish'](keys=keys, args=args), 2)
+        other.remove_subscriber(channel, peer)
+        other.shutdown()
+
+    def test_dead_nodes_skipped(self):
+        """Nodes whose key expired are not published to and leave the node sets."""
+        socket = self.get_socket()
+        channel = uuid.uuid4().hex
+        self.backend.add_subscriber(channel, socket)
+        other = self.backend_class()
+        other.add_subscriber(channel, self.get_socket())
+        keys, args = self.backend._publish_args(channel, 'ping', 'XXX')
+        self.backend.publisher.delete(other._node_key(other.node))
+        self.assertEqual(self.backend.scripts['publish'](keys=keys, args=args), 0)
+        self.assertFalse(self.backend.publisher.sismember(keys[0], other.node))
+        self.assertTrue(self.backend.publisher.sismember(keys[0], self.backend.node))
+
+    def test_node_heartbeat(self):
+        """Heartbeats refresh the node key and the node sets of local channels."""
+        socket = self.get_socket()
+        channel = uuid.uuid4().hex
+        self.backend.add_subscriber(channel, socket)
+        node_key = self.backend._node_key(self.backend.node)
+        nodes_key = self.backend._nodes_key(channel)
+        ttl = self.backend._node_ttl()
+        self.assertTrue(0 < self.backend.publisher.ttl(nodes_key) <= ttl)
+        self.backend.publisher.delete(node_key, nodes_key)
+        self.backend._heartbeat()
+        self.assertTrue(0 < self.backend.publisher.ttl(node_key) <= ttl)
+        self.assertTrue(0 < self.backend.publisher.ttl(nodes_key) <= ttl)
+        self.assertTrue(self.backend.publisher.sismember(nodes_key, self.backend.node))
+
+    def test_shutdown_unregisters_node(self):
+        """Nodes remove their key and node set entries when shutting down."""
+        channel = uuid.uuid4().hex
+        other = self.backend_class()
+        other.add_subscriber(channel, self.get_socket())
+        other.shutdown()
+        self.assertFalse(self.backend.publisher.exists(other._node_key(other.node)))
+        self.assertFalse(self.backend.publisher.sismember(self.backend._nodes_key(channel), other.node))
+
+    @gen_test
+    def test_remote_delivery(self):
+        """Messages reach subscribers on other nodes once."""
+        other = self.backend_class()
+        socket, local, remote = self.get_socket(), self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', local)
+        other.add_subscriber('123', remote)
+        yield self.pause()
+        self.backend.broadcast(message='ping', channel='123', sender=socket.uuid)
+        yield self.pause()
+        local.write_message.assert_called_once_with('ping')
+        remote.write_message.assert_called_once_with('ping')
+        self.assertFalse(socket.write_message.called)
+        other.remove_subscriber('123', remote)
+        other.shutdown()
+
+    @gen_test
+    def test_delivery_after_redis_restart(self):
+        """Nodes register again once Redis is back without their keys."""
+        other = self.backend_class()
+        socket, remote = self.get_socket(), self.get_socket()
+        channel = uuid.uuid4().hex
+        self.backend.add_subscriber(channel, socket)
+        other.add_subscriber(channel, remote)
+        yield self.pause()
+        # Lose all keys and pub/sub connections like a Redis restart
+        self.backend.publisher.delete(*self.backend.publisher.keys('shoestring-*'))
+        self.backend.publisher.execute_command('CLIENT', 'KILL', 'TYPE', 'pubsub')
+        yield self.pause(0.5)
+        self.assertIsNone(other.subscriber.shards[0].outage)
+        self.backend.broadcast(message='ping', channel=channel, sender=socket.uuid)
+        yield self.pause()
+        remote.write_message.assert_called_once_with('ping')
+        other.remove_subscriber(channel, remote)
+        other.shutdown()
+
+    @gen_test
+    def test_resume_log(self):
+        """Messages are logged to the channel stream with their seq."""
+        self.backend.resume_log_size = 10
+        other = self.backend_class(resume_log_size=10)
+        socket, local, remote = self.get_socket(), self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', local)
+        other.add_subscriber('123', remote)
+        yield self.pause()
+        self.backend.broadcast('a', channel='123', sender=socket.uuid)
+        self.backend.broadcast('b', channel='123', sender=socket.uuid)
+        yield self.pause()
+        log = self.backend.get_log('123', '0-0')
+        self.assertEqual([(sender, message) for seq, sender, message in log],
+                         [(socket.uuid, 'a'), (socket.uuid, 'b')])
+        for peer in (local, remote):
+            args, kwargs = peer.write_message.call_args
+            self.assertEqual(json.loads(args[0]), {'seq': log[1][0], 'message': 'b'})
+        self.assertEqual(self.backend.get_log('123', log[0][0]), log[1:])
+        other.remove_subscriber('123', remote)
+        other.shutdown()
+
+    @gen_test
+    def test_resume_log_outage(self):
+        """Logged messages are buffered and delivered once Redis is back."""
+        self.backend.resume_log_size = 10
+        socket, peer = self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        self.backend.add_subscriber('123', peer)
+        send = self.backend.batcher.send
+        self.backend.batcher.send = Mock(side_effect=RedisConnectionError('Refused.'))
+        self.backend.broadcast('a', channel='123', sender=socket.uuid)
+        yield self.pause()
+        self.assertIsNotNone(self.backend.batcher.outage)
+        self.assertFalse(peer.write_message.called)
+        self.backend.batcher.send = send
+        self.backend.batcher.flush()
+        yield self.pause()
+        args, kwargs = peer.write_message.call_args
+        self.assertEqual(json.loads(args[0])['message'], 'a')
+        self.assertEqual(len(self.backend.get_log('123', '0-0')), 1)
+
+    def test_removal_outage(self):
+        """Members removed while Redis is unreachable are removed once it is back."""
+        socket = self.get_socket()
+        room = self.backend.create_room(socket.uuid)
+        key = self.backend._room_key(room)
+        self.backend.add_subscriber(room, socket)
+        remove = self.backend.scripts['remove_subscriber']
+        self.backend.scripts['remove_subscriber'] = Mock(side_effect=RedisConnectionError('Refused.'))
+        self.backend.remove_subscriber(room, socket)
+        self.assertEqual(self.backend._removals, {(room, socket.uuid)})
+        self.assertIsNone(self.backend.publisher.ttl(key))
+        self.backend.scripts['remove_subscriber'] = remove
+        self.backend._heartbeat()
+        self.assertEqual(self.backend._removals, set())
+        self.assertGreater(self.backend.publisher.ttl(key), 0)
+
+    def test_resubscribe_after_removal_outage(self):
+        """Members reconnecting after a failed removal can subscribe again."""
+        socket = self.get_socket()
+        room = self.backend.create_room(socket.uuid)
+        self.backend.add_subscriber(room, socket)
+        remove = self.backend.scripts['remove_subscriber']
+        self.backend.scripts['remove_subscriber'] = Mock(side_effect=RedisConnectionError('Refused.'))
+        self.backend.remove_subscriber(room, socket)
+        self.backend.scripts['remove_subscriber'] = remove
+        reconnected = Mock(uuid=socket.uuid)
+        self.backend.add_subscriber(room, reconnected)
+        self.assertEqual(list(self.backend.get_subscribers(room)), [reconnected])
+        self.assertEqual(self.backend._removals, set())
+
+    def test_shard_count(self):
+        """Number of pub/sub connections is configured in the OS environment."""
+        with self.environ('SHOESTRING_REDIS_PUBSUB_SHARDS', None):
+            self.assertEqual(self.backend.parse_shard_count(), 1)
+        with self.environ('SHOESTRING_REDIS_PUBSUB_SHARDS', '4'):
+            self.assertEqual(self.backend.parse_shard_count(), 4)
+            self.assertEqual(len(self.backend_class().subscriber.shards), 4)
+
+    def test_invalid_shard_count(self):
+        """Shard count must be a positive integer."""
+        for value in ('0', 'foo'):
+            with self.environ('SHOESTRING_REDIS_PUBSUB_SHARDS', value):
+                with self.assertRaises(RuntimeError):
+                    self.backend.parse_shard_count()
+
+
+    def test_publish_batch(self):
+        """Publish batch size and delay are configured in the OS environment."""
+        with self.environ('SHOESTRING_REDIS_PUBLISH_BATCH_SIZE', None):
+            with self.environ('SHOESTRING_REDIS_PUBLISH_DELAY', None):
+                self.assertEqual(self.backend.parse_publish_batch(), (100, 0))
+        with self.environ('SHOESTRING_REDIS_PUBLISH_BATCH_SIZE', '10'):
+            with self.environ('SHOESTRING_REDIS_PUBLISH_DELAY', '5'):
+                self.assertEqual(self.backend.parse_publish_batch(), (10, 0.005))
+                self.assertEqual(self.backend_class().batcher.max_size, 10)
+
+    def test_invalid_publish_batch(self):
+        """Batch size must be a positive integer and the delay not negative."""
+        for key, value in (('SHOESTRING_REDIS_PUBLISH_BATCH_SIZE', '0'),
+                           ('SHOESTRING_REDIS_PUBLISH_BATCH_SIZE', 'foo'),
+                           ('SHOESTRING_REDIS_PUBLISH_DELAY', '-1'),
+                           ('SHOESTRING_REDIS_PUBLISH_DELAY', 'foo')):
+            with self.environ(key, value):
+                with self.assertRaises(RuntimeError):
+                    self.backend.parse_publish_batch()
+
+    def test_publish_buffer(self):
+        """Publishes kept during an outage are configured in the OS environment."""
+        with self.environ('SHOESTRING_REDIS_PUBLISH_BUFFER', None):
+            self.assertEqual(self.backend.parse_publish_buffer(), 10000)
+        with self.environ('SHOESTRING_REDIS_PUBLISH_BUFFER', '50'):
+            self.assertEqual(self.backend_class().batcher.max_pending, 50)
+        for value in ('-1', 'foo'):
+            with self.environ('SHOESTRING_REDIS_PUBLISH_BUFFER', value):
+                with self.assertRaises(RuntimeError):
+                    self.backend.parse_publish_buffer()
+
+    def test_room_cache(self):
+        """Room members are read from Redis once while they don't change."""
+        room = self.backend.create_room('XXX')
+        with patch.object(self.backend.publisher, 'hgetall', wraps=self.backend.publisher.hgetall) as mock_hgetall:
+            self.assertEqual(self.backend.get_room(room), {'XXX': False})
+            self.assertEqual(self.backend.get_room(room), {'XXX': False})
+            self.assertEqual(mock_hgetall.call_count, 1)
+            self.backend.join_room(room, 'YYY')
+            self.assertEqual(self.backend.get_room(room), {'XXX': False, 'YYY': False})
+            self.assertEqual(mock_hgetall.call_count, 2)
+
+    @gen_test
+    def test_room_cache_invalidation(self):
+        """Room changes made by other nodes drop the room from the cache."""
+        other = self.backend_class()
+        room = self.backend.create_room('XXX')
+        yield self.pause()
+        self.assertEqual(self.backend.get_room(room), {'XXX': False})
+        other.join_room(room, 'YYY')
+        yield self.pause()
+        self.assertEqual(self.backend.get_room(room), {'XXX': False, 'YYY': False})
+        other.shutdown()
+
+    def test_room_cache_disabled(self):
+        """A room cache TTL of 0 disables the cache."""
+        with self.environ('SHOESTRING_REDIS_ROOM_CACHE_TTL', '0'):
+            backend = self.backend_class()
+        self.assertIsNone(backend.rooms)
+        self.assertIsNone(backend.invalidations)
+        room = backend.create_room('XXX')
+        self.assertEqual(backend.get_room(room), {'XXX': False})
+
+    def test_invalid_room_cache_ttl(self):
+        """Room cache TTL must be a number of seconds."""
+        for value in ('-1', 'foo'):
+            with self.environ('SHOESTRING_REDIS_ROOM_CACHE_TTL', value):
+                with self.assertRaises(RuntimeError):
+                    self.backend.parse_room_cache_ttl()
+
+    @gen_test
+    def test_batched_publish_order(self):
+        """Publishes batched together reach other nodes in order."""
+        other = self.backend_class()
+        socket, remote = self.get_socket(), self.get_socket()
+        self.backend.add_subscriber('123', socket)
+        other.add_subscriber('123', remote)
+        yield self.pause()
+        self.backend.batcher.max_size = 3
+        for i in range(10):
+            self.backend.broadcast(message=str(i), channel='123', sender=socket.uuid)
+        yield self.pause()
+        received = [args[0] for args, kwargs in remote.write_message.call_args_list]
+        self.assertEqual(received, [str(i) for i in range(10)])
+        other.remove_subscriber('123', remote)
+        other.shutdown()
+
+
+class PublishBatcherTestCase(unittest.TestCase):
+    """Outgoing publishes collected into pipelined batches."""
+
+    def setUp(self):
+        self.io_loop = Mock(time=Mock(return_value=0))
+        self.send = Mock(return_value=None)
+        self.batcher = PublishBatcher(self.send, max_size=3, io_loop=self.io_loop)
+
+    def test_end_of_iteration(self):
+        """Without a delay messages are sent once the IOLoop iteration is done."""
+        self.batcher.add('123', 'a', 'XXX')
+        self.batcher.add('456', 'b', 'YYY')
+        self.io_loop.add_callback.assert_called_once_with(self.batcher.flush)
+        self.assertFalse(self.send.called)
+        self.batcher.flush()
+        self.send.assert_called_once_with([('123', 'a', 'XXX'), ('456', 'b', 'YYY')])
+        self.assertEqual(len(self.batcher), 0)
+
+    def test_max_delay(self):
+        """With a delay messages are sent when the first one has waited that long."""
+        batcher = PublishBatcher(self.send, max_size=3, max_delay=0.005, io_loop=self.io_loop)
+        batcher.add('123', 'a', 'XXX')
+        batcher.add('123', 'b', 'XXX')
+        self.io_loop.add_timeout.assert_called_once_with(0.005, batcher.flush)
+        batcher.flush()
+        self.assertEqual(len(self.send.call_args[0][0]), 2)
+
+    def test_max_size(self):
+        """Full batches are sent right away."""
+        for message in 'abcd':
+            self.batcher.add('123', message, 'XXX')
+        self.send.assert_called_once_with([('123', m, 'XXX') for m in 'abc'])
+        self.assertEqual(len(self.batcher), 1)
+
+    def test_max_size_cancels_timeout(self):
+        """Sending a full batch cancels its delayed flush."""
+        batcher = PublishBatcher(self.send, max_size=2, max_delay=1, io_loop=self.io_loop)
+        batcher.add('123', 'a', 'XXX')
+        batcher.add('123', 'b', 'XXX')
+        self.io_loop.remove_timeout.assert_called_once_with(self.io_loop.add_timeout.return_value)
+
+    def test_one_batch_in_flight(self):
+        """Asynchronous batches are sent one after the other, in order."""
+        futures = []
+
+        def send(batch):
+            futures.append((batch, Future()))
+            return futures[-1][1]
+
+        batcher = PublishBatcher(send, max_size=2, io_loop=self.io_loop)
+        for message in 'abcde':
+            batcher.add('123', message, 'XXX')
+        self.assertEqual(len(futures), 1)
+        args, kwargs = self.io_loop.add_future.call_args
+        self.assertEqual(args[0], futures[0][1])
+        futures[0][1].set_result(None)
+        args[1](futures[0][1])
+        self.assertEqual([[m for c, m, s in batch] for batch, f in futures], [['a', 'b'], ['c', 'd']])
+        self.assertEqual(len(batcher), 1)
+
+    def test_nothing_pending(self):
+        """Flushing without pending messages sends nothing."""
+        self.batcher.flush()
+        self.assertFalse(self.send.called)
+
+    def test_outage(self):
+        """Failed batches are kept in order and retried with backoff."""
+        batcher = PublishBatcher(self.send, max_size=2, errors=(IOError, ), io_loop=self.io_loop)
+        disconnects = metrics.REDIS_DISCONNECTS.value(connection='publish')
+        self.send.side_effect = IOError('Connection refused.')
+        batcher.add('123', 'a', 'XXX')
+        batcher.add('123', 'b', 'XXX')
+        self.assertEqual(self.send.call_count, 1)
+        self.assertIsNotNone(batcher.outage)
+        self.assertEqual(metrics.REDIS_DISCONNECTS.value(connection='publish'), disconnects + 1)
+        retry = self.io_loop.add_timeout.call_args[0][1]
+        # Buffered until the retry
+        for message in 'cde':
+            batcher.add('123', message, 'XXX')
+        self.assertEqual(self.send.call_count, 1)
+        self.send.side_effect = None
+        self.send.reset_mock()
+        outages = metrics.REDIS_OUTAGE_SECONDS.count(connection='publish')
+        retry()
+        self.assertIsNone(batcher.outage)
+        self.assertEqual(metrics.REDIS_OUTAGE_SECONDS.count(connection='publish'), outages + 1)
+        self.send.assert_called_once_with([('123', 'a', 'XXX'), ('123', 'b', 'XXX')])
+        self.assertEqual(len(batcher), 3)
+
+    def test_outage_buffer_limit(self):
+        """Only the newest messages are kept during an outage."""
+        batcher = PublishBatcher(self.send, max_size=1, max_pending=2, errors=(IOError, ),
+                                 io_loop=self.io_loop)
+        dropped = metrics.REDIS_PUBLISH_DROPPED.value()
+        self.send.side_effect = IOError('Connection refused.')
+        for message in 'abcd':
+            batcher.add('123', message, 'XXX')
+        self.assertEqual([m for c, m, s in batcher.pending], ['c', 'd'])
+        self.assertEqual(metrics.REDIS_PUBLISH_DROPPED.value(), dropped + 2)
+
+    def test_async_outage(self):
+        """Batches failing asynchronously are retried as well."""
+        future = Future()
+        send = Mock(return_value=future)
+        batcher = PublishBatcher(send, max_size=1, errors=(IOError, ), io_loop=self.io_loop)
+        batcher.add('123', 'a', 'XXX')
+        future.set_exception(IOError('Connection lost.'))
+        self.io_loop.add_future.call_args[0][1](future)
+        self.assertEqual(len(batcher), 1)
+        self.assertIsNotNone(batcher.outage)
+        self.assertTrue(self.io_loop.add_timeout.called)
+
+    def test_results(self):
+        """Result futures are set to the replies for their messages."""
+        self.send.return_value = [1, 2, 3]
+        results = [Future(), Future()]
+        self.batcher.add('123', 'a', 'XXX', result=results[0])
+        self.batcher.add('123', 'b', 'XXX')
+        self.batcher.add('456', 'c', 'XXX', result=results[1])
+        self.assertEqual([result.result() for result in results], [1, 3])
+
+    def test_async_results(self):
+        """Results are set once an asynchronous batch is sent."""
+        future, result = Future(), Future()
+        batcher = PublishBatcher(Mock(return_value=future), max_size=1, io_loop=self.io_loop)
+        batcher.add('123', 'a', 'XXX', result=result)
+        self.assertFalse(result.done())
+        future.set_result(['1-0'])
+        self.io_loop.add_future.call_args[0][1](future)
+        self.assertEqual(result.result(), '1-0')
+
+    def test_dropped_results(self):
+        """Results of messages dropped during an outage are None."""
+        batcher = PublishBatcher(self.send, max_size=1, max_pending=1, errors=(IOError, ),
+                                 io_loop=self.io_loop)
+        self.send.side_effect = IOError('Connection refused.')
+        results = [Future(), Future()]
+        for message, result in zip('ab', results):
+            batcher.add('123', message, 'XXX', result=result)
+        self.assertIsNone(results[0].result())
+        self.assertFalse(results[1].done())
+
+    def test_other_errors(self):
+        """Errors other than lost connections are raised."""
+        batcher = PublishBatcher(self.send, max_size=1, errors=(IOError, ), io_loop=self.io_loop)
+        self.send.side_effect = ValueError('Bad script.')
+        with self.assertRaises(ValueError):
+            batcher.add('123', 'a', 'XXX')
+        self.assertIsNone(batcher.outage)
+
+
+class RoomCacheTestCase(unittest.TestCase):
+    """Room members cached per node."""
+
+    def setUp(self):
+        self.cache = RoomCache(ttl=5, max_size=2)
+
+    def test_hit(self):
+        """Cached rooms are returned until they are invalidated."""
+        hits = metrics.ROOM_CACHE_LOOKUPS.value(result='hit')
+        misses = metrics.ROOM_CACHE_LOOKUPS.value(result='miss')
+        self.assertIsNone(self.cache.get('room:1'))
+        self.cache.add('room:1', {'XXX': True}, self.cache.generation)
+        self.assertEqual(self.cache.get('room:1'), {'XXX': True})
+        self.cache.invalidate('room:1')
+        self.assertIsNone(self.cache.get('room:1'))
+        self.assertEqual(self.cache.stats, {'size': 0, 'hits': 1, 'misses': 2})
+        self.assertEqual(metrics.ROOM_CACHE_LOOKUPS.value(result='hit'), hits + 1)
+        self.assertEqual(metrics.ROOM_CACHE_LOOKUPS.value(result='miss'), misses + 2)
+
+    def test_ttl(self):
+        """Rooms are read again once their TTL has passed."""
+        with patch('shoestring.backends.redis.time.monotonic', return_value=100):
+            self.cache.add('room:1', {'XXX': True}, self.cache.generation)
+        with patch('shoestring.backends.redis.time.monotonic', return_value=105):
+            self.assertIsNotNone(self.cache.get('room:1'))
+        with patch('shoestring.backends.redis.time.monotonic', return_value=106):
+            self.assertIsNone(self.cache.get('room:1'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidated_while_reading(self):
+        """Members read before an invalidation are not cached."""
+        generation = self.cache.generation
+        self.cache.invalidate('room:1')
+        self.cache.add('room:1', {'XXX': True}, generation)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_size(self):
+        """The least recently used room is evicted when the cache is full."""
+        for key in ('room:1', 'room:2'):
+            self.cache.add(key, {}, self.cache.generation)
+        self.cache.get('room:1')
+        self.cache.add('room:3', {}, self.cache.generation)
+        self.assertIsNone(self.cache.get('room:2'))
+        self.assertIsNotNone(self.cache.get('room:1'))
+
+
+def mock_io_loop(subscriber, reachable=True):
+    """Run the subscriber's futures right away and let it find Redis reachable or not."""
+    subscriber.io_loop = Mock(time=Mock(return_value=0))
+    subscriber.io_loop.add_future.side_effect = lambda future, callback: callback(future)
+    probed = Future()
+    probed.set_result(reachable)
+    subscriber._probe = Mock(return_value=probed)
+
+
+class InvalidationSubscriberTestCase(unittest.TestCase):
+    """Room cache invalidations received over pub/sub."""
+
+    def setUp(self):
+        self.client = Mock(subscribed=set())
+        self.cache = RoomCache()
+        self.subscriber = InvalidationSubscriber(self.client, self.cache, 'invalidate')
+        mock_io_loop(self.subscriber)
+        self.cache.add('room:1', {}, self.cache.generation)
+        self.cache.add('room:2', {}, self.cache.generation)
+
+    def test_subscribe(self):
+        """The invalidation channel is subscribed on creation."""
+        self.assertEqual(self.client.subscribe.call_args[0][0], 'invalidate')
+
+    def test_invalidate(self):
+        """Published room keys are dropped from the cache."""
+        self.subscriber.on_message(Mock(kind='message', channel='invalidate', body=b'room:1'))
+        self.assertIsNone(self.cache.get('room:1'))
+        self.assertIsNotNone(self.cache.get('room:2'))
+
+    def test_disconnect(self):
+        """The cache is cleared when invalidations may have been missed."""
+        self.subscriber.on_message(Mock(kind='disconnect', channel={'invalidate'}))
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNotNone(self.subscriber.outage)
+        self.cache.add('room:1', {}, self.cache.generation)
+        self.subscriber.io_loop.add_timeout.call_args[0][1]()
+        self.client.subscribe.call_args[1]['callback'](True)
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.subscriber.outage)
+
+    def test_unreachable(self):
+        """Subscribing is retried when Redis can't be reached at first."""
+        client = Mock(subscribed=set())
+        client.subscribe.side_effect = TornadoRedisConnectionError('Refused.')
+        with patch('shoestring.backends.redis.IOLoop'):
+            subscriber = InvalidationSubscriber(client, self.cache, 'invalidate')
+        self.assertIsNotNone(subscriber.outage)
+        self.assertEqual(dict(subscriber.subscriber_count), {'invalidate': 1})
+
+
+class BackoffTestCase(unittest.TestCase):
+    """Reconnect delays."""
+
+    def test_delays(self):
+        """Delays double up to the maximum with up to half of them as jitter."""
+        backoff = Backoff(initial=1, maximum=4)
+        for step in (1, 2, 4, 4):
+            delay = backoff.delay()
+            self.assertTrue(step / 2 <= delay <= step)
+        backoff.reset()
+        self.assertTrue(backoff.delay() <= 1)
+
+
+class RedisSubscriberTestCase(unittest.TestCase):
+    """Pub/sub connection surviving Redis outages."""
+
+    def setUp(self):
+        self.client = Mock(subscribed=set())
+        self.subscriber = RedisSubscriber(self.client)
+        mock_io_loop(self.subscriber)
+
+    def get_socket(self):
+        return Mock(uuid=uuid.uuid4().hex)
+
+    def disconnect(self):
+        self.subscriber.on_message(Mock(kind='disconnect', channel={'123'}))
+
+    def reconnect(self):
+        args, kwargs = self.subscriber.io_loop.add_timeout.call_args
+        self.subscriber.io_loop.add_timeout.reset_mock()
+        args[1]()
+
+    def test_disconnect(self):
+        """Losing the connection keeps the sockets open and schedules a reconnect."""
+        socket = self.get_socket()
+        self.subscriber.subscribe('123', socket)
+        with patch('signal.alarm') as mock_alarm:
+            self.disconnect()
+        self.assertFalse(mock_alarm.called)
+        self.assertFalse(socket.close.called)
+        self.assertIsNotNone(self.subscriber.outage)
+        self.assertTrue(self.subscriber.io_loop.add_timeout.called)
+
+    def test_resubscribe(self):
+        """Channels with subscribers are subscribed again once Redis is back."""
+        first, second = self.get_socket(), self.get_socket()
+        self.subscriber.subscribe('123', first)
+        self.subscriber.subscribe('456', second)
+        self.disconnect()
+        self.client.subscribe.reset_mock()
+        self.reconnect()
+        self.client.connection.connect.assert_called_with()
+        self.assertEqual(self.client.connection.timeout, RedisSubscriber.CONNECT_TIMEOUT)
+        args, kwargs = self.client.subscribe.call_args
+        self.assertEqual(sorted(args[0]), ['123', '456'])
+        self.assertFalse(self.client.listen.called)
+        recoveries = metrics.REDIS_RECOVERY_SECONDS.count(connection='pubsub')
+        kwargs['callback'](True)
+        self.client.listen.assert_called_with(self.subscriber.on_message)
+        self.assertIsNone(self.subscriber.outage)
+        self.assertEqual(metrics.REDIS_RECOVERY_SECONDS.count(connection='pubsub'), recoveries + 1)
+
+    def test_resubscribed_callback(self):
+        """The node is registered again on the resubscribed channels."""
+        resubscribed = Mock()
+        self.subscriber.resubscribed = resubscribed
+        self.subscriber.subscribe('123', self.get_socket())
+        self.disconnect()
+        self.reconnect()
+        self.assertFalse(resubscribed.called)
+        self.client.subscribe.call_args[1]['callback'](True)
+        resubscribed.assert_called_with({'123'})
+
+    def test_reconnect_failed(self):
+        """Reconnecting is retried while Redis is unreachable."""
+        self.subscriber.subscribe('123', self.get_socket())
+        self.disconnect()
+        self.client.connection.connect.side_effect = TornadoRedisConnectionError('Refused.')
+        self.reconnect()
+        self.assertIsNotNone(self.subscriber.outage)
+        self.assertTrue(self.subscriber.io_loop.add_timeout.called)
+        self.assertEqual(self.subscriber.backoff.attempts, 2)
+
+    def test_redis_unreachable(self):
+        """The client doesn't connect while Redis doesn't accept connections."""
+        mock_io_loop(self.subscriber, reachable=False)
+        self.subscriber.subscribe('123', self.get_socket())
+        self.disconnect()
+        self.reconnect()
+        self.assertFalse(self.client.connection.connect.called)
+        self.assertIsNotNone(self.subscriber.outage)
+        self.assertTrue(self.subscriber.io_loop.add_timeout.called)
+
+    def test_changes_during_outage(self):
+        """Sockets coming and going during an outage are only recorded."""
+        first, second = self.get_socket(), self.get_socket()
+        self.subscriber.subscribe('123', first)
+        self.disconnect()
+        self.client.subscribe.reset_mock()
+        self.subscriber.subscribe('456', second)
+        self.subscriber.unsubscribe('123', first)
+        self.assertFalse(self.client.subscribe.called)
+        self.assertFalse(self.client.unsubscribe.called)
+        self.reconnect()
+        self.assertEqual(self.client.subscribe.call_args[0][0], ['456'])
+
+    def test_changes_during_resubscribe(self):
+        """Sockets coming and going while resubscribing are caught up with."""
+        first, second = self.get_socket(), self.get_socket()
+        self.subscriber.subscribe('123', first)
+        self.disconnect()
+        self.reconnect()
+        callback = self.client.subscribe.call_args[1]['callback']
+        self.client.subscribe.reset_mock()
+        self.subscriber.subscribe('456', second)
+        self.subscriber.unsubscribe('123', first)
+        callback(True)
+        self.client.subscribe.assert_called_with(['456'])
+        self.client.unsubscribe.assert_called_with(['123'])
+
+    def test_close_during_outage(self):
+        """Closing during an outage stops reconnecting."""
+        self.subscriber.subscribe('123', self.get_socket())
+        self.disconnect()
+        self.subscriber.close()
+        self.assertTrue(self.subscriber.io_loop.remove_timeout.called)
+        self.assertFalse(self.client.unsubscribe.called)
+        self.assertEqual(list(self.subscriber.subscribers), [])
+        self.disconnect()
+        self.assertEqual(self.subscriber.io_loop.add_timeout.call_count, 1)
+
+
+class RedisProbeTestCase(AsyncTestCase):
+    """Finding out whether Redis accepts connections without blocking."""
+
+    def setUp(self):
+        super().setUp()
+        self.sock, port = bind_unused_port()
+        self.client = Mock()
+        self.client.connection.unix_socket_path = None
+        self.client.connection.host, self.client.connection.port = '127.0.0.1', port
+        self.subscriber = RedisSubscriber(self.client)
+
+    def tearDown(self):
+        self.sock.close()
+        super().tearDown()
+
+    @gen_test
+    def test_reachable(self):
+        """Redis is reachable once the connection is accepted."""
+        reachable = yield self.subscriber._probe()
+        self.assertTrue(reachable)
+
+    @gen_test
+    def test_refused(self):
+        """Refused connections don't block."""
+        self.sock.close()
+        reachable = yield self.subscriber._probe()
+        self.assertFalse(reachable)
+
+
+class ShardedSubscriberTestCase(unittest.TestCase):
+    """Channel subscriptions spread over pub/sub connections."""
+
+    def setUp(self):
+        self.clients = [Mock(subscribed=True) for _ in range(4)]
+        self.subscriber = ShardedSubscriber(self.clients)
+
+    def get_socket(self):
+        return Mock(uuid=uuid.uuid4().hex)
+
+    def test_shard_by_channel(self):
+        """Each channel is always handled by the same connection."""
+        channels = [str(i) for i in range(10000, 10100)]
+        shards = [self.subscriber.shard(channel) for channel in channels]
+        self.assertEqual(shards, [self.subscriber.shard(channel) for channel in channels])
+        self.assertEqual(set(shards), set(self.subscriber.shards))
+
+    def test_subscribe(self):
+        """Only the channel's connection subscribes to it."""
+        socket = self.get_socket()
+        self.subscriber.subscribe('12345', socket)
+        shard = self.subscriber.shard('12345')
+        for client in self.clients:
+            if client is shard.redis:
+                client.subscribe.assert_called_with('12345', callback=None)
+            else:
+                self.assertFalse(client.subscribe.called)
+        self.assertEqual(list(self.subscriber.get_subscribers('12345')), [socket])
+        self.assertEqual(list(self.subscriber.get_subscribers()), [socket])
+
+    def test_unsubscribe(self):
+        """The channel's connection unsubscribes with the last subscriber."""
+        first, second = self.get_socket(), self.get_socket()
+        self.subscriber.subscribe('12345', first)
+        self.subscriber.subscribe('12345', second)
+        shard = self.subscriber.shard('12345')
+        self.subscriber.unsubscribe('12345', first)
+        self.assertFalse(shard.redis.unsubscribe.called)
+        self.subscriber.unsubscribe('12345', second)
+        shard.redis.unsubscribe.assert_called_with('12345')
+        self.assertEqual(list(self.subscriber.get_subscribers('12345')), [])
+
+    def test_unknown_channel(self):
+        """Looking up a channel without subscribers leaves no entries behind."""
+        self.assertEqual(list(self.subscriber.get_subscribers('99999')), [])
+        self.assertNotIn('99999', self.subscriber.shard('99999').subscribers)
+
+    def test_skip_own_node(self):
+        """Messages published by the subscriber's own node are not delivered again."""
+        subscriber = ShardedSubscriber(self.clients, node='local')
+        socket = self.get_socket()
+        subscriber.subscribe('123', socket)
+        shard = subscriber.shard('123')
+        for node, calls in (('local', 0), ('remote', 1)):
+            body = json.dumps({'sender': 'XXX', 'node': node, 'message': 'ping'})
+            shard.on_message(Mock(kind='message', channel='123', body=body))
+            self.assertEqual(socket.write_message.call_count, calls)
+
+    def test_close(self):
+        """Closing unsubscribes every connection from its channels."""
+        channels = [str(i) for i in range(10000, 10020)]
+        for channel in channels:
+            self.subscriber.subscribe(channel, self.get_socket())
+        self.subscriber.close()
+        unsubscribed = [args[0] for client in self.clients
+                        for args, kwargs in client.unsubscribe.call_args_list]
+        self.assertEqual(sorted(unsubscribed), channels)
+
+
+class AsyncRedisBackendTestCase(RedisKeysMixin, BackendAPIMixin, AsyncTestCase):
+
+    backend_class = AsyncRedisBackend
+
+    @gen_test
+    def test_room_api_is_async(self):
+        """Room API methods return futures rather than blocking."""
+        result = self.backend.create_room('XXX')
+        self.assertTrue(isinstance(result, Future))
+        room = yield result
+        self.assertTrue(isinstance(room, str))
+
+    @gen_test
+    def test_room_count(self):
+        """Rooms are counted in the background."""
+        yield self.backend.create_room('XXX')
+        self.assertIsNone(self.backend.room_count())
+        yield self.pause()
+        self.assertEqual(self.backend.room_count(), 1)
+
+    @gen_test
+    def test_concurrent_add_and_remove(self):
+        """Removing the last subscriber while another is added keeps the node registered."""
+        socket, peer = self.get_socket(), self.get_socket()
+        channel = uuid.uuid4().hex
+        yield self.backend.add_subscriber(channel, socket)
+        added = self.backend.add_subscriber(channel, peer)
+        removed = self.backend.remove_subscriber(channel, socket)
+        yield [added, removed]
+        self.assertEqual(list(self.backend.get_subscribers(channel)), [peer])
+        members = yield gen.Task(self.backend.publisher.smembers, self.backend._nodes_key(channel))
+        self.assertEqual(members, {self.backend.node})
+
+    @gen_test
+    def test_add_subscriber_rollback(self):
+        """Local subscriptions are undone when Redis refuses the subscriber."""
+        socket = self.get_socket()
+        duplicate = Mock(uuid=socket.uuid)
+        room = yield self.backend.create_room(socket.uuid)
+        yield self.backend.add_subscriber(room, socket)
+        with self.assertRaises(ValueError):
+            yield self.backend.add_subscriber(room, duplicate)
+        self.assertEqual(list(self.backend.get_subscribers(room)), [socket])
+
+    @gen_test
+    def test_resubscribe_after_removal_outage(self):
+        """Members reconnecting after a failed removal can subscribe again."""
+        socket = self.get_socket()
+        room = yield self.backend.create_room(socket.uuid)
+        yield self.backend.add_subscriber(room, socket)
+        with patch.object(self.backend, '_command',
+                          side_effect=TornadoRedisConnectionError('Refused.')):
+            yield self.backend.remove_subscriber(room, socket)
+        self.assertEqual(self.backend._removals, {(room, socket.uuid)})
+        reconnected = Mock(uuid=socket.uuid)
+        yield self.backend.add_subscriber(room, reconnected)
+        self.assertEqual(list(self.backend.get_subscribers(room)), [reconnected])
+        self.assertEqual(self.backend._removals, set())
+
+    @gen_test
+    def test_shutdown_unregisters_node(self):
+        """Nodes remove their key and node set entries when shutting down."""
+        channel = uuid.uuid4().hex
+        other = self.backend_class()
+        yield other.add_subscriber(channel, self.get_socket())
+        nodes_key = self.backend._nodes_key(channel)
+        members = yield gen.Task(self.backend.publisher.smembers, nodes_key)
+        self.assertEqual(members, {other.node})
+        other.shutdown()
+        yield self.pause()
+        members = yield gen.Task(self.backend.publisher.smembers, nodes_key)
+        self.assertEqual(members, set())
+        exists = yield gen.Task(self.backend.publisher.exists, other._node_key(other.node))
+        self.assertFalse(exists)
@@ -0,0 +1,81 @@
+import unittest
+import zlib
+
+from ..deflate import DeflateOptions, InflateError, deflate, get_deflate_options, inflate, negotiate
+
+
+OPTIONS = DeflateOptions(level=6, mem_level=8, window_bits=15, min_size=256)
+
+
+class NegotiateTestCase(unittest.TestCase):
+    """Accepting permessage-deflate offers from clients."""
+
+    def test_browser_offer(self):
+        """The offer browsers send is accepted without context takeover."""
+        options, response = negotiate('permessage-deflate; client_max_window_bits', OPTIONS)
+        self.assertEqual(options, OPTIONS)
+        self.assertEqual(
+            response, 'permessage-deflate; server_no_context_takeover; client_no_context_takeover')
+
+    def test_no_offer(self):
+        """Clients which don't offer the extension get uncompressed messages."""
+        self.assertIsNone(negotiate(None, OPTIONS))
+        self.assertIsNone(negotiate('', OPTIONS))
+        self.assertIsNone(negotiate('x-webkit-deflate-frame', OPTIONS))
+
+    def test_server_window_bits(self):
+        """The server window is limited to what the client accepts."""
+        options, response = negotiate('permessage-deflate; server_max_window_bits=10', OPTIONS)
+        self.assertEqual(options.window_bits, 10)
+        self.assertTrue(response.endswith('; server_max_window_bits=10'))
+
+    def test_configured_window_bits(self):
+        """A smaller configured window is announced to the client."""
+        options, response = negotiate('permessage-deflate', OPTIONS._replace(window_bits=12))
+        self.assertEqual(options.window_bits, 12)
+        self.assertTrue(response.endswith('; server_max_window_bits=12'))
+
+    def test_fallback_offer(self):
+        """Unusable offers are skipped for the next one."""
+        header = ('permessage-deflate; server_max_window_bits=8, '
+                  'permessage-deflate; unknown_param, '
+                  'permessage-deflate; server_max_window_bits="11"')
+        options, response = negotiate(header, OPTIONS)
+        self.assertEqual(options.window_bits, 11)
+
+
+class DeflateTestCase(unittest.TestCase):
+    """Compressing and inflating message payloads."""
+
+    def test_round_trip(self):
+        """Compressed payloads are raw deflate without the sync flush tail."""
+        data = b'a=candidate:1 1 UDP 2130706431 192.168.1.10 54321 typ host\r\n' * 20
+        compressed = deflate(data, OPTIONS)
+        self.assertFalse(compressed.endswith(b'\x00\x00\xff\xff'))
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(inflate(compressed), data)
+
+    def test_client_payload(self):
+        """Payloads compressed by a client with context takeover still inflate."""
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        data = compressor.compress(b'hello hello hello') + compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.assertEqual(inflate(data[:-4]), b'hello hello hello')
+
+    def test_too_big(self):
+        """Messages inflating past the limit are rejected."""
+        compressed = deflate(b'\x00' * 10000, OPTIONS)
+        with self.assertRaises(InflateError) as context:
+            inflate(compressed, max_size=1000)
+        self.assertEqual(context.exception.code, 1009)
+
+    def test_invalid(self):
+        """Invalid deflate data is rejected."""
+        with self.assertRaises(InflateError) as context:
+            inflate(b'\xff\xff\xff\xff')
+        self.assertEqual(context.exception.code, 1007)
+
+    def test_settings(self):
+        """Options are read from the application settings."""
+        self.assertIsNone(get_deflate_options({}))
+        options = get_deflate_options({'compression_level': 1, 'compression_min_size': 0})
+        self.assertEqual(options, DeflateOptions(level=1, mem_level=8, window_bits=15, min_size=0))
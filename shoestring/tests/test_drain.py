@@ -0,0 +1,84 @@
+from unittest.mock import Mock, patch
+
+from tornado.testing import AsyncTestCase
+
+from .. import metrics
+from ..drain import DrainScheduler
+
+
+class Subscriber(object):
+
+    def __init__(self, last_active):
+        self.last_active = last_active
+        self.closed = None
+
+    def close(self, code=None, reason=None):
+        self.closed = (code, reason)
+
+
+class DrainSchedulerTestCase(AsyncTestCase):
+    """Closing sockets in batches over a time window."""
+
+    def setUp(self):
+        super().setUp()
+        self.io_loop = Mock(time=Mock(return_value=0))
+
+    def next_batch(self):
+        args, kwargs = self.io_loop.add_timeout.call_args
+        self.io_loop.add_timeout.reset_mock()
+        args[1]()
+
+    def test_batches(self):
+        """Sockets are closed in equal batches spread over the window."""
+        subscribers = [Subscriber(i) for i in range(10)]
+        done = Mock()
+        drain = DrainScheduler(subscribers, window=1, io_loop=self.io_loop)
+        self.assertEqual(drain.batch_size, 3)
+        drain.start(callback=done)
+        self.assertEqual(len(drain), 7)
+        self.assertEqual([s.closed is not None for s in subscribers], [True] * 3 + [False] * 7)
+        args, kwargs = self.io_loop.add_timeout.call_args
+        self.assertEqual(args[0], DrainScheduler.INTERVAL)
+        for remaining in (4, 1):
+            self.next_batch()
+            self.assertEqual(len(drain), remaining)
+        self.assertFalse(done.called)
+        self.next_batch()
+        self.assertTrue(done.called)
+        self.assertFalse(self.io_loop.add_timeout.called)
+
+    def test_idle_first(self):
+        """The least recently active sockets are closed first."""
+        busy, idle, unknown = Subscriber(100), Subscriber(10), Mock(spec=['close'])
+        drain = DrainScheduler([busy, idle, unknown], window=1, io_loop=self.io_loop)
+        drain.batch_size = 1
+        drain.start()
+        self.assertTrue(unknown.close.called)
+        self.next_batch()
+        self.assertIsNotNone(idle.closed)
+        self.assertIsNone(busy.closed)
+
+    def test_reconnect_hint(self):
+        """Close reasons carry a random reconnect delay."""
+        subscriber = Subscriber(0)
+        with patch('shoestring.drain.random.randint', return_value=321) as mock_randint:
+            DrainScheduler([subscriber], window=1, jitter=500, io_loop=self.io_loop).start()
+        mock_randint.assert_called_with(0, 500)
+        self.assertEqual(subscriber.closed, (4200, 'Server shutdown. retry=321'))
+
+    def test_metrics(self):
+        """Drain progress is exposed as metrics."""
+        closed = metrics.DRAIN_CLOSED.value()
+        drain = DrainScheduler([Subscriber(i) for i in range(8)], window=1, io_loop=self.io_loop)
+        drain.start()
+        self.assertIn('shoestring_drain_remaining 6', metrics.REGISTRY.render())
+        self.assertEqual(metrics.DRAIN_CLOSED.value(), closed + 2)
+        drain.stop()
+        self.assertNotIn('\nshoestring_drain_remaining ', metrics.REGISTRY.render())
+        self.assertTrue(self.io_loop.remove_timeout.called)
+
+    def test_no_subscribers(self):
+        """Nothing to drain calls back right away."""
+        done = Mock()
+        DrainScheduler([], window=10, io_loop=self.io_loop).start(callback=done)
+        self.assertTrue(done.called)
@@ -0,0 +1,77 @@
+import unittest
+
+from unittest.mock import Mock
+
+from tornado.websocket import WebSocketProtocol13
+
+from ..deflate import DeflateOptions, inflate
+from ..frames import encode_frame, prepare_message, EncodedMessage
+
+
+class EncodeFrameTestCase(unittest.TestCase):
+    """Building websocket frames shared across peers."""
+
+    def tornado_frame(self, message):
+        """Frame built by Tornado's own protocol implementation."""
+        handler = Mock()
+        protocol = WebSocketProtocol13(handler)
+        protocol.write_message(message)
+        args, kwargs = handler.stream.write.call_args
+        return args[0]
+
+    def test_short_message(self):
+        """Payloads under 126 bytes use the single byte length."""
+        self.assertEqual(encode_frame('ping'), self.tornado_frame('ping'))
+
+    def test_medium_message(self):
+        """Payloads up to 64KB use the 16-bit length."""
+        message = 'x' * 5000
+        self.assertEqual(encode_frame(message), self.tornado_frame(message))
+
+    def test_large_message(self):
+        """Larger payloads use the 64-bit length."""
+        message = 'x' * 70000
+        self.assertEqual(encode_frame(message), self.tornado_frame(message))
+
+    def test_unicode_message(self):
+        """Text is sent as UTF-8."""
+        message = 'café ☃'
+        self.assertEqual(encode_frame(message), self.tornado_frame(message))
+
+    def test_cached_frame(self):
+        """The frame is only built once per message."""
+        message = EncodedMessage('ping')
+        self.assertEqual(message, 'ping')
+        self.assertIs(message.frame, message.frame)
+
+    def test_deflate_frame(self):
+        """Messages over the minimum size are compressed with RSV1 set."""
+        options = DeflateOptions(level=6, mem_level=8, window_bits=15, min_size=100)
+        message = '{"sdp": "%s"}' % ('a=candidate:1 1 UDP 2130706431 10.0.0.1 54321 typ host\\r\\n' * 50)
+        frame = encode_frame(message, deflate=options)
+        self.assertEqual(frame[0], 0xC1)
+        self.assertLess(frame[1], 126)
+        self.assertEqual(inflate(frame[2:]).decode('utf-8'), message)
+
+    def test_deflate_small_frame(self):
+        """Messages under the minimum size or which don't shrink are not compressed."""
+        options = DeflateOptions(level=6, mem_level=8, window_bits=15, min_size=100)
+        self.assertEqual(encode_frame('ping', deflate=options), encode_frame('ping'))
+        options = options._replace(min_size=0)
+        self.assertEqual(encode_frame('ping', deflate=options), encode_frame('ping'))
+
+    def test_cached_deflate_frame(self):
+        """Compressed frames are cached per options."""
+        message = EncodedMessage('x' * 1000)
+        fast = DeflateOptions(level=1, mem_level=8, window_bits=15, min_size=0)
+        best = fast._replace(level=9)
+        self.assertIs(message.get_frame(fast), message.get_frame(fast))
+        self.assertIsNot(message.get_frame(fast), message.get_frame(best))
+        self.assertIs(message.get_frame(None), message.frame)
+
+    def test_prepare_message(self):
+        """Only text messages are wrapped."""
+        self.assertTrue(isinstance(prepare_message('ping'), EncodedMessage))
+        message = EncodedMessage('ping')
+        self.assertIs(prepare_message(message), message)
+        self.assertEqual(prepare_message(b'ping'), b'ping')
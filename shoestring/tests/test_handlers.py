@@ -1,17 +1,29 @@
 import json
+import os
+import socket
+import struct
+import time
+import unittest
 
 from contextlib import contextmanager
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
 import jwt
 
 from tornado import gen
 from tornado.concurrent import Future
 from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.httputil import HTTPServerRequest
+from tornado.iostream import IOStream
 from tornado.testing import AsyncHTTPTestCase, LogTrapTestCase, gen_test
-from tornado.websocket import websocket_connect
+from tornado.websocket import websocket_connect, WebSocketClosedError, WebSocketProtocol13
 
+from .. import metrics
 from ..app import ShoestringApplication
+from ..deflate import DeflateOptions, deflate, inflate
+from ..frames import encode_frame
+from ..handlers import SocketHandler
+from ..tokens import CompactTokens
 
 
 class BaseAppTestCase(AsyncHTTPTestCase, LogTrapTestCase):
@@ -62,6 +74,15 @@ class RoomHandlerTestCase(BaseAppTestCase):
             self.assertEqual(info['uuid'], user)
             self.assertEqual(info['room'], '1234')
 
+    @patch('shoestring.backends.memory.Backend.create_room')
+    def test_create_room_async_backend(self, mock_create):
+        """Backends can return a future for the new room."""
+        mock_create.return_value = gen.maybe_future('1234')
+        response = self.fetch('/rooms', method='POST', body='')
+        self.assertTrue(mock_create.called)
+        with self.assertJSON(response) as result:
+            self.assertEqual(result['room'], '1234')
+
     @patch('shoestring.backends.memory.Backend.join_room')
     def test_existing_room(self, mock_join):
         """Join an existing room."""
@@ -97,6 +118,46 @@ class RoomHandlerTestCase(BaseAppTestCase):
         self.assertEqual(response.code, 404)
 
 
+class MetricsHandlerTestCase(BaseAppTestCase):
+    """Metrics endpoint."""
+
+    def test_metrics(self):
+        """Expose metrics in the Prometheus text format."""
+        created = metrics.ROOMS_CREATED.value()
+        self.fetch('/rooms', method='POST', body='')
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.body.decode('utf-8')
+        self.assertIn('shoestring_rooms_created_total {}\n'.format(created + 1), body)
+        self.assertIn('shoestring_rooms{backend="shoestring.backends.memory"} ', body)
+        self.assertIn('# TYPE shoestring_broadcast_seconds histogram', body)
+
+    @gen_test
+    def test_socket_metrics(self):
+        """Sockets and messages are counted."""
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        opened = metrics.SOCKETS_OPENED.value()
+        broadcast = metrics.MESSAGES_BROADCAST.value()
+        delivered = metrics.MESSAGES_DELIVERED.value()
+        sockets = []
+        for user in ('XXX', 'YYY'):
+            token = jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+            ws = yield SocketTestCase.ws_connect(self, '/socket?token={}'.format(token))
+            sockets.append(ws)
+        sockets[0].write_message('hello')
+        yield sockets[1].read_message()
+        self.assertEqual(metrics.SOCKETS_OPENED.value(), opened + 2)
+        self.assertEqual(metrics.MESSAGES_BROADCAST.value(), broadcast + 1)
+        self.assertEqual(metrics.MESSAGES_DELIVERED.value(), delivered + 1)
+        closed = metrics.SOCKETS_CLOSED.value(code='1000')
+        for ws in sockets:
+            yield SocketTestCase.close(self, ws)
+        self.assertGreater(metrics.SOCKETS_CLOSED.value(code='1000') + metrics.SOCKETS_CLOSED.value(code='None'), closed)
+
+
 class SocketTestCase(BaseAppTestCase):
     """Websocket URL for signal channels."""
 
@@ -134,6 +195,24 @@ class SocketTestCase(BaseAppTestCase):
         self.assertEqual(args[1].uuid, 'XXX')
         yield self.close(ws)
 
+    @patch('shoestring.backends.memory.Backend.broadcast')
+    @patch('shoestring.backends.memory.Backend.add_subscriber')
+    @patch('shoestring.backends.memory.Backend.get_room')
+    @gen_test
+    def test_async_backend_connect(self, mock_get, mock_subscribe, mock_broadcast):
+        """Messages wait for an asynchronous subscription to finish."""
+        members = Future()
+        mock_get.return_value = members
+        mock_subscribe.return_value = gen.maybe_future(None)
+        token = jwt.encode({'room': '123', 'uuid': 'XXX'}, 'XXXX').decode('utf-8')
+        ws = yield self.ws_connect('/socket?token={}'.format(token))
+        ws.write_message('hello')
+        self.assertFalse(mock_subscribe.called)
+        members.set_result({'XXX': False})
+        yield self.close(ws)
+        self.assertTrue(mock_subscribe.called)
+        mock_broadcast.assert_called_with('hello', channel='123', sender='XXX')
+
     @patch('shoestring.backends.memory.Backend.add_subscriber')
     @patch('shoestring.backends.memory.Backend.get_room')
     @gen_test
@@ -208,6 +287,35 @@ class SocketTestCase(BaseAppTestCase):
         yield self.close(ws)
         mock_broadcast.assert_called_with('hello', channel='123', sender='XXX')    
 
+    @gen_test
+    def test_token_cache(self):
+        """Reconnecting with the same token skips verifying it again."""
+        room = self._app.backend.create_room('XXX')
+        token = jwt.encode({'room': room, 'uuid': 'XXX'}, 'XXXX').decode('utf-8')
+        for channel in (room, 'XXX'):
+            ws = yield self.ws_connect('/socket?token={}&channel={}'.format(token, channel))
+            yield self.close(ws)
+        self.assertEqual(self._app.tokens.hits, 1)
+        self.assertEqual(self._app.tokens.misses, 1)
+
+    @gen_test
+    def test_relay_message(self):
+        """Broadcast messages are written to the other sockets in the room."""
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        sockets = []
+        for user in ('XXX', 'YYY'):
+            token = jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+            ws = yield self.ws_connect('/socket?token={}'.format(token))
+            sockets.append(ws)
+        message = '{"sdp": "' + 'x' * 5000 + '"}'
+        sockets[0].write_message(message)
+        result = yield sockets[1].read_message()
+        self.assertEqual(result, message)
+        for ws in sockets:
+            yield self.close(ws)
+
     @patch('shoestring.backends.memory.Backend.add_subscriber')
     @patch('shoestring.backends.memory.Backend.get_room')
     @gen_test
@@ -253,6 +361,31 @@ class SocketTestCase(BaseAppTestCase):
         self.assertTrue(mock_get.called)
         self.assertFalse(mock_subscribe.called)
 
+    @patch('shoestring.backends.memory.Backend.connection_errors', (ConnectionError, ))
+    @patch('shoestring.backends.memory.Backend.add_subscriber')
+    @patch('shoestring.backends.memory.Backend.get_room')
+    @gen_test
+    def test_backend_unavailable(self, mock_get, mock_subscribe):
+        """Connections are closed for a retry while the backend can't be reached."""
+        mock_get.side_effect = ConnectionError('Refused.')
+        token = jwt.encode({'room': '123', 'uuid': 'XXX'}, 'XXXX').decode('utf-8')
+        ws = yield self.ws_connect('/socket?token={}'.format(token))
+        self.assertSocketError(ws, 4101, 'Backend unavailable.')
+        self.assertFalse(mock_subscribe.called)
+
+    @patch('shoestring.backends.memory.Backend.connection_errors', (ConnectionError, ))
+    @patch('shoestring.backends.memory.Backend.add_subscriber')
+    @patch('shoestring.backends.memory.Backend.get_room')
+    @gen_test
+    def test_subscribe_backend_unavailable(self, mock_get, mock_subscribe):
+        """Connections are closed for a retry when subscribing fails to reach the backend."""
+        mock_get.return_value = {'XXX': True}
+        mock_subscribe.side_effect = ConnectionError('Refused.')
+        token = jwt.encode({'room': '123', 'uuid': 'XXX'}, 'XXXX').decode('utf-8')
+        ws = yield self.ws_connect('/socket?token={}'.format(token))
+        self.assertSocketError(ws, 4101, 'Backend unavailable.')
+        self.assertTrue(mock_subscribe.called)
+
     @patch('shoestring.backends.memory.Backend.add_subscriber')
     @patch('shoestring.backends.memory.Backend.get_room')
     @gen_test
@@ -314,3 +447,378 @@ class SocketTestCase(BaseAppTestCase):
         self.assertEqual(args[0], '123')
         self.assertEqual(args[1].uuid, 'XXX')
         yield self.close(ws)
+
+
+class CompactTokenTestCase(BaseAppTestCase):
+    """Issuing and accepting compact room tokens."""
+
+    ws_connect = SocketTestCase.ws_connect
+    close = SocketTestCase.close
+
+    def get_app(self):
+        return ShoestringApplication(secret='XXXX', token_format='compact')
+
+    @patch('shoestring.backends.memory.Backend.add_subscriber')
+    @gen_test
+    def test_compact_token(self, mock_subscribe):
+        """Rooms issue compact tokens which are accepted by the socket."""
+        response = yield self.http_client.fetch(self.get_url('/rooms'), method='POST', body='')
+        result = json.loads(response.body.decode('utf-8'))
+        self.assertNotIn('.', result['token'])
+        info = self._app.tokens.compact.decode(result['token'])
+        self.assertEqual(info['room'], result['room'])
+        self.assertEqual(info['uuid'], result['user'])
+        ws = yield self.ws_connect('/socket?token={}'.format(result['token']))
+        self.assertTrue(mock_subscribe.called)
+        args, kwargs = mock_subscribe.call_args
+        self.assertEqual(args[0], result['room'])
+        self.assertEqual(args[1].uuid, result['user'])
+        yield self.close(ws)
+
+    @patch('shoestring.backends.memory.Backend.add_subscriber')
+    @gen_test
+    def test_forged_compact_token(self, mock_subscribe):
+        """Compact tokens with an invalid MAC are rejected."""
+        room = self._app.backend.create_room('XXX')
+        token = CompactTokens('YYYY').encode(room, 'a' * 32, time.time() + 60)
+        ws = yield self.ws_connect('/socket?token={}'.format(token))
+        msg = yield ws.read_message()
+        self.assertIsNone(msg)
+        self.assertFalse(mock_subscribe.called)
+
+
+class ResumeSocketTestCase(BaseAppTestCase):
+    """Replaying missed messages to reconnecting sockets."""
+
+    ws_connect = SocketTestCase.ws_connect
+    close = SocketTestCase.close
+
+    def get_app(self):
+        return ShoestringApplication(secret='XXXX', resume_log_size=10)
+
+    @gen_test
+    def test_resume(self):
+        """Messages sent while a socket was away are replayed after the last seen seq."""
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        tokens = [jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+                  for user in ('XXX', 'YYY')]
+        sender = yield self.ws_connect('/socket?token={}'.format(tokens[0]))
+        receiver = yield self.ws_connect('/socket?token={}'.format(tokens[1]))
+        sender.write_message('"offer"')
+        first = json.loads((yield receiver.read_message()))
+        self.assertEqual(first['message'], '"offer"')
+        yield self.close(receiver)
+        sender.write_message('"candidate 1"')
+        sender.write_message('"candidate 2"')
+        # Sender's own messages wait on the sender's socket being processed
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.05)
+        receiver = yield self.ws_connect(
+            '/socket?token={}&last_seq={}'.format(tokens[1], first['seq']))
+        replayed = []
+        for _ in range(2):
+            message = yield receiver.read_message()
+            replayed.append(json.loads(message))
+        self.assertEqual([m['message'] for m in replayed], ['"candidate 1"', '"candidate 2"'])
+        self.assertTrue(first['seq'] < replayed[0]['seq'] < replayed[1]['seq'])
+        for ws in (sender, receiver):
+            yield self.close(ws)
+
+    @gen_test
+    def test_replay_before_live(self):
+        """Live messages sent while the log is read arrive after the replayed ones."""
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        token = jwt.encode({'room': room, 'uuid': 'YYY'}, 'XXXX').decode('utf-8')
+        backend.add_subscriber(room, Mock(uuid='XXX'))
+        backend.broadcast('"candidate 1"', channel=room, sender='XXX')
+        get_log = backend.get_log
+
+        @gen.coroutine
+        def slow_get_log(channel, since):
+            log = get_log(channel, since)
+            backend.broadcast('"candidate 2"', channel=room, sender='XXX')
+            yield gen.moment
+            raise gen.Return(log)
+
+        with patch.object(backend, 'get_log', slow_get_log):
+            receiver = yield self.ws_connect('/socket?token={}&last_seq=0'.format(token))
+            received = []
+            for _ in range(2):
+                message = yield receiver.read_message()
+                received.append(json.loads(message))
+        self.assertEqual([m['message'] for m in received], ['"candidate 1"', '"candidate 2"'])
+        self.assertTrue(received[0]['seq'] < received[1]['seq'])
+        yield self.close(receiver)
+
+
+class BatchSocketTestCase(BaseAppTestCase):
+    """Batching messages from a socket within a time window."""
+
+    ws_connect = SocketTestCase.ws_connect
+    close = SocketTestCase.close
+
+    def get_app(self):
+        return ShoestringApplication(secret='XXXX', batch_window=20)
+
+    @gen.coroutine
+    def connect_peers(self):
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        sockets = []
+        for user in ('XXX', 'YYY'):
+            token = jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+            ws = yield self.ws_connect('/socket?token={}'.format(token))
+            sockets.append(ws)
+        raise gen.Return(sockets)
+
+    @gen_test
+    def test_batch_messages(self):
+        """Messages sent within the window are relayed as one frame."""
+        sender, receiver = yield self.connect_peers()
+        messages = ['{"candidate": %d}' % i for i in range(3)]
+        for message in messages:
+            sender.write_message(message)
+        result = yield receiver.read_message()
+        self.assertEqual(json.loads(result), {'batch': messages})
+        for ws in (sender, receiver):
+            yield self.close(ws)
+
+    @gen_test
+    def test_single_message(self):
+        """A message alone in the window is relayed as a batch of one."""
+        sender, receiver = yield self.connect_peers()
+        sender.write_message('{"batch": "client data"}')
+        result = yield receiver.read_message()
+        self.assertEqual(json.loads(result), {'batch': ['{"batch": "client data"}']})
+        for ws in (sender, receiver):
+            yield self.close(ws)
+
+    @patch('shoestring.backends.memory.Backend.broadcast')
+    @patch('shoestring.backends.memory.Backend.get_room')
+    @gen_test
+    def test_flush_on_close(self, mock_get, mock_broadcast):
+        """Pending messages are relayed when the socket closes."""
+        mock_get.return_value = {'XXX': False}
+        token = jwt.encode({'room': '123', 'uuid': 'XXX'}, 'XXXX').decode('utf-8')
+        ws = yield self.ws_connect('/socket?token={}'.format(token))
+        ws.write_message('hello')
+        yield self.close(ws)
+        mock_broadcast.assert_called_with('{"batch": ["hello"]}', channel='123', sender='XXX')
+
+
+class CompressionSocketTestCase(BaseAppTestCase):
+    """permessage-deflate compression of socket messages."""
+
+    ws_connect = SocketTestCase.ws_connect
+    close = SocketTestCase.close
+
+    def get_app(self):
+        return ShoestringApplication(secret='XXXX', compression_level=6, compression_min_size=100)
+
+    @gen.coroutine
+    def deflate_connect(self, path):
+        """Raw websocket connection offering permessage-deflate."""
+        stream = IOStream(socket.socket(), io_loop=self.io_loop)
+        yield stream.connect(('127.0.0.1', self.get_http_port()))
+        stream.write((
+            'GET {} HTTP/1.1\r\n'
+            'Host: 127.0.0.1:{}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+            '\r\n').format(path, self.get_http_port()).encode('ascii'))
+        response = yield stream.read_until(b'\r\n\r\n')
+        raise gen.Return((stream, response.decode('ascii')))
+
+    @gen.coroutine
+    def read_frame(self, stream):
+        """Read an unmasked server frame returning the first byte and payload."""
+        first, length = struct.unpack('BB', (yield stream.read_bytes(2)))
+        if length == 126:
+            length = struct.unpack('!H', (yield stream.read_bytes(2)))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', (yield stream.read_bytes(8)))[0]
+        payload = yield stream.read_bytes(length)
+        raise gen.Return((first, payload))
+
+    def masked_frame(self, payload, first):
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        assert len(payload) < 126
+        return struct.pack('BB', first, 0x80 | len(payload)) + mask + masked
+
+    @gen.coroutine
+    def connect_peers(self):
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        tokens = [jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+                  for user in ('XXX', 'YYY')]
+        stream, response = yield self.deflate_connect('/socket?token={}'.format(tokens[0]))
+        plain = yield self.ws_connect('/socket?token={}'.format(tokens[1]))
+        raise gen.Return((stream, response, plain))
+
+    @gen_test
+    def test_negotiate(self):
+        """Clients offering the extension get compressed messages."""
+        stream, response, plain = yield self.connect_peers()
+        self.assertIn('101 Switching Protocols', response)
+        self.assertIn('Sec-WebSocket-Extensions: permessage-deflate; server_no_context_takeover; '
+                      'client_no_context_takeover', response)
+        message = json.dumps({'sdp': 'a=candidate:1 1 UDP 2130706431 10.0.0.1 54321 typ host\r\n' * 40})
+        plain.write_message(message)
+        first, payload = yield self.read_frame(stream)
+        self.assertEqual(first, 0xC1)
+        self.assertLess(len(payload), len(message))
+        self.assertEqual(inflate(payload).decode('utf-8'), message)
+        # Small messages are sent uncompressed
+        plain.write_message('{"type": "bye"}')
+        first, payload = yield self.read_frame(stream)
+        self.assertEqual((first, payload), (0x81, b'{"type": "bye"}'))
+        stream.close()
+        yield self.close(plain)
+
+    @gen_test
+    def test_compressed_client_message(self):
+        """Compressed client messages are inflated before they are relayed."""
+        stream, response, plain = yield self.connect_peers()
+        options = DeflateOptions(level=9, mem_level=8, window_bits=15, min_size=0)
+        stream.write(self.masked_frame(deflate(b'{"type": "hello"}', options), 0xC1))
+        result = yield plain.read_message()
+        self.assertEqual(result, '{"type": "hello"}')
+        stream.close()
+        yield self.close(plain)
+
+    @gen_test
+    def test_uncompressed_client_message(self):
+        """Clients may still send uncompressed messages."""
+        stream, response, plain = yield self.connect_peers()
+        stream.write(self.masked_frame(b'x' * 100, 0x81))
+        result = yield plain.read_message()
+        self.assertEqual(result, 'x' * 100)
+        stream.close()
+        yield self.close(plain)
+
+    @gen_test
+    def test_plain_client(self):
+        """Clients which don't offer the extension get plain frames."""
+        backend = self._app.backend
+        room = backend.create_room('XXX')
+        backend.join_room(room, 'YYY')
+        sockets = []
+        for user in ('XXX', 'YYY'):
+            token = jwt.encode({'room': room, 'uuid': user}, 'XXXX').decode('utf-8')
+            ws = yield self.ws_connect('/socket?token={}'.format(token))
+            sockets.append(ws)
+        sockets[0].write_message('x' * 1000)
+        result = yield sockets[1].read_message()
+        self.assertEqual(result, 'x' * 1000)
+        for ws in sockets:
+            yield self.close(ws)
+
+
+class OutboundQueueTestCase(LogTrapTestCase, unittest.TestCase):
+    """Bounded outbound queue of a socket."""
+
+    def get_handler(self, **settings):
+        app = ShoestringApplication(secret='XXXX', outbound_max_messages=2, **settings)
+        request = HTTPServerRequest(method='GET', uri='/socket', connection=Mock())
+        handler = SocketHandler(app, request, backend=app.backend)
+        handler.channel, handler.uuid = '123', 'XXX'
+        handler.stream = Mock()
+        handler.stream.closed.return_value = False
+        handler.stream.io_loop.time.return_value = 0
+        handler.ws_connection = WebSocketProtocol13(handler)
+        return handler
+
+    def flush(self, handler):
+        """Mimic the stream finishing the pending write."""
+        args, kwargs = handler.stream.write.call_args
+        handler.stream.write.reset_mock()
+        kwargs['callback']()
+
+    def queued(self):
+        """Queued messages and bytes from the metrics output."""
+        values = {}
+        for line in metrics.REGISTRY.render().splitlines():
+            for unit in ('messages', 'bytes'):
+                if line.startswith('shoestring_outbound_queued_{} '.format(unit)):
+                    values[unit] = int(line.split()[1])
+        return values['messages'], values['bytes']
+
+    def test_write_immediately(self):
+        """Frames are written directly when nothing is being flushed."""
+        handler = self.get_handler()
+        handler.write_message('ping')
+        args, kwargs = handler.stream.write.call_args
+        self.assertEqual(args[0], encode_frame('ping'))
+        self.assertEqual(handler.outbound_depth, (0, 0))
+
+    def test_queue_while_flushing(self):
+        """Frames wait until the pending write has been flushed."""
+        handler = self.get_handler()
+        handler.write_message('ping')
+        handler.write_message('pong')
+        handler.write_message('ping')
+        self.assertEqual(handler.stream.write.call_count, 1)
+        self.assertEqual(handler.outbound_depth, (2, len(encode_frame('pong')) * 2))
+        self.flush(handler)
+        self.assertEqual(handler.outbound_depth, (0, 0))
+        frames = [args[0] for args, kwargs in handler.stream.write.call_args_list]
+        self.assertEqual(frames, [encode_frame('pong'), encode_frame('ping')])
+
+    def test_close_slow_consumer(self):
+        """The default policy closes the socket when the queue overflows."""
+        handler = self.get_handler()
+        for message in ('a', 'b', 'c', 'd'):
+            handler.write_message(message)
+        self.assertEqual(handler.close_code, None)
+        self.assertEqual(handler.outbound_depth, (0, 0))
+        args, kwargs = handler.stream.write.call_args
+        self.assertEqual(args[0][2:4], b'\x11\x30')
+        with self.assertRaises(WebSocketClosedError):
+            handler.write_message('e')
+
+    def test_drop_oldest(self):
+        """Drop the oldest queued frames when the queue overflows."""
+        handler = self.get_handler(outbound_policy='drop')
+        for message in ('a', 'b', 'c', 'd'):
+            handler.write_message(message)
+        self.assertEqual(handler.outbound_depth, (2, 6))
+        self.flush(handler)
+        frames = [args[0] for args, kwargs in handler.stream.write.call_args_list]
+        self.assertEqual(frames, [encode_frame('c'), encode_frame('d')])
+
+    def test_coalesce(self):
+        """Drop queued copies of the same frame before older frames."""
+        handler = self.get_handler(outbound_policy='coalesce')
+        for message in ('a', 'b', 'c', 'b'):
+            handler.write_message(message)
+        self.flush(handler)
+        frames = [args[0] for args, kwargs in handler.stream.write.call_args_list]
+        self.assertEqual(frames, [encode_frame('c'), encode_frame('b')])
+
+    def test_queued_metrics(self):
+        """Queued messages and bytes of all sockets are exposed as gauges."""
+        first = self.get_handler(outbound_policy='drop')
+        second = self.get_handler()
+        messages, size = self.queued()
+        for message in ('a', 'b', 'c', 'd'):
+            first.write_message(message)
+        second.write_message('ping')
+        second.write_message('pong')
+        self.assertEqual(self.queued(), (messages + 3, size + 6 + len(encode_frame('pong'))))
+        self.flush(second)
+        self.assertEqual(self.queued(), (messages + 2, size + 6))
+        second.write_message('a')
+        second.write_message('b')
+        second.write_message('c')
+        self.assertEqual(self.queued(), (messages + 2, size + 6))
+        first.on_close()
+        self.assertEqual(self.queued(), (messages, size))
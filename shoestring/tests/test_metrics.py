@@ -0,0 +1,66 @@
+import unittest
+
+from ..metrics import Counter, Gauge, Histogram, Registry
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Metrics in the Prometheus text format."""
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        """Counters add up per set of labels."""
+        counter = self.registry.register(Counter('test_closed', 'Closed sockets.', labels=('code', )))
+        counter.inc(code='1000')
+        counter.inc(code='1000')
+        counter.inc(3, code='4400')
+        self.assertEqual(counter.value(code='1000'), 2)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_closed Closed sockets.',
+            '# TYPE test_closed counter',
+            'test_closed_total{code="1000"} 2',
+            'test_closed_total{code="4400"} 3',
+        ]) + '\n')
+
+    def test_histogram(self):
+        """Histograms count observations in cumulative buckets."""
+        histogram = self.registry.register(Histogram('test_seconds', 'Latency.', buckets=(0.1, 1)))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_seconds Latency.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4',
+        ]) + '\n')
+
+    def test_histogram_timer(self):
+        """Time a block of code."""
+        histogram = Histogram('test_seconds', 'Latency.', labels=('command', ))
+        with histogram.time(command='get'):
+            pass
+        self.assertEqual(histogram.count(command='get'), 1)
+        self.assertEqual(histogram.count(command='set'), 0)
+
+    def test_gauge(self):
+        """Gauges are computed when rendered."""
+        gauge = self.registry.register(Gauge('test_rooms', 'Rooms.', labels=('backend', )))
+        rooms = [1, 2]
+        gauge.set_function(lambda: len(rooms), backend='memory')
+        gauge.set_function(lambda: None, backend='redis')
+        rooms.append(3)
+        self.assertIn('test_rooms{backend="memory"} 3\n', self.registry.render())
+        self.assertNotIn('redis', self.registry.render())
+        gauge.remove(backend='memory')
+        self.assertNotIn('memory', self.registry.render())
+
+    def test_escape_labels(self):
+        """Label values are escaped."""
+        counter = self.registry.register(Counter('test_total', 'Test.', labels=('name', )))
+        counter.inc(name='a"b\\c')
+        self.assertIn(r'test_total_total{name="a\"b\\c"} 1', self.registry.render())
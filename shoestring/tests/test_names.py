@@ -0,0 +1,70 @@
+import json
+import unittest
+
+from ..backends.names import NameAllocator
+
+
+class NameAllocatorTestCase(unittest.TestCase):
+    """Allocating unused random room names."""
+
+    def test_unique_names(self):
+        """Every name of the given length is handed out exactly once."""
+        names = NameAllocator(length=2, widen_at=1)
+        allocated = [names.allocate() for _ in range(90)]
+        self.assertEqual(sorted(allocated), [str(i) for i in range(10, 100)])
+        self.assertEqual(names.in_use(), 90)
+
+    def test_widen_when_full(self):
+        """Names get another digit once the current length is exhausted."""
+        names = NameAllocator(length=1, widen_at=1)
+        for _ in range(9):
+            self.assertEqual(len(names.allocate()), 1)
+        self.assertEqual(len(names.allocate()), 2)
+        self.assertEqual(names.length, 2)
+
+    def test_widen_at_threshold(self):
+        """Names get another digit once the occupancy passes the threshold."""
+        names = NameAllocator(length=2, widen_at=0.5)
+        allocated = [names.allocate() for _ in range(46)]
+        self.assertTrue(all(len(name) == 2 for name in allocated[:45]))
+        self.assertEqual(len(allocated[45]), 3)
+
+    def test_release(self):
+        """Released names can be allocated again."""
+        names = NameAllocator(length=1, widen_at=1)
+        allocated = [names.allocate() for _ in range(9)]
+        names.release(allocated[3])
+        self.assertEqual(names.in_use(), 8)
+        self.assertEqual(names.allocate(), allocated[3])
+        self.assertEqual(names.length, 1)
+
+    def test_release_and_reuse_all(self):
+        """Releasing in any order keeps the pool consistent."""
+        names = NameAllocator(length=2, widen_at=1)
+        allocated = [names.allocate() for _ in range(60)]
+        for name in allocated[::2]:
+            names.release(name)
+        again = [names.allocate() for _ in range(60)]
+        self.assertEqual(sorted(allocated[1::2] + again), [str(i) for i in range(10, 100)])
+
+    def test_random_order(self):
+        """Names are not handed out sequentially."""
+        names = NameAllocator(length=5)
+        allocated = [int(names.allocate()) for _ in range(10)]
+        self.assertNotEqual(allocated, sorted(allocated))
+
+    def test_invalid_length(self):
+        """Names need at least one digit."""
+        with self.assertRaises(ValueError):
+            NameAllocator(length=0)
+
+    def test_dump_and_load(self):
+        """A loaded allocator never hands out the names in use when dumped."""
+        names = NameAllocator(length=2, widen_at=1)
+        allocated = [names.allocate() for _ in range(40)]
+        names.release(allocated.pop())
+        state = json.loads(json.dumps(names.dump()))
+        restored = NameAllocator(length=5, widen_at=1)
+        restored.load(state)
+        again = [restored.allocate() for _ in range(51)]
+        self.assertEqual(sorted(allocated + again), [str(i) for i in range(10, 100)])
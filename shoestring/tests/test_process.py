@@ -0,0 +1,191 @@
+import os
+import signal
+import socket
+import sys
+import unittest
+
+from unittest.mock import patch
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. import process
+
+
+@patch('shoestring.process.signal.signal')
+@patch('shoestring.process.IOLoop.initialized', return_value=False)
+class ForkWorkersTestCase(unittest.TestCase):
+    """Supervision of forked worker processes."""
+
+    def setUp(self):
+        setpgid = patch('shoestring.process.os.setpgid')
+        self.mock_setpgid = setpgid.start()
+        self.addCleanup(setpgid.stop)
+
+    def tearDown(self):
+        process._worker_id = None
+
+    @patch('shoestring.process.os.fork', return_value=0)
+    def test_child(self, mock_fork, mock_initialized, mock_signal):
+        """Workers return their id and restore the default signal handlers."""
+        self.assertEqual(process.fork_workers(2), 0)
+        self.assertEqual(process.worker_id(), 0)
+        mock_signal.assert_any_call(signal.SIGTERM, signal.SIG_DFL)
+
+    @patch('shoestring.process.os.fork', return_value=0)
+    def test_child_process_group(self, mock_fork, mock_initialized, mock_signal):
+        """Workers leave the parent's process group so group signals only reach them once."""
+        process.fork_workers(2)
+        self.mock_setpgid.assert_called_with(0, 0)
+
+    @patch('shoestring.process.os.kill')
+    @patch('shoestring.process.os.wait')
+    @patch('shoestring.process.os.fork')
+    def test_clean_exit(self, mock_fork, mock_wait, mock_kill, mock_initialized, mock_signal):
+        """The parent exits once all workers have stopped after a shutdown signal."""
+        mock_fork.side_effect = [101, 102]
+
+        def wait():
+            if not mock_kill.called:
+                handlers = dict(c[0] for c in mock_signal.call_args_list)
+                handlers[signal.SIGTERM](signal.SIGTERM, None)
+                return (101, 0)
+            return (102, 0)
+
+        mock_wait.side_effect = wait
+        with self.assertRaises(SystemExit):
+            process.fork_workers(2)
+        self.assertEqual(mock_fork.call_count, 2)
+        self.assertIsNone(process.worker_id())
+
+    @patch('shoestring.process.os.wait')
+    @patch('shoestring.process.os.fork')
+    def test_restart_stopped_worker(self, mock_fork, mock_wait, mock_initialized, mock_signal):
+        """Workers which stop on their own are restarted while the parent keeps running."""
+        mock_fork.side_effect = [101, 102, 0]
+        mock_wait.side_effect = [(101, 0), ]
+        self.assertEqual(process.fork_workers(2), 0)
+        self.assertEqual(mock_fork.call_count, 3)
+
+    @patch('shoestring.process.os.wait')
+    @patch('shoestring.process.os.fork')
+    def test_restart_crashed_worker(self, mock_fork, mock_wait, mock_initialized, mock_signal):
+        """Workers which exit with an error are restarted with the same id."""
+        mock_fork.side_effect = [101, 102, 0]
+        mock_wait.side_effect = [(102, 1 << 8), ]
+        self.assertEqual(process.fork_workers(2), 1)
+        self.assertEqual(mock_fork.call_count, 3)
+
+    @patch('shoestring.process.os.kill')
+    @patch('shoestring.process.os.wait')
+    @patch('shoestring.process.os.fork')
+    def test_forward_signal(self, mock_fork, mock_wait, mock_kill, mock_initialized, mock_signal):
+        """Shutdown signals are forwarded and stopped workers are not restarted."""
+        mock_fork.side_effect = [101, 102]
+
+        def wait():
+            if not mock_kill.called:
+                handlers = dict(c[0] for c in mock_signal.call_args_list)
+                handlers[signal.SIGTERM](signal.SIGTERM, None)
+                return (101, signal.SIGTERM)
+            return (102, signal.SIGTERM)
+
+        mock_wait.side_effect = wait
+        with self.assertRaises(SystemExit):
+            process.fork_workers(2)
+        self.assertEqual(mock_fork.call_count, 2)
+        mock_kill.assert_any_call(101, signal.SIGTERM)
+        mock_kill.assert_any_call(102, signal.SIGTERM)
+
+    def test_after_ioloop(self, mock_initialized, mock_signal):
+        """Workers must be forked before the IOLoop is created."""
+        mock_initialized.return_value = True
+        with self.assertRaises(RuntimeError):
+            process.fork_workers(2)
+
+
+class HandoffTestCase(AsyncTestCase):
+    """Handing listening sockets to a new server process."""
+
+    def setUp(self):
+        super().setUp()
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+
+    def tearDown(self):
+        self.sock.close()
+        super().tearDown()
+
+    @gen_test
+    def test_ready(self):
+        """The new process inherits the sockets and reports when it is ready."""
+        script = (
+            'import os, sys; from shoestring import process; '
+            'socks = process.inherited_sockets(); '
+            'assert socks[0].getsockname()[1] == int(sys.argv[1]), socks; '
+            'assert process.LISTEN_FDS_ENV_KEY not in os.environ; '
+            'assert os.environ["SHOESTRING_SECRET_KEY"] == "XXXX"; '
+            'process.notify_ready()')
+        ready = Future()
+        child = process.spawn_successor(
+            [self.sock], ready.set_result, env={'SHOESTRING_SECRET_KEY': 'XXXX'}, io_loop=self.io_loop,
+            command=[sys.executable, '-c', script, str(self.sock.getsockname()[1])])
+        self.assertTrue((yield ready))
+        self.assertEqual(child.wait(), 0)
+
+    @gen_test
+    def test_failed(self):
+        """The callback is told when the new process exits before it is ready."""
+        ready = Future()
+        child = process.spawn_successor(
+            [self.sock], ready.set_result, io_loop=self.io_loop,
+            command=[sys.executable, '-c', 'import sys; sys.exit(1)'])
+        self.assertFalse((yield ready))
+        self.assertEqual(child.wait(), 1)
+
+    def test_no_handoff(self):
+        """Servers started normally don't inherit sockets."""
+        with patch.dict(os.environ, clear=True):
+            self.assertIsNone(process.inherited_sockets())
+            process.notify_ready()
+
+
+class NotifyTestCase(unittest.TestCase):
+    """Status notifications to systemd."""
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind('\0shoestring-test-{}'.format(os.getpid()))
+        self.sock.settimeout(1)
+        self.addCleanup(self.sock.close)
+
+    def environ(self, **values):
+        values['NOTIFY_SOCKET'] = '@shoestring-test-{}'.format(os.getpid())
+        return patch.dict(os.environ, values, clear=True)
+
+    def test_ready(self):
+        """Servers started normally report they are ready."""
+        with self.environ():
+            process.notify_ready()
+        self.assertEqual(self.sock.recv(1024), b'READY=1')
+
+    def test_new_main_process(self):
+        """A hot restarted server reports itself as the main process."""
+        read_fd, write_fd = os.pipe()
+        with self.environ(SHOESTRING_READY_FD=str(write_fd)):
+            process.notify_ready()
+        self.assertEqual(os.read(read_fd, 1), b'1')
+        os.close(read_fd)
+        state = 'MAINPID={}\nREADY=1'.format(os.getpid())
+        self.assertEqual(self.sock.recv(1024), state.encode('utf-8'))
+
+    def test_no_service_manager(self):
+        """Nothing is sent without a notification socket."""
+        with patch.dict(os.environ, clear=True):
+            self.assertFalse(process.sd_notify('READY=1'))
+
+    def test_unreachable(self):
+        """Failing to notify the service manager is not fatal."""
+        with patch.dict(os.environ, {'NOTIFY_SOCKET': '@shoestring-missing'}, clear=True):
+            self.assertFalse(process.sd_notify('READY=1'))
@@ -0,0 +1,117 @@
+import random
+
+from unittest.mock import patch
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..timers import TimingWheel
+
+
+class TimingWheelTestCase(AsyncTestCase):
+    """Coarse timeouts on a hierarchical timing wheel."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        patcher = patch.object(self.io_loop, 'time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.expired = []
+        self.wheel = TimingWheel(self.expired.append, resolution=1, slots=4, levels=3)
+
+    def tearDown(self):
+        self.wheel.stop()
+        super().tearDown()
+
+    def advance(self, seconds):
+        """Move the clock forward one second at a time."""
+        for _ in range(seconds):
+            self.now += 1
+            self.wheel._advance()
+
+    def test_expire(self):
+        """Keys are called back once their delay has passed."""
+        self.wheel.schedule('a', 3)
+        self.advance(2)
+        self.assertEqual(self.expired, [])
+        self.advance(1)
+        self.assertEqual(self.expired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascade(self):
+        """Timeouts on higher levels expire on time."""
+        delays = {'a': 5, 'b': 17, 'c': 63, 'd': 40}
+        for key, delay in delays.items():
+            self.wheel.schedule(key, delay)
+        for second in range(1, 64):
+            self.advance(1)
+            expected = sorted(k for k, d in delays.items() if d <= second)
+            self.assertEqual(sorted(self.expired), expected, second)
+
+    def test_beyond_top_level(self):
+        """Timeouts longer than the wheel's span still expire on time."""
+        self.wheel.schedule('a', 150)
+        self.advance(149)
+        self.assertEqual(self.expired, [])
+        self.advance(1)
+        self.assertEqual(self.expired, ['a'])
+
+    def test_random_delays(self):
+        """Every timeout expires on the tick it is due."""
+        rng = random.Random(42)
+        delays = {key: rng.randint(1, 200) for key in range(300)}
+        for key, delay in delays.items():
+            self.wheel.schedule(key, delay)
+        for second in range(1, 201):
+            self.advance(1)
+            due = sorted(k for k, d in delays.items() if d == second)
+            self.assertEqual(sorted(self.expired), due, second)
+            del self.expired[:]
+
+    def test_cancel(self):
+        """Cancelled keys are not called back."""
+        self.wheel.schedule('a', 10)
+        self.wheel.cancel('a')
+        self.wheel.cancel('b')
+        self.assertNotIn('a', self.wheel)
+        self.advance(20)
+        self.assertEqual(self.expired, [])
+
+    def test_reschedule(self):
+        """Scheduling a pending key replaces its timeout."""
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('a', 30)
+        self.advance(29)
+        self.assertEqual(self.expired, [])
+        self.advance(1)
+        self.assertEqual(self.expired, ['a'])
+
+    def test_catch_up(self):
+        """Ticks missed by a blocked loop are processed together."""
+        self.wheel.schedule('a', 3)
+        self.wheel.schedule('b', 20)
+        self.now += 25
+        self.wheel._advance()
+        self.assertEqual(self.expired, ['a', 'b'])
+
+    def test_stop_when_empty(self):
+        """The periodic callback only runs while timeouts are pending."""
+        self.wheel.schedule('a', 1)
+        self.assertIsNotNone(self.wheel._periodic)
+        self.advance(1)
+        self.assertIsNone(self.wheel._periodic)
+
+
+class TimingWheelLoopTestCase(AsyncTestCase):
+    """Advancing the timing wheel from the IOLoop."""
+
+    @gen_test
+    def test_periodic(self):
+        """Timeouts expire without advancing the wheel by hand."""
+        expired = Future()
+        wheel = TimingWheel(expired.set_result, resolution=0.01)
+        wheel.schedule('a', 0.02)
+        key = yield expired
+        self.assertEqual(key, 'a')
+        self.assertIsNone(wheel._periodic)
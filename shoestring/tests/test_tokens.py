@@ -0,0 +1,140 @@
+import time
+import unittest
+
+from unittest.mock import patch
+
+import jwt
+
+from ..tokens import CompactTokens, TokenCache
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Caching verified room tokens."""
+
+    def setUp(self):
+        self.cache = TokenCache('XXXX', max_size=2)
+
+    def get_token(self, expires=3600, secret='XXXX', **claims):
+        claims.setdefault('room', '123')
+        claims.setdefault('uuid', 'XXX')
+        if expires is not None:
+            claims['exp'] = int(time.time()) + expires
+        return jwt.encode(claims, secret).decode('utf-8')
+
+    def test_decode(self):
+        """Return the claims of a valid token."""
+        info = self.cache.decode(self.get_token())
+        self.assertEqual(info['room'], '123')
+        self.assertEqual(info['uuid'], 'XXX')
+
+    def test_hit(self):
+        """Verified tokens are not verified again."""
+        token = self.get_token()
+        self.cache.decode(token)
+        with patch('jwt.decode') as mock_decode:
+            info = self.cache.decode(token)
+            self.assertFalse(mock_decode.called)
+        self.assertEqual(info['uuid'], 'XXX')
+        self.assertEqual(self.cache.stats, {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_forged_token(self):
+        """Tokens signed with another secret are rejected and not cached."""
+        token = self.get_token(secret='YYYY')
+        for _ in range(2):
+            with self.assertRaises(jwt.DecodeError):
+                self.cache.decode(token)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_expired_token(self):
+        """Expired tokens are rejected."""
+        with self.assertRaises(jwt.ExpiredSignature):
+            self.cache.decode(self.get_token(expires=-10))
+
+    def test_evict_at_expiry(self):
+        """Cached tokens are dropped once they expire."""
+        token = self.get_token(expires=10)
+        self.cache.decode(token)
+        with patch('time.time', return_value=time.time() + 20):
+            with patch.object(self.cache, 'verify', side_effect=jwt.ExpiredSignature) as mock_verify:
+                with self.assertRaises(jwt.ExpiredSignature):
+                    self.cache.decode(token)
+                mock_verify.assert_called_with(token)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_size_limit(self):
+        """Least recently used tokens are evicted when the cache is full."""
+        first, second, third = [self.get_token(uuid=user) for user in ('XXX', 'YYY', 'ZZZ')]
+        self.cache.decode(first)
+        self.cache.decode(second)
+        self.cache.decode(first)
+        self.cache.decode(third)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.decode(first)
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.decode(second)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_no_expiry(self):
+        """Tokens without an expiry are only evicted by the size limit."""
+        token = self.get_token(expires=None)
+        self.cache.decode(token)
+        with patch('time.time', return_value=time.time() + 10 ** 6):
+            self.cache.decode(token)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_disabled(self):
+        """A cache without entries verifies every token."""
+        cache = TokenCache('XXXX', max_size=0)
+        token = self.get_token()
+        cache.decode(token)
+        cache.decode(token)
+        self.assertEqual(cache.stats, {'size': 0, 'hits': 0, 'misses': 2})
+
+
+class CompactTokensTestCase(unittest.TestCase):
+    """Binary room tokens."""
+
+    def setUp(self):
+        self.tokens = CompactTokens('XXXX')
+        self.user = 'e4a3c1d2b5f60718293a4b5c6d7e8f90'
+
+    def test_round_trip(self):
+        """Decoding returns the claims of the minted token."""
+        expires = int(time.time()) + 60
+        token = self.tokens.encode('12345', self.user, expires)
+        self.assertNotIn('.', token)
+        self.assertEqual(self.tokens.decode(token), {'room': '12345', 'uuid': self.user, 'exp': expires})
+
+    def test_forged(self):
+        """Tokens signed with another secret are rejected."""
+        token = CompactTokens('YYYY').encode('12345', self.user, time.time() + 60)
+        with self.assertRaises(jwt.DecodeError):
+            self.tokens.decode(token)
+
+    def test_tampered(self):
+        """Changing any part of the token invalidates the MAC."""
+        token = self.tokens.encode('12345', self.user, time.time() + 60)
+        tampered = token[:8] + ('A' if token[8] != 'A' else 'B') + token[9:]
+        with self.assertRaises(jwt.DecodeError):
+            self.tokens.decode(tampered)
+
+    def test_malformed(self):
+        """Garbage is rejected as an invalid token."""
+        for token in ('', 'abc', '!!!!', 'A' * 64):
+            with self.assertRaises(jwt.DecodeError):
+                self.tokens.decode(token)
+
+    def test_expired(self):
+        """Expired tokens are rejected."""
+        token = self.tokens.encode('12345', self.user, time.time() - 10)
+        with self.assertRaises(jwt.ExpiredSignature):
+            self.tokens.decode(token)
+
+    def test_cache_verifies_both_formats(self):
+        """The token cache accepts JWTs and compact tokens."""
+        cache = TokenCache('XXXX')
+        compact = cache.compact.encode('12345', self.user, time.time() + 60)
+        self.assertEqual(cache.decode(compact)['uuid'], self.user)
+        token = jwt.encode({'room': '12345', 'uuid': self.user}, 'XXXX').decode('utf-8')
+        self.assertEqual(cache.decode(token)['uuid'], self.user)
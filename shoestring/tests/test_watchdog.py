@@ -0,0 +1,91 @@
+import sys
+import time
+
+from unittest.mock import patch
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from .. import metrics
+from ..backends.memory import Backend
+from ..watchdog import Watchdog, describe_frame
+
+
+def block():
+    time.sleep(0.2)
+
+
+class Handler(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open(self):
+        self.backend.get_room('12345')
+
+
+class WatchdogTestCase(AsyncTestCase):
+    """Detect and attribute callbacks blocking the IOLoop."""
+
+    def setUp(self):
+        super().setUp()
+        self.backend = Backend()
+        self.watchdog = Watchdog(threshold=0.05, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.watchdog.stop()
+        self.backend.shutdown()
+        super().tearDown()
+
+    @gen.coroutine
+    def wait(self, seconds):
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + seconds)
+
+    def test_describe_frame(self):
+        """Frames are named after the method and class of self."""
+        self.assertEqual(describe_frame(sys._getframe()), 'WatchdogTestCase.test_describe_frame')
+
+    def test_watch(self):
+        """Backend methods are wrapped and still return their results."""
+        self.watchdog.watch(self.backend)
+        room = self.backend.create_room('owner')
+        self.assertEqual(self.backend.get_room(room), {'owner': False})
+        self.assertEqual(self.backend.create_room.__name__, 'create_room')
+
+    @gen_test
+    def test_blocking_backend_call(self):
+        """Slow backend calls are logged with their caller and a stack sample."""
+        self.backend.get_room = lambda name: time.sleep(0.2)
+        self.watchdog.watch(self.backend)
+        self.watchdog.start()
+        with patch('shoestring.watchdog.logging') as mock_logging:
+            self.io_loop.add_callback(Handler(self.backend).open)
+            yield self.wait(0.2)
+        self.assertTrue(mock_logging.warning.called)
+        msg, *args = mock_logging.warning.call_args[0]
+        self.assertIn('IOLoop blocked', msg)
+        self.assertEqual(args[1:3], ['memory.Backend.get_room', 'Handler.open'])
+        self.assertGreaterEqual(args[3], 0.2)
+        self.assertIn('in open', args[4])
+
+    @gen_test
+    def test_blocking_callback(self):
+        """Stalls outside backend calls are still logged with the stack."""
+        self.watchdog.start()
+        with patch('shoestring.watchdog.logging') as mock_logging:
+            self.io_loop.add_callback(block)
+            yield self.wait(0.2)
+        self.assertTrue(mock_logging.warning.called)
+        msg, lag, stack = mock_logging.warning.call_args[0]
+        self.assertGreater(lag, 0.1)
+        self.assertIn('in block', stack)
+
+    @gen_test
+    def test_lag(self):
+        """The heartbeat records the IOLoop lag without logging."""
+        count = metrics.IOLOOP_LAG_SECONDS.count()
+        self.watchdog.start()
+        with patch('shoestring.watchdog.logging') as mock_logging:
+            yield self.wait(0.1)
+        self.assertGreater(metrics.IOLOOP_LAG_SECONDS.count(), count)
+        self.assertFalse(mock_logging.warning.called)
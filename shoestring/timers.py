@@ -0,0 +1,104 @@
+import math
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+class TimingWheel(object):
+    """Hierarchical timing wheel for large numbers of coarse timeouts.
+
+    Timeouts are kept in buckets of ``slots`` ticks per level, each level
+    covering ``slots`` times the span of the level below. Scheduling and
+    cancelling are O(1) and a single periodic callback on the IOLoop
+    advances the wheel one tick (``resolution`` seconds) at a time, moving
+    timeouts down a level as their bucket comes up. The callback only runs
+    while there are timeouts pending.
+    """
+
+    def __init__(self, callback, resolution=1.0, slots=64, levels=4):
+        self.callback = callback
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # Key -> (deadline tick, bucket)
+        self._timers = {}
+        self._tick = None
+        self._periodic = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def _current_tick(self):
+        return int(IOLoop.current().time() / self.resolution)
+
+    def schedule(self, key, delay):
+        """Call back with the key once the delay (in seconds) has passed.
+
+        Rescheduling a pending key replaces its timeout.
+        """
+        self.cancel(key)
+        if self._periodic is None:
+            if not self._timers:
+                self._tick = self._current_tick()
+            self._periodic = PeriodicCallback(self._advance, self.resolution * 1000)
+            self._periodic.start()
+        deadline = math.ceil((IOLoop.current().time() + delay) / self.resolution)
+        self._place(key, max(deadline, self._tick + 1))
+
+    def cancel(self, key):
+        """Remove the pending timeout of the key if there is one."""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            del timer[1][key]
+
+    def _place(self, key, deadline):
+        delta = deadline - self._tick
+        for level in range(self.levels):
+            span = self.slots ** (level + 1)
+            if delta < span:
+                slot = (deadline // self.slots ** level) % self.slots
+                break
+        else:
+            # Beyond the top level, park it in the furthest bucket and
+            # place it again when that bucket comes up.
+            level = self.levels - 1
+            slot = ((self._tick + span - 1) // self.slots ** level) % self.slots
+        bucket = self._wheels[level][slot]
+        bucket[key] = deadline
+        self._timers[key] = (deadline, bucket)
+
+    def _advance(self):
+        expired = []
+        now = self._current_tick()
+        while self._tick < now:
+            self._tick += 1
+            # Move timeouts of the buckets coming up to lower levels,
+            # starting at the top so they can cascade all the way down
+            levels = 1
+            while levels < self.levels and not self._tick % self.slots ** levels:
+                levels += 1
+            for level in reversed(range(1, levels)):
+                slot = (self._tick // self.slots ** level) % self.slots
+                bucket, self._wheels[level][slot] = self._wheels[level][slot], {}
+                for key, deadline in bucket.items():
+                    self._place(key, deadline)
+            slot = self._tick % self.slots
+            bucket = self._wheels[0][slot]
+            for key, deadline in list(bucket.items()):
+                if deadline <= self._tick:
+                    del bucket[key]
+                    del self._timers[key]
+                    expired.append(key)
+        if not self._timers:
+            self.stop()
+        for key in expired:
+            self.callback(key)
+
+    def stop(self):
+        """Stop advancing the wheel until another timeout is scheduled."""
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import hmac
+import heapq
+import struct
+import time
+
+from collections import OrderedDict
+
+import jwt
+
+from tornado.escape import utf8
+
+from . import metrics
+
+
+TOKEN_FORMATS = ('jwt', 'compact')
+
+
+class CompactTokens(object):
+    """Binary room tokens with a truncated HMAC-SHA256.
+
+    The token is the URL safe base64 (without padding) of::
+
+        version (1 byte) | exp (4 bytes) | room length (1 byte) | room |
+        uuid (16 bytes) | MAC (16 bytes)
+
+    Unlike JWTs they never contain a ``.`` so both formats can be told
+    apart. Invalid tokens raise the same errors as ``jwt.decode``.
+    """
+
+    VERSION = 1
+    MAC_SIZE = 16
+    UUID_SIZE = 16
+    HEADER = struct.Struct('!BIB')
+
+    def __init__(self, secret):
+        # Separate key so a MAC can never be mistaken for a JWT signature
+        self.key = hmac.new(utf8(secret), b'shoestring-compact-token', hashlib.sha256).digest()
+
+    def _mac(self, data):
+        return hmac.new(self.key, data, hashlib.sha256).digest()[:self.MAC_SIZE]
+
+    def encode(self, room, user, expires):
+        """Mint a token for the user in the room valid until the expires timestamp."""
+        room = utf8(room)
+        data = self.HEADER.pack(self.VERSION, int(expires), len(room)) + room + bytes.fromhex(user)
+        token = base64.urlsafe_b64encode(data + self._mac(data)).rstrip(b'=')
+        return token.decode('ascii')
+
+    def decode(self, token):
+        """Verify the MAC and expiry, returning claims like a room JWT."""
+        try:
+            raw = utf8(token)
+            raw = base64.urlsafe_b64decode(raw + b'=' * (-len(raw) % 4))
+            data, mac = raw[:-self.MAC_SIZE], raw[-self.MAC_SIZE:]
+            version, expires, length = self.HEADER.unpack_from(data)
+        except (ValueError, TypeError, struct.error):
+            raise jwt.DecodeError('Invalid compact token.')
+        size = self.HEADER.size
+        if version != self.VERSION or len(data) != size + length + self.UUID_SIZE:
+            raise jwt.DecodeError('Invalid compact token.')
+        if not hmac.compare_digest(mac, self._mac(data)):
+            raise jwt.DecodeError('Signature verification failed')
+        if time.time() > expires:
+            raise jwt.ExpiredSignature('Signature has expired')
+        return {
+            'room': data[size:size + length].decode('utf-8'),
+            'uuid': data[size + length:].hex(),
+            'exp': expires,
+        }
+
+
+class TokenCache(object):
+    """Bounded cache of verified room token claims keyed by the token.
+
+    Clients reconnect with the same token for the room channel and their
+    own channel, so only the first handshake pays for verifying the
+    signature. Entries are dropped once the token's ``exp`` has passed and
+    the least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, secret, max_size=10000):
+        self.secret = secret
+        self.compact = CompactTokens(secret)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Token -> (expiry or None, claims) in least recently used order
+        self._entries = OrderedDict()
+        # (expiry, token) for the entries with an expiry
+        self._expiries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def verify(self, token):
+        """Verify the token signature and expiry, returning the claims."""
+        with metrics.TOKEN_VERIFY_SECONDS.time():
+            if '.' in token:
+                return jwt.decode(token, self.secret)
+            return self.compact.decode(token)
+
+    def decode(self, token):
+        """Return the claims of a valid token.
+
+        Raises the same errors as ``jwt.decode`` for forged or expired tokens.
+        """
+        now = time.time()
+        self._expire(now)
+        entry = self._entries.get(token)
+        if entry is not None:
+            expiry, claims = entry
+            if expiry is None or now <= expiry:
+                self.hits += 1
+                self._entries.move_to_end(token)
+                return claims
+            del self._entries[token]
+        self.misses += 1
+        claims = self.verify(token)
+        if self.max_size > 0:
+            self._add(token, claims)
+        return claims
+
+    def _add(self, token, claims):
+        expiry = claims.get('exp')
+        self._entries[token] = (expiry, claims)
+        if expiry is not None:
+            heapq.heappush(self._expiries, (expiry, token))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if len(self._expiries) > 2 * self.max_size:
+            # Forget expiries of tokens which were already evicted
+            self._expiries = [(e, t) for e, t in self._expiries if t in self._entries]
+            heapq.heapify(self._expiries)
+
+    def _expire(self, now):
+        while self._expiries and self._expiries[0][0] < now:
+            expiry, token = heapq.heappop(self._expiries)
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] == expiry:
+                del self._entries[token]
+
+    @property
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
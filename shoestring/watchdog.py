@@ -0,0 +1,142 @@
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from . import metrics
+
+
+BACKEND_METHODS = (
+    'create_room', 'join_room', 'get_room', 'add_subscriber', 'remove_subscriber',
+    'broadcast', 'get_log', 'shutdown',
+)
+
+
+def describe_frame(frame):
+    """Name the function running in the frame as Class.method where possible."""
+    code = frame.f_code
+    owner = frame.f_locals.get('self')
+    if owner is not None:
+        return '{}.{}'.format(type(owner).__name__, code.co_name)
+    return '{}.{}'.format(frame.f_globals.get('__name__', '?'), code.co_name)
+
+
+class Watchdog(object):
+    """Detect callbacks blocking the IOLoop and attribute them to backend calls.
+
+    A periodic heartbeat on the IOLoop measures its lag. A background thread
+    samples the stack of the IOLoop thread once the heartbeat is overdue by
+    more than ``threshold`` seconds, so the log shows what was running while
+    the loop was stuck rather than where it resumed. Backend methods wrapped
+    with :meth:`watch` record the slowest call and its caller, for example
+    ``redis.Backend.add_subscriber`` called from ``SocketHandler.open``.
+
+    Tornado's own ``set_blocking_log_threshold`` relies on ``SIGALRM`` which
+    the server already uses for shutdown.
+    """
+
+    def __init__(self, threshold=0.1, interval=None, io_loop=None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.io_loop = io_loop or IOLoop.current()
+        self._periodic = None
+        self._sampler = None
+        self._stopped = threading.Event()
+        self._thread_id = None
+        self._last_beat = None
+        # (caller, method, start) of the backend call in progress
+        self._call = None
+        # (caller, method, duration) of the slowest call since the last beat
+        self._slow_call = None
+        # (call in progress, formatted stack) sampled during a stall
+        self._sample = None
+
+    def watch(self, backend):
+        """Wrap the backend's API methods to record slow calls."""
+        cls = type(backend)
+        prefix = '{}.{}'.format(cls.__module__.rsplit('.', 1)[-1], cls.__name__)
+        for name in BACKEND_METHODS:
+            method = getattr(backend, name, None)
+            if method is not None:
+                setattr(backend, name, self._wrap('{}.{}'.format(prefix, name), method))
+        return backend
+
+    def _wrap(self, label, method):
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            caller = describe_frame(sys._getframe(1))
+            start = time.perf_counter()
+            self._call = (caller, label, start)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                self._call = None
+                if duration > self.threshold and (
+                        self._slow_call is None or duration > self._slow_call[2]):
+                    self._slow_call = (caller, label, duration)
+
+        return wrapper
+
+    def start(self):
+        """Start watching. Must be called on the IOLoop's thread."""
+        if self._periodic is not None:
+            return
+        self._thread_id = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._stopped.clear()
+        self._periodic = PeriodicCallback(self._beat, self.interval * 1000, io_loop=self.io_loop)
+        self._periodic.start()
+        self._sampler = threading.Thread(target=self._run_sampler, name='shoestring-watchdog')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        self._stopped.set()
+
+    def _beat(self):
+        now = time.perf_counter()
+        lag = max(now - self._last_beat - self.interval, 0)
+        self._last_beat = now
+        metrics.IOLOOP_LAG_SECONDS.observe(lag)
+        if lag > self.threshold:
+            self._report(lag)
+        self._slow_call, self._sample = None, None
+
+    def _report(self, lag):
+        sample = self._sample
+        if self._slow_call is not None:
+            caller, label, duration = self._slow_call
+        elif sample is not None and sample[0] is not None:
+            caller, label, start = sample[0]
+            duration = None
+        else:
+            caller = label = duration = None
+        if label is None:
+            msg, args = 'IOLoop blocked for %.3fs.', [lag]
+        elif duration is None:
+            msg, args = 'IOLoop blocked for %.3fs in %s from %s.', [lag, label, caller]
+        else:
+            msg = 'IOLoop blocked for %.3fs in %s from %s (%.3fs).'
+            args = [lag, label, caller, duration]
+        if sample is not None:
+            msg += '\n%s'
+            args.append(sample[1])
+        logging.warning(msg, *args)
+
+    def _run_sampler(self):
+        while not self._stopped.wait(self.interval):
+            overdue = time.perf_counter() - self._last_beat - self.interval
+            if self._sample is None and overdue > self.threshold:
+                call = self._call
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._sample = (call, ''.join(traceback.format_stack(frame)))
@@ -5,10 +5,24 @@
         this.token = token;
         this.channel = channel;
         this.ws = null;
+        this.lastSeq = null;
         this.connected = new $.Deferred();
         this.open();
     };
 
+    // Compare message seqs, either numbers or Redis stream ids like 1700000000000-3
+    function seqAfter(seq, other) {
+        var a = String(seq).split('-'),
+            b = String(other).split('-'),
+            i;
+        for (i = 0; i < Math.max(a.length, b.length); i++) {
+            if (Number(a[i] || 0) !== Number(b[i] || 0)) {
+                return Number(a[i] || 0) > Number(b[i] || 0);
+            }
+        }
+        return false;
+    }
+
     Socket.prototype = _.extend(Socket.prototype, Backbone.Events, {
         open: function () {
             if (this.ws === null) {
@@ -21,7 +35,12 @@
             return this.connected;
         },
         url: function () {
-            return this.server + '?' + $.param({token: this.token, channel: this.channel});
+            var params = {token: this.token, channel: this.channel};
+            if (this.lastSeq !== null) {
+                // Resume the session after the last message seen
+                params.last_seq = this.lastSeq;
+            }
+            return this.server + '?' + $.param(params);
         },
         close: function () {
             if (this.ws && this.ws.close) {
@@ -36,21 +55,45 @@
             this.trigger('open');
         },
         onmessage: function (message) {
-            var result = JSON.parse(message.data);
-            this.trigger('message', result, message);
+            var result = JSON.parse(message.data),
+                self = this;
+            if (typeof(result.seq) !== 'undefined') {
+                // Resumable session, drop messages which were already seen
+                if (this.lastSeq !== null && !seqAfter(result.seq, this.lastSeq)) {
+                    return;
+                }
+                this.lastSeq = result.seq;
+                result = JSON.parse(result.message);
+            }
+            if (_.isArray(result.batch)) {
+                // Batched messages from one peer, each is the original message text
+                _.each(result.batch, function (data) {
+                    self.trigger('message', JSON.parse(data), message);
+                });
+            } else {
+                this.trigger('message', result, message);
+            }
         },
         onclose: function (e) {
+            var hint = /retry=(\d+)/.exec(e.reason || '');
             console.debug('Websocket connection closed. ', e.reason);
             this.close();
             if (4200 <= e.code && e.code < 4299) {
-                // Fast reconnect with slow backoff
-                this.reconnect(100, 10, 1);
+                // Fast reconnect with slow backoff, after the delay the
+                // server asked for when it spreads out reconnects
+                this.reconnect(hint ? Number(hint[1]) : 100, 10, 1);
             } else if (4100 <= e.code && e.code < 4199) {
                 // Reconnect after a few seconds and backoff quickly
                 this.reconnect(2000, 1000, 1);
             } else if (4000 <= e.code && e.code < 4099) {
                 // URL needs to be refreshed
                 this.refresh();
+            } else if (e.code === 1006 && this.lastSeq !== null) {
+                // Dropped connection, resume the session quickly
+                this.reconnect(100, 100, 1);
+            } else if (e.code === 4400) {
+                // Evicted as a slow consumer, give the connection time to recover
+                this.reconnect(1000, 1000, 1);
             }
         },
         onerror: function (error) {